@@ -1,6 +1,8 @@
 # Standard Python modules
 import json
 import datetime
+import struct
+import types
 
 # 3rd party modules
 from twisted.internet import defer, reactor
@@ -14,7 +16,26 @@ from socialscan import scanning
 from socialscan.config import loadDefaultConfig
 from socialscan.db import setupDB
 from socialscan.model import Peer, Scan
-from socialscan.util import Safety, WeightedAverager
+from f3ds.framework.util import WeightedAverager
+from socialscan.util import Safety
+
+def resolve(result):
+    """
+    Turn what a handler's C{process} returned into a Deferred.  C{process} may return:
+        - its result, having computed it synchronously;
+        - a Deferred firing with its result;
+        - a resolver: a generator, as with C{defer.inlineCallbacks}, which yields a
+          Deferred for each stage that has to wait and hands over its result with
+          C{defer.returnValue}.
+
+    @rtype: C{twisted.internet.defer.Deferred}
+    """
+    if isinstance(result, types.GeneratorType):
+        return defer.inlineCallbacks(lambda: result)()
+    if isinstance(result, defer.Deferred):
+        return result
+    return defer.succeed(result)
+
 
 class BaseHandlerProxy(object):
     """
@@ -42,31 +63,137 @@ class BaseHandlerProxy(object):
         """
         raise NotImplementedError(self.not_implemented)
 
+    def resolve(self, core, request):
+        """
+        Process a request without blocking the reactor on a handler which does not.  Handlers
+        which compute their result synchronously are adapted, and still run on the reactor.
+
+        @return: a Deferred firing with the result of L{process}
+        @rtype: C{twisted.internet.defer.Deferred}
+        """
+        try:
+            result = self.process(core, request)
+        except:
+            return defer.fail()
+        return resolve(result)
+
+
+# Messages of the framed core protocol are JSON prefixed with their length in 4 network order
+# bytes.  No message comes close to MAX_LENGTH, so a framed connection always starts with a
+# zero byte, which is never the start of a message of the \x04 protocol.
+PREFIX = struct.Struct("!I")
+MAX_LENGTH = 1 << 20
+
+
+def frame(message):
+    """
+    Encode C{message} as a frame of the core protocol.
+    """
+    payload = json.dumps(message)
+    return PREFIX.pack(len(payload)) + payload
+
+
+def unframe(buffer):
+    """
+    Decode the complete frames at the start of C{buffer}.
+
+    @return: the decoded messages, and what is left of C{buffer} after them
+    @rtype: C{tuple} of C{list} and C{str}
+    @raise ValueError: if a frame is longer than L{MAX_LENGTH}
+    """
+    messages = []
+    offset = 0
+    while len(buffer) - offset >= PREFIX.size:
+        length, = PREFIX.unpack_from(buffer, offset)
+        if length > MAX_LENGTH:
+            raise ValueError("frame of %d bytes is too long" % length)
+        end = offset + PREFIX.size + length
+        if end > len(buffer):
+            break
+        messages.append(json.loads(buffer[offset + PREFIX.size:end]))
+        offset = end
+    return messages, buffer[offset:]
+
 
 class CoreRequest(Protocol):
+    """
+    Server side of the core protocol.
+
+    Each message is a frame (see L{frame}) holding C{[requestid, url]}, answered with a
+    frame holding C{[requestid, result]}.  The connection is kept open, so that a client can
+    keep many urls in flight on one connection; answers come back as soon as they are
+    ready, not in the order asked.  C{result} is C{null} if the url could not be handled.
+
+    For compatibility, a connection which does not start with a frame speaks the C{"\\x04"}
+    protocol: each message is a JSON document followed by C{"\\x04"}, which JSON never
+    contains.  A message which is just a url is answered with the JSON result, and the
+    connection closed; a message C{[requestid, url]} is answered with
+    C{[requestid, result]\\x04}, and the connection kept open.
+
+    @ivar framed: whether the connection speaks the framed protocol; C{None} until the
+                  first byte arrives
+    @type framed: C{bool}
+    """
     def __init__(self, core, logger_name='Core Request'):
         self.core = core
         self.handler = core.handler
         self.logger = Logger(logger_name)
-        self.input = []
+        self.buffer = ''
+        self.framed = None
         self.timeout = core.handle_timeout
 
     def dataReceived(self, data):
-        if "\x04" in data:
-            self.input.append(data.partition("\x04")[0])
-            url = json.loads("".join(self.input))
-            self.handle_url(url)
+        self.buffer += data
+        if self.framed is None and self.buffer:
+            self.framed = self.buffer[0] == "\x00"
+        if self.framed:
+            try:
+                messages, self.buffer = unframe(self.buffer)
+            except ValueError, e:
+                self.logger.log("dropping connection: %s" % e)
+                self.transport.loseConnection()
+                return
+            for message in messages:
+                self.messageReceived(message)
+        else:
+            while "\x04" in self.buffer:
+                message, _, self.buffer = self.buffer.partition("\x04")
+                self.messageReceived(json.loads(message))
+
+    def messageReceived(self, message):
+        """
+        Handle the url of one message, replying once it has been decided.
+        """
+        if isinstance(message, list):
+            requestid, url = message
+        else:
+            requestid, url = None, message
+        d = self.handle_url(url)
+        d.addCallback(self.reply, requestid)
+        d.addErrback(self.failed, requestid)
+
+    def reply(self, result, requestid=None):
+        if self.framed:
+            self.transport.write(frame([requestid, result]))
+        elif requestid is None:
+            self.transport.write(json.dumps(result))
+            self.transport.loseConnection()
         else:
-            self.input.append(data)
+            self.transport.write(json.dumps([requestid, result]) + "\x04")
 
-    def reply(self, result):
-        self.transport.write(json.dumps(result))
-        self.transport.loseConnection()
+    def failed(self, failure, requestid=None):
+        self.logger.log("handling url failed: %s" % failure.getTraceback())
+        if requestid is None and not self.framed:
+            self.transport.loseConnection()
+        else:
+            self.reply(None, requestid)
 
-    @defer.inlineCallbacks
     def handle_url(self, url):
         """
         Run the loop for an individual url
+
+        @return: a Deferred firing with the reply for the url
+        @rtype: C{twisted.internet.defer.Deferred}
         """
         raise NotImplementedError('Derived classes must implement handle_url.')
 
@@ -113,3 +240,111 @@ class CoreClientFactory(Factory):
     def buildProtocol(self, addr):
         return CoreClientRequest(self.url, self.callback)
 
+
+
+class CoreClient(Protocol):
+    """
+    Client side of the framed core protocol (see L{CoreRequest}): any number of urls may be
+    in flight at once on the one connection, each answered as soon as the core has decided
+    it.
+    """
+    def __init__(self):
+        self.buffer = ''
+        self.nextid = 0
+        self.pending = {}
+        self.lost = defer.Deferred()
+
+    def connectionMade(self):
+        # notice a connection which has silently died while it is kept open
+        try:
+            self.transport.setTcpKeepAlive(True)
+        except AttributeError:
+            pass
+
+    def request(self, url):
+        """
+        Ask the core about C{url}.
+
+        @return: a Deferred firing with the core's reply, C{None} if the core could not
+                 handle the url, or failing if the connection is lost first
+        @rtype: C{twisted.internet.defer.Deferred}
+        """
+        self.nextid += 1
+        d = self.pending[self.nextid] = defer.Deferred()
+        self.transport.write(frame([self.nextid, url]))
+        return d
+
+    def dataReceived(self, data):
+        try:
+            messages, self.buffer = unframe(self.buffer + data)
+        except ValueError:
+            self.transport.loseConnection()
+            return
+        for requestid, result in messages:
+            d = self.pending.pop(requestid, None)
+            if d is not None:
+                if result is not None:
+                    result = result.encode("utf-8")
+                d.callback(result)
+
+    def connectionLost(self, reason):
+        pending, self.pending = self.pending, {}
+        for d in pending.itervalues():
+            d.errback(reason)
+        self.lost.callback(None)
+
+
+class CoreConnection(object):
+    """
+    A persistent connection to the core shared by all requests, opened when first needed
+    and opened again when the next request comes after it was lost.
+
+    @ivar client: the connected protocol, if any
+    @type client: L{CoreClient}
+    """
+    def __init__(self, endpoint):
+        """
+        @param endpoint: where the core listens
+        @type endpoint: C{twisted.internet.interfaces.IStreamClientEndpoint}
+        """
+        self.endpoint = endpoint
+        self.client = None
+        self.waiting = []
+
+    def request(self, url):
+        """
+        Ask the core about C{url}; see L{CoreClient.request}.
+        """
+        d = self.connect()
+        d.addCallback(lambda client: client.request(url))
+        return d
+
+    def connect(self):
+        """
+        @return: a Deferred firing with the connected L{CoreClient}
+        @rtype: C{twisted.internet.defer.Deferred}
+        """
+        if self.client is not None:
+            return defer.succeed(self.client)
+        d = defer.Deferred()
+        self.waiting.append(d)
+        if len(self.waiting) == 1:
+            connecting = self.endpoint.connect(Factory.forProtocol(CoreClient))
+            connecting.addCallbacks(self._connected, self._failed)
+        return d
+
+    def _connected(self, client):
+        self.client = client
+        client.lost.addCallback(self._lost, client)
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.callback(client)
+
+    def _failed(self, failure):
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.errback(failure)
+
+    def _lost(self, ignored, client):
+        if self.client is client:
+            self.client = None
@@ -26,3 +26,10 @@ class DigestModifiedTimeError(Exception):
     Exception raised when the mtime of a Digest is older than expected.
     """
     pass
+
+class CorruptTransferError(IOError):
+    """
+    Exception raised when a container downloaded from a peer does not match the length or
+    checksum it was sent with.
+    """
+    pass
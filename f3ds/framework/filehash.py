@@ -12,6 +12,12 @@ if projectdir not in sys.path:
     sys.path.append(projectdir)
 
 from f3ds.framework.sethash import hasher
+from f3ds.framework.workers import WorkerPool
+
+# hashlib releases the GIL while hashing buffers this big, so several files can be hashed
+# at once on a thread pool while memory use stays at one block per file.
+BLOCKSIZE = 64 * 1024
+
 
 class FileIter(object):
     """
@@ -19,25 +25,79 @@ class FileIter(object):
     """
     def __init__(self, f, blocksize=4096):
         self.f = f
+        self.blocksize = blocksize
 
     def __iter__(self):
         return self
 
     def next(self):
-        r = self.f.read()
+        r = self.f.read(self.blocksize)
         if not len(r):
             raise StopIteration
         return r
 
 
-def filehash(filename):
-    f = open(filename, "rb")
-    print("opened")
+def filehash(filename, blocksize=BLOCKSIZE):
+    """
+    Hexdigest of the contents of C{filename}, read C{blocksize} bytes at a time.
+    """
     sum = hasher()
-    for block in FileIter(f):
-        sum.update(block)
+    with open(filename, "rb") as f:
+        for block in FileIter(f, blocksize):
+            sum.update(block)
     return sum.hexdigest()
 
 
-print pickle.dumps(filehash(sys.argv[1]))
+class FileHasher(object):
+    """
+    Hashes files on a bounded pool of threads, so that the reactor never waits on a file
+    being read and hashed.
+
+    @ivar workers: the threads hashing files
+    @type workers: L{WorkerPool}
+    """
+
+    def __init__(self, maxthreads=4, blocksize=BLOCKSIZE, reactor=None):
+        """
+        @param maxthreads: most files to hash at once; further files wait their turn
+        @type maxthreads: C{int}
+
+        @param blocksize: bytes to read and hash at a time
+        @type blocksize: C{int}
+        """
+        self.blocksize = blocksize
+        self.workers = WorkerPool('FileHasher', maxthreads, reactor)
+
+    def hash(self, filename):
+        """
+        Hash the contents of C{filename}.
+
+        @return: a Deferred firing with the hexdigest, or failing with the C{IOError} or
+                 C{OSError} raised reading the file
+        @rtype: C{twisted.internet.defer.Deferred}
+        """
+        return self.workers.run(filehash, filename, self.blocksize)
+
+    def stop(self):
+        """
+        Stop the threads once the files being hashed are done.
+        """
+        self.workers.stop()
+
+
+_hashers = {}
+
+
+def getHasher(maxthreads=4):
+    """
+    The shared L{FileHasher} with at most C{maxthreads} threads.
+    """
+    try:
+        return _hashers[maxthreads]
+    except KeyError:
+        service = _hashers[maxthreads] = FileHasher(maxthreads)
+        return service
+
 
+if __name__ == "__main__":
+    print pickle.dumps(filehash(sys.argv[1]))
@@ -23,10 +23,30 @@ from sqlalchemy.orm import mapper, relationship, backref
 
 # Our modules
 from f3ds.framework import util
+from f3ds.framework.exceptions import ContainerFullError
+from f3ds.framework.peerrpc import PooledProxy
 from f3ds.framework.util import UrlObject, class_name, delta_seconds, TimeoutedTransport
 
 Base = declarative_base()
 
+_taints = 0
+
+
+def taints():
+    """
+    How many containers and scans have been marked tainted so far.  Anything decided using
+    what was there before the count last changed may rest on a tainted result.
+    """
+    return _taints
+
+
+def countTaint():
+    """
+    Count one more container or scan marked tainted.
+    """
+    global _taints
+    _taints += 1
+
 
 # TODO: write tests (can use ScanDigestFile, ScanLogFile tests as starting point).
 class ContainerMixin(object):
@@ -70,21 +90,27 @@ class ContainerMixin(object):
 
     @property
     def usefulness(self):
-        now = datetime.now()
+        """
+        Hits per second since the container was made.
+        """
+        now = datetime.utcnow()
         if not hasattr(self, 'date') or not self.date:
             self.date = now
-        agesecs = util.delta_seconds(self.date - now)
+        agesecs = util.delta_seconds(now - self.date)
         try:
             return float(self.hits) / agesecs
         except:
             return float(0)
 
-    def create(self, maxcapacity):
+    def create(self, maxcapacity, **options):
         """
         Create a container.
+
+        @param options: passed on to the container type, such as a digest's C{backend}
         """
         self.maxcapacity = maxcapacity
-        self._container = self.container_type(self.maxcapacity, self.meta, self.filename)
+        self._container = self.container_type(self.maxcapacity, self.meta, self.filename,
+                                              **options)
 
     def load(self):
         """
@@ -132,6 +158,32 @@ class ContainerMixin(object):
             raise AttributeError(msg)
         return add(item, extra)
 
+    def add_many(self, items, extras=None):
+        """
+        Add a batch of items to the container, C{extras[i]} going with C{items[i]}.  Uses the
+        container's own C{add_many} when it has one, otherwise adds the items one by one.
+
+        @return: the number of items taken from the front of C{items}; fewer than all of
+                 them means the container filled up at that position.
+        @rtype: C{int}
+        """
+        container = getattr(self, '_container', None)
+        if container is None:
+            msg = "Attempted to add to %r which is not loaded. call load() before using!"
+            raise AttributeError(msg % (self,))
+        if extras is None:
+            extras = [None] * len(items)
+        if hasattr(container, 'add_many'):
+            return container.add_many(items, extras)
+        taken = 0
+        for item, extra in zip(items, extras):
+            try:
+                container.add(item, extra)
+            except ContainerFullError:
+                break
+            taken += 1
+        return taken
+
     @property
     def meta(self):
         """
@@ -150,6 +202,7 @@ class ContainerMixin(object):
         relationship = self.owner.getRelationship(session, self.creator)
         relationship.punish(punishment)
         self.tainted = True
+        countTaint()
         session.add(relationship)
         session.add(self)
 
@@ -293,12 +346,10 @@ class BasePeer(object):
     @property
     def transport(self):
         """
-        Return a call proxy to this peer's rpccommands, currently using xmlrpc
+        Return a call proxy to this peer's rpccommands, currently using xmlrpc over
+        connections kept open between calls (see L{f3ds.framework.peerrpc})
         """
-        transport_with_timeout = util.TimeoutedTransport()
-        transport_with_timeout.set_timeout(self.timeout)
-        return xmlrpclib.ServerProxy(self.rpc_url+"RPC2", allow_none=True,
-                                     transport=transport_with_timeout)
+        return PooledProxy(self.rpc_url+"RPC2", self.timeout)
 
     def getRelationship(self, session, peer):
         """
@@ -7,6 +7,8 @@ import os
 
 # Our modules
 from f3ds.framework.log import Logger
+from f3ds.framework.model.index import DigestIndex
+from f3ds.framework.model.workingset import WorkingSet
 from f3ds.framework.util import UrlObject
 from socialscan.model import relationshipsQuery
 from socialscan.searchutil import SearchResult
@@ -32,6 +34,19 @@ class ContainerManager(object):
     @ivar containers: foreign containers currently loaded
     @type containers: C{list} of L{ContainerMixin}
 
+    @ivar workingset: the loaded containers ranked by their recent hits, against the
+                      memory budget of C{config.container_manager.memory_budget_mb}, or
+                      L{loadlimit} when there is none
+    @type workingset: L{WorkingSet}
+
+    @ivar demoted: containers unloaded to make room but still searched from disk, at most
+                   C{config.container_manager.demote_limit} of them
+    @type demoted: L{WorkingSet}
+
+    @ivar index: combined membership index of the loaded containers, or C{None} when
+                 C{config.container_manager.use_index} is off
+    @type index: L{DigestIndex} or C{None}
+
     @ivar ourcontainer: the container that is currently being built by this container manager
     @type ourcontainer: L{ContainerMixin}
 
@@ -59,19 +74,29 @@ class ContainerManager(object):
             os.makedirs(storedir)
 
         self.loadlimit = int(config.container_manager.loadlimit)
+        budget = float(getattr(config.container_manager, 'memory_budget_mb', 0))
+        halflife = float(getattr(config.container_manager, 'usefulness_halflife', 3600))
+        demotelimit = int(getattr(config.container_manager, 'demote_limit', 0))
+        self.workingset = WorkingSet(int(budget * 1024 * 1024), self.loadlimit, halflife)
+        self.demoted = WorkingSet(0, demotelimit, halflife)
         self.announcequeue = []
         self.containers = []
+        useindex = getattr(config.container_manager, 'use_index', 'True')
+        self.index = DigestIndex() if useindex in ['True', 'true'] else None
         allcontainers = session.query(self.container)\
                             .filter(self.container.owner == config.owner)\
                             .filter(self.container.creator != config.owner)\
                             .all()
                             # TODO: get the below filter working
                             #.filter(self.container.tainted == False)\
-        sortedcontainers = sorted(allcontainers, key=lambda container: container.usefulness)
-        for container in sortedcontainers[:self.loadlimit]:
+        sortedcontainers = sorted(allcontainers, key=lambda container: container.usefulness,
+                                  reverse=True)
+        for container in sortedcontainers:
+            if self.workingset.full(self._cost(container)):
+                continue
             try:
                 container.container_type = eval(container.container_type_name)
-                self.containers.append(container.load())
+                self._loadcontainer(container.load())
             except (ValueError, AttributeError, IOError), error:
                 msg = 'Error while loading %s %s: %s'
                 self.logger.log(msg % (self.cname, container, error))
@@ -133,18 +158,101 @@ class ContainerManager(object):
         """
         pass
 
+    def _cost(self, container):
+        """
+        Bytes a foreign container takes when loaded, counted by the size of its file.
+        """
+        try:
+            return os.path.getsize(container.filename)
+        except OSError:
+            return 0
+
+    def _loadcontainer(self, container, key=None):
+        """
+        Put a loaded foreign container in the working set, adding it to L{index} if its
+        contents can be indexed.  The weakest containers are evicted to make room for it.
+
+        @param key: its rank in L{workingset}; by default that of its lifetime
+                    C{usefulness}
+        @type key: C{float}
+        """
+        cost = self._cost(container)
+        if key is None:
+            key = self.workingset.keyOf(self.workingset.rate(container.usefulness))
+        while len(self.workingset) and self.workingset.full(cost):
+            self._unloadone()
+        self.containers.append(container)
+        if self.index is not None:
+            self.index.add(container, container._container)
+        self.workingset.add(container, cost, key)
+
+    def _unloadcontainer(self, container):
+        """
+        Take a foreign container out of the working set and L{index}, or out of L{demoted},
+        then unload it.
+        """
+        if container in self.demoted:
+            self.demoted.remove(container)
+        else:
+            self._removecontainer(container)
+        container.unload()
+
+    def _removecontainer(self, container):
+        """
+        Take a foreign container out of the working set and L{index}, leaving it loaded.
+
+        @return: its rank in L{workingset}
+        """
+        self.containers.remove(container)
+        if self.index is not None:
+            self.index.remove(container)
+        if container in self.workingset:
+            return self.workingset.remove(container)
+        return WorkingSet.NEVER
+
     def _unloadone(self):
         """
-        Unload the least useful container.
+        Evict the container with the lowest score of recent hits from the working set:
+        demote it to be searched from disk if L{demoted} has room for it, and unload it
+        otherwise.
         """
-        self.logger.log('attempting to unload some containers [stub]')
-        if not len(self.containers):
+        container, key = self.workingset.weakest()
+        if container is None:
             self.logger.log('no %s loaded to unload!' % (self.cname))
-        containers = sorted(self.containers, key=lambda container: container.usefulness)
-        tounload = containers[0]
-        self.containers.remove(tounload)
-        tounload.unload()
-        self.logger.log('unloaded %s %r' % (self.cname, (tounload,)))
+            return
+        key = self._removecontainer(container)
+        demote = getattr(container._container, 'demote', None)
+        if self.demoted.limit and demote is not None and demote():
+            self.demoted.add(container, 0, key)
+            self.logger.log('demoted %s %r' % (self.cname, (container,)))
+            while len(self.demoted) > self.demoted.limit:
+                weakest, weakestkey = self.demoted.weakest()
+                self._unloadcontainer(weakest)
+                self.logger.log('unloaded demoted %s %r' % (self.cname, (weakest,)))
+        else:
+            container.unload()
+            self.logger.log('unloaded %s %r' % (self.cname, (container,)))
+
+    def _hit(self, container):
+        """
+        Count a hit of a searched container in its score.  A demoted container whose score
+        now beats the weakest loaded container's, or which has room, is loaded again.
+        """
+        if container in self.workingset:
+            self.workingset.hit(container)
+        elif container in self.demoted:
+            self.demoted.hit(container)
+            key = self.demoted.keys[container]
+            cost = self._cost(container)
+            weakest, weakestkey = self.workingset.weakest()
+            if not self.workingset.fits(cost):
+                return
+            if self.workingset.full(cost) and weakest is not None and weakestkey >= key:
+                return
+            self.demoted.remove(container)
+            container._container.promote()
+            self._loadcontainer(container, key)
+            self.logger.log('promoted %s %r' % (self.cname, (container,)))
 
     def search(self, url, size, contenthash, aggregate=False):
         """
@@ -4,21 +4,26 @@ Code to handle innards of scan digests.
 """
 
 # Standard python modules
+import cStringIO
 import datetime
+import hashlib
 import os
 import random
 # see http://docs.python.org/library/struct.html for struct documentation
 # particularly of the format strings
 import struct
 import time
+import zlib
 
 # 3rd party modules
-from pybloom import ScalableBloomFilter
+from pybloom import BloomFilter, ScalableBloomFilter
 
 # Our modules
 from f3ds.framework.log import Logger
 from f3ds.framework.exceptions import (ContainerFullError, ZeroSizedDigestError,
                                        DigestModifiedTimeError)
+from f3ds.framework.model.mappedfilter import (FixedFilter, StoredFilter, newfilter,
+                                               openfilter, writefilter)
 from f3ds.framework.util import UrlObject
 from socialscan.util import SigInfo
 
@@ -33,8 +38,10 @@ class Digest(object):
                   ranged C{0} to C{0xffffffff-1}.
     @type nonce: C{int}
 
-    @ivar filterS: Bloom filter
-    @type filterS: C{ScalableBloomFilter}
+    @ivar filterS: filter from the backend the digest was made with; read-only, probed
+                   from a mapping of the file, when loaded from a file written in the mapped
+                   format, until something is added.
+    @type filterS: C{ScalableBloomFilter} or L{f3ds.framework.model.mappedfilter.StoredFilter}
 
     @ivar maxcapacity: maximum number of items to store in this digest.
     @type maxcapacity: C{int}
@@ -44,7 +51,34 @@ class Digest(object):
 
     @ivar saved: whether this digest has been saved since items were added.
     @type saved: C{bool}
+
+    @ivar generation: how many times this digest has been saved; written to the file in the
+                      mapped format, so that a peer holding a copy knows how old it is.
+    @type generation: C{int}
+
+    @cvar fileformat: how L{save} writes the filters of new digests, by default:
+                      C{'scalable'} for C{ScalableBloomFilter}'s own format, which every peer
+                      reads, or C{'mapped'} for the format which L{load} maps into memory (see
+                      L{f3ds.framework.model.mappedfilter}), which peers running versions
+                      from before it cannot read.  L{load} reads both, and a digest loaded
+                      from a file in the mapped format is saved in it again.  Filters of
+                      backends other than the scalable one are always written in the mapped
+                      format.
+    @type fileformat: C{str}
+
+    @cvar backend: backend of the filters of new digests, by default: C{'scalable'} for
+                   C{ScalableBloomFilter}, which grows as items are added, or one of the
+                   filters sized for L{maxcapacity}, C{'blocked'} or C{'cuckoo'}.  See
+                   L{f3ds.framework.model.mappedfilter.backends}.
+    @type backend: C{str}
     """
+    fileformat = 'scalable'
+    backend = 'scalable'
+    # Bytes in each block of the saved file that L{delta} compares between generations.
+    blocksize = 1024
+    # Seconds by which a file system's modification times may trail time.time().
+    mtime_resolution = 0.1
+
     # Compile just one format string, just once for the class
     # Packing is for int: self.nonce
     #                int: self.maxcapacity
@@ -52,24 +86,48 @@ class Digest(object):
     #                str: self.meta
     transformer = struct.Struct('<III150p')
 
-    def __init__(self, maxcapacity, meta, filename, filterS=None, nonce=None):
+    def __init__(self, maxcapacity, meta, filename, filterS=None, nonce=None, backend=None,
+                 fileformat=None):
         """
         @param filterS: object to use as filterS if not None. if None, a new filter will be created.
-        @type filterS: C{ScalableBloomFilter} or C{None}
+        @type filterS: C{ScalableBloomFilter}, L{StoredFilter} or C{None}
+
+        @param backend: backend of the new filter, instead of the class's L{backend}
+        @type backend: C{str}
+
+        @param fileformat: how to save the filters, instead of the class's L{fileformat}
+        @type fileformat: C{str}
 
         @param nonce: if not None, the nonce to use. When None, a new one will be generated.
         @type nonce: C{int}
         """
         self.saved = True  # nothing to save until add is called.
+        if fileformat is None and isinstance(filterS, StoredFilter):
+            fileformat = 'mapped'
+        if fileformat is not None:
+            if fileformat not in ('mapped', 'scalable'):
+                raise ValueError('unknown digest file format %r' % (fileformat,))
+            self.fileformat = fileformat
         if nonce != None:
             self.nonce = nonce
         else:
             self.nonce = random.randint(0, 0xffffffff)
-        self.filterS = filterS or ScalableBloomFilter()
+        if filterS is None:
+            # An item is stored under up to two keys; see itemkeys().
+            filterS = newfilter(backend or self.backend, 2 * maxcapacity)
+        self.filterS = filterS
         self.maxcapacity = maxcapacity
         self.meta = meta
         self.urlcount = 0
         self.filename = filename
+        self.generation = getattr(filterS, 'generation', 0)
+        # What L{delta} needs: the md5 of each block of the file last saved, the generation
+        # each block last changed in, and the first generation saved in this process.
+        self._blocksums = None
+        self._changed = None
+        self._base = None
+        self._length = None
+        self.checksum = None
 
     def get(self, obj):
         """
@@ -80,15 +138,43 @@ class Digest(object):
         @param obj: object to search for
         @type obj: L{UrlObject}
         """
-        found = False
-        try:
-            contenthash = obj.contenthash
-        except AttributeError:
-            pass
-        else:
-            if contenthash:
-                found = contenthash.decode("hex") in self.filterS
-        return found or obj.url.decode('hex') in self.filterS
+        for key in self.itemkeys(obj):
+            if key in self.filterS:
+                return True
+        return False
+
+    @staticmethod
+    def itemkeys(obj):
+        """
+        The filter keys of a UrlObject: the raw content hash, if there is one, followed by
+        the raw url hash, if there is one.  These are the keys L{add} stores and L{get} looks
+        for.
+
+        @param obj: object to get the keys of
+        @type obj: L{UrlObject}
+
+        @rtype: C{list} of C{str}
+        """
+        keys = []
+        contenthash = getattr(obj, 'rawcontenthash', '')
+        if contenthash:
+            keys.append(contenthash)
+        if obj.rawurl:
+            keys.append(obj.rawurl)
+        return keys
+
+    def slices(self):
+        """
+        The stacked bloom filters making up this digest, for use by a
+        L{f3ds.framework.model.index.DigestIndex}.
+
+        @return: one C{(num_slices, bits_per_slice, bits)} tuple per stacked filter
+        @rtype: C{list} of C{tuple}
+
+        @raise AttributeError: if the digest's backend is not the scalable one, whose
+                               filters are hashed the way the index probes them
+        """
+        return [(f.num_slices, f.bits_per_slice, f.bitarray) for f in self.filterS.filters]
 
     def __len__(self):
         """
@@ -100,8 +186,61 @@ class Digest(object):
         # If the last one added filled this digest to capacity, don't add another.
         if len(self) >= self.maxcapacity:
             raise ContainerFullError
+        if self._mapped():
+            self._thaw()
         self.saved = False
-        return self.filterS.add(key)
+        return self._insert(key)
+
+    def _mapped(self):
+        """
+        Whether L{filterS} is read-only, probed from the file it was loaded from.
+        """
+        return isinstance(self.filterS, StoredFilter) and self.filterS.mapping is not None
+
+    def _insert(self, key):
+        """
+        Insert a key into L{filterS} the way C{ScalableBloomFilter.add} does, but hashing it
+        only once for the filter it lands in: the hashes from the membership check of the
+        newest filter are reused to set its bits.
+
+        @return: True if the key was already present
+        @rtype: C{bool}
+        """
+        filterS = self.filterS
+        if isinstance(filterS, FixedFilter):
+            return filterS.add(key)
+        filters = filterS.filters
+        newest = filters[-1] if filters else None
+        hashes = None
+        for bloom in reversed(filters):
+            found = bloom.make_hashes(key)
+            if found in bloom:
+                return True
+            if hashes is None:
+                hashes = found
+        if newest is None or newest.count >= newest.capacity:
+            num_filters = len(filters)
+            newest = BloomFilter(
+                capacity=filterS.initial_capacity * (filterS.scale ** num_filters),
+                error_rate=filterS.error_rate * (filterS.ratio ** num_filters))
+            filters.append(newest)
+            hashes = newest.make_hashes(key)
+        bits = newest.bitarray
+        bits_per_slice = newest.bits_per_slice
+        offset = 0
+        for k in hashes:
+            bits[offset + k] = True
+            offset += bits_per_slice
+        newest.count += 1
+        return False
+
+    def _thaw(self):
+        """
+        Replace a read-only mapped filter with a writable in-memory copy.
+        """
+        mapped = self.filterS
+        self.filterS = mapped.thaw()
+        mapped.close()
 
     def add(self, item, extra=None):
         """
@@ -111,19 +250,51 @@ class Digest(object):
         added = False
         if not item:
             return added
-        try:
-            contenthash = item.contenthash
-        except AttributeError:
-            pass
-        else:
-            if contenthash:
-                added = not self._addkey(contenthash.decode('hex'))
-        if item.url:
-            added = not self._addkey(item.url.decode('hex')) or added
+        for key in self.itemkeys(item):
+            added = not self._addkey(key) or added
         if added:
             self.urlcount += 1
         return added
 
+    def add_many(self, items, extras=None):
+        """
+        Add a batch of items in one pass.  Unlike L{add}, a full digest does not raise
+        L{ContainerFullError}; the number of items taken says where the batch overflowed.
+
+        Param extras is deliberately unused; it exists for the interface.
+
+        @param items: items to add, in order
+        @type items: iterable of L{UrlObject}
+
+        @return: the number of items taken from the front of C{items}.  When it is less than
+                 the number of items, the item at that position and all after it did not
+                 fit and still need adding somewhere else.
+        @rtype: C{int}
+        """
+        taken = 0
+        itemkeys = self.itemkeys
+        insert = self._insert
+        for item in items:
+            # Empty items are skipped, as add() does, even when the digest is full.
+            if item:
+                if self.urlcount >= self.maxcapacity:
+                    break
+                if self._mapped():
+                    self._thaw()
+                added = False
+                try:
+                    for key in itemkeys(item):
+                        added = not insert(key) or added
+                except ContainerFullError:
+                    # a fixed-size filter with no room left before maxcapacity
+                    self.saved = False
+                    break
+                if added:
+                    self.urlcount += 1
+                    self.saved = False
+            taken += 1
+        return taken
+
     def makedirs(self):
         filedir = os.path.dirname(self.filename)
         try:
@@ -137,44 +308,210 @@ class Digest(object):
     # TODO: should we be saving self.hits as well?
     def save(self):
         """
-        Write the filters for this digest to a seekable file-like object.
+        Write the header and filters for this digest to its file, as its next generation.
         Based off of the equivalent method in ScalableBloomFilter.
         """
         if not self.saved:
             now = time.time()
+            self.generation += 1
+            serialized = cStringIO.StringIO()
+            serialized.write(self._packheader())
+            self._writefilter(serialized)
+            data = serialized.getvalue()
             with open(self.filename, "wb") as f:
-                f.write(self.transformer.pack(self.nonce, self.maxcapacity,
-                                              self.urlcount, str(self.meta)))
-                self.filterS.tofile(f)
+                f.write(data)
+            self._track(data)
             self.saved = True
             self.verify_save(now)
 
+    def _packheader(self):
+        """
+        The header written at the start of the file, packed with L{transformer}.
+        """
+        return self.transformer.pack(self.nonce, self.maxcapacity, self.urlcount,
+                                     str(self.meta))
+
+    def _track(self, data):
+        """
+        Note which blocks of the file just saved as C{data} differ from the generation saved
+        before, for L{delta}.  Only the mapped format keeps the generation in the file, so
+        nothing is tracked for the other.
+        """
+        if not self._mappedformat():
+            self._blocksums = self._changed = self._base = None
+            return
+        size = self.blocksize
+        sums = [hashlib.md5(data[i:i + size]).digest() for i in xrange(0, len(data), size)]
+        if self._blocksums is None:
+            # What was saved before is not known, so deltas can only start from here.
+            self._base = self.generation
+            self._changed = [self.generation] * len(sums)
+        else:
+            previous = self._blocksums
+            changed = self._changed[:len(sums)]
+            for i, blocksum in enumerate(sums):
+                if i >= len(changed):
+                    changed.append(self.generation)
+                elif blocksum != previous[i]:
+                    changed[i] = self.generation
+            self._changed = changed
+        self._blocksums = sums
+        self._length = len(data)
+        self.checksum = hashlib.md5(data).hexdigest()
+
+    def delta(self, since):
+        """
+        What a peer holding a copy of this digest's file as saved at generation C{since}
+        needs to bring it up to the generation last saved: the blocks which have changed.
+
+        @param since: the generation of the peer's copy
+        @type since: C{int}
+
+        @return: C{None} when the changes since C{since} are not known and the file has to
+                 be fetched whole, otherwise a C{dict} of the C{generation}, C{length} and
+                 md5 C{checksum} of the file, the C{blocksize}, the C{indexes} of the
+                 changed blocks and their C{data}, back to back and zlib compressed
+        @rtype: C{dict} or C{None}
+        """
+        if self._changed is None or not self._base <= since <= self.generation:
+            return None
+        size = self.blocksize
+        indexes = [i for i, generation in enumerate(self._changed) if generation > since]
+        blocks = []
+        with open(self.filename, "rb") as f:
+            for i in indexes:
+                f.seek(i * size)
+                blocks.append(f.read(size))
+        return {'generation': self.generation, 'length': self._length,
+                'checksum': self.checksum, 'blocksize': size, 'indexes': indexes,
+                'data': zlib.compress(''.join(blocks))}
+
+    def patch(self, delta):
+        """
+        Bring this digest, loaded from a copy of a peer's file, up to date in place with a
+        L{delta} from the peer: the changed blocks are written into the file, which is then
+        read again.
+
+        @raise ValueError: if the delta does not fit the file: a block lies outside the
+                           new length, the file would grow by more than the blocks sent,
+                           or the data is not the blocks' length.  The file is left as it
+                           was.  Also if the patched file is not the same as the peer's;
+                           this digest can then no longer be probed, and the file has to be
+                           fetched whole.
+        """
+        size = delta['blocksize']
+        length = delta['length']
+        indexes = delta['indexes']
+        current = os.path.getsize(self.filename)
+        if size <= 0 or not 0 <= length <= current + len(indexes) * size:
+            msg = 'delta for digest %s has blocksize %s and length %s, for a file of %s bytes'
+            raise ValueError(msg % (self.filename, size, length, current))
+        if any(not 0 <= i * size < length for i in indexes):
+            msg = 'delta for digest %s has blocks outside its length %s'
+            raise ValueError(msg % (self.filename, length))
+        expected = sum(min(size, length - i * size) for i in indexes)
+        data = zlib.decompressobj().decompress(delta['data'], expected + 1)
+        if len(data) != expected:
+            msg = 'delta for digest %s has %s bytes of blocks, not %s'
+            raise ValueError(msg % (self.filename, len(data), expected))
+        if self._mapped():
+            self.filterS.close()
+        checksum = hashlib.md5()
+        with open(self.filename, "r+b") as f:
+            position = 0
+            for i in indexes:
+                block = data[position:position + min(size, length - i * size)]
+                position += len(block)
+                f.seek(i * size)
+                f.write(block)
+            f.truncate(length)
+            f.seek(0)
+            for block in iter(lambda: f.read(size * 64), ''):
+                checksum.update(block)
+        if checksum.hexdigest() != delta['checksum']:
+            msg = 'digest %s patched to generation %s does not match the original'
+            raise ValueError(msg % (self.filename, delta['generation']))
+        vars(self).update(vars(self.load(self.filename)))
+
     def verify_save(self, age=0):
         """
         If a digest is written with 0 bytes, there was a problem.  Stop the system so
-        it can be found.  Double-check the last modification time.
+        it can be found.  Double-check the last modification time, allowing for file
+        system timestamps being coarser than C{time.time()}.
         """
         size = os.path.getsize(self.filename)
         if not size > 0:
             msg = 'file %s has size %s bytes' % (self.filename, size)
             raise ZeroSizedDigestError(msg)
         newer = os.path.getmtime(self.filename)
-        if not newer >= age:
+        if not newer >= age - self.mtime_resolution:
             msg = 'file %s age in seconds since the epoch is %s, but expected something >= %s'
             raise DigestModifiedTimeError(msg % (self.filename, newer, age))
 
+    def _writefilter(self, f):
+        """
+        Write the filters to C{f} in L{fileformat}, just after the header.
+        """
+        if self._mappedformat():
+            writefilter(f, self.filterS, self.generation)
+        else:
+            self.filterS.tofile(f)
+
+    def _mappedformat(self):
+        """
+        Whether L{save} writes the mapped format: always for the backends that only have it.
+        """
+        return self.fileformat == 'mapped' or isinstance(self.filterS, FixedFilter)
+
+    @classmethod
+    def _readfilter(cls, f, filename):
+        """
+        Read the filters following the header in C{f}.  A file in the mapped format is
+        mapped, which only reads the filter table; anything else is read into memory.
+        """
+        if StoredFilter.ismapped(f):
+            return openfilter(filename, f.tell())
+        return ScalableBloomFilter.fromfile(f)
+
     def close(self):
         """
-        Make sure digest changes are written.
+        Make sure digest changes are written, and release any mapping.
         """
         try:
             self.save()
         except IOError:
             pass
+        if self._mapped():
+            self.filterS.close()
+
+    def demote(self):
+        """
+        Probe L{filterS} from the file rather than from a mapping of it, so that the digest
+        stays searchable while holding next to no memory.  Only a digest loaded in the mapped
+        format can be demoted.
+
+        @return: whether the digest is now probed from the file
+        @rtype: C{bool}
+        """
+        mapped = self.filterS
+        if not self._mapped():
+            return False
+        if not mapped.ondisk:
+            self.filterS = mapped.reopen(ondisk=True)
+            mapped.close()
+        return True
+
+    def promote(self):
+        """
+        Map the file of a L{demote}d digest again.
+        """
+        mapped = self.filterS
+        if self._mapped() and mapped.ondisk:
+            self.filterS = mapped.reopen()
+            mapped.close()
 
     @classmethod
     def load(cls, filename):
-        #import pdb; pdb.set_trace()
         t = cls.transformer
         size = t.size
         with open(filename, "rb") as serialized_digest:
@@ -186,9 +523,9 @@ class Digest(object):
             nonce, maxcapacity, urlcount, meta = t.unpack(readdata)
 
             # If meta has a conversion from string repr, use it.
-            if hasattr(self, 'meta_from_string'):
-                meta = self.meta_from_string()
-            filterS = ScalableBloomFilter.fromfile(serialized_digest)
+            if hasattr(cls, 'meta_from_string'):
+                meta = cls.meta_from_string(meta)
+            filterS = cls._readfilter(serialized_digest, filename)
         digest = cls(maxcapacity, meta, filename, filterS=filterS, nonce=nonce)
         digest.urlcount = urlcount
         return digest
@@ -0,0 +1,190 @@
+#!/usr/bin/python
+"""
+Combined membership index over the bloom filters of several loaded digests.
+"""
+
+# 3rd party modules
+from bitarray import bitarray
+from pybloom.pybloom import make_hashfuncs
+
+# Our modules
+from f3ds.framework.model.digest import Digest
+
+_ONE = bitarray('1')
+
+
+def _setbits(bits):
+    """
+    Positions of the set bits in a filter's bit array.
+    """
+    return bits.search(_ONE)
+
+
+class DigestIndex(object):
+    """
+    Bit-sliced signature index over the bloom filters of several digests.
+
+    Every indexed digest gets a slot.  For each filter geometry C{(num_slices,
+    bits_per_slice)} found among the digests' stacked filters the index keeps one row of
+    L{width} bits per filter bit, all packed into one C{bitarray}, and bit C{slot} of a row
+    is set when that digest's filter has that bit set.  Probing hashes a key once per
+    geometry and ANDs the matching rows together; the slots left standing are exactly the
+    digests whose C{get} would have answered True.  Digests are added and removed one at a
+    time, so loading and unloading a digest never rebuilds the index.
+
+    @ivar slots: slot number of each indexed member
+    @type slots: C{dict}
+
+    @ivar members: the member and the geometries of its filters, for each used slot
+    @type members: C{dict}
+
+    @ivar geometries: C{[rows, refcount]} for each filter geometry in use
+    @type geometries: C{dict}
+
+    @ivar width: bits in each row; doubled when every slot is used
+    @type width: C{int}
+
+    @ivar mask: a row with the bit of every used slot set
+    @type mask: C{bitarray}
+    """
+
+    def __init__(self, width=8):
+        self.slots = {}
+        self.members = {}
+        self.free = []
+        self.geometries = {}
+        self.hashfuncs = {}
+        self.width = width
+        self.mask = bitarray(width)
+        self.mask.setall(False)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, member):
+        return member in self.slots
+
+    def _rows(self, geometry):
+        try:
+            entry = self.geometries[geometry]
+        except KeyError:
+            num_slices, bits_per_slice = geometry
+            rows = bitarray(num_slices * bits_per_slice * self.width)
+            rows.setall(False)
+            entry = self.geometries[geometry] = [rows, 0]
+            if geometry not in self.hashfuncs:
+                self.hashfuncs[geometry] = make_hashfuncs(num_slices, bits_per_slice)
+        return entry
+
+    def _widen(self):
+        """
+        Double L{width}, copying every slot's column of each geometry's rows across.
+        """
+        width = self.width * 2
+        for entry in self.geometries.itervalues():
+            rows = bitarray(len(entry[0]) // self.width * width)
+            rows.setall(False)
+            for slot in self.members:
+                rows[slot::width] = entry[0][slot::self.width]
+            entry[0] = rows
+        self.mask.extend([False] * self.width)
+        self.width = width
+
+    def add(self, member, digest):
+        """
+        Index the filters of C{digest} under C{member}, replacing anything already indexed
+        under C{member}.
+
+        @param member: what L{candidates} should return when C{digest} may hold a key,
+                       usually the container holding C{digest}
+        @type member: any hashable object
+
+        @param digest: digest to index
+        @type digest: L{Digest}
+
+        @return: False if C{digest} does not expose its filters and was not indexed
+        @rtype: C{bool}
+        """
+        try:
+            slices = digest.slices()
+        except AttributeError:
+            return False
+        if member in self.slots:
+            self.remove(member)
+        if self.free:
+            slot = self.free.pop()
+        else:
+            slot = len(self.members)
+        if slot >= self.width:
+            self._widen()
+        width = self.width
+        geometries = []
+        for num_slices, bits_per_slice, bits in slices:
+            geometry = (num_slices, bits_per_slice)
+            entry = self._rows(geometry)
+            rows = entry[0]
+            size = num_slices * bits_per_slice
+            for position in _setbits(bits):
+                if position < size:
+                    rows[position * width + slot] = True
+            entry[1] += 1
+            geometries.append(geometry)
+        self.slots[member] = slot
+        self.members[slot] = (member, geometries)
+        self.mask[slot] = True
+        return True
+
+    def remove(self, member):
+        """
+        Stop indexing C{member}.  Does nothing if C{member} is not indexed.
+        """
+        try:
+            slot = self.slots.pop(member)
+        except KeyError:
+            return
+        member, geometries = self.members.pop(slot)
+        for geometry in geometries:
+            entry = self.geometries[geometry]
+            entry[1] -= 1
+            if not entry[1]:
+                del self.geometries[geometry]
+            else:
+                entry[0][slot::self.width] = False
+        self.mask[slot] = False
+        self.free.append(slot)
+
+    def probe(self, keys):
+        """
+        Return the set of members which may hold any of C{keys}.
+
+        @param keys: raw filter keys, as produced by L{Digest.itemkeys}
+        @type keys: C{list} of C{str}
+        """
+        width = self.width
+        found = bitarray(width)
+        found.setall(False)
+        for geometry, (rows, refcount) in self.geometries.iteritems():
+            bits_per_slice = geometry[1]
+            make_hashes = self.hashfuncs[geometry]
+            for key in keys:
+                mask = self.mask & ~found
+                offset = 0
+                for k in make_hashes(key):
+                    start = (offset + k) * width
+                    mask &= rows[start:start + width]
+                    if not mask.any():
+                        break
+                    offset += bits_per_slice
+                found |= mask
+        return set(self.members[slot][0] for slot in _setbits(found))
+
+    def candidates(self, urlobject):
+        """
+        Return the set of members which may hold the url hash or the content hash of
+        C{urlobject}.
+
+        @type urlobject: L{UrlObject}
+        """
+        if not self.slots:
+            return set()
+        return self.probe(Digest.itemkeys(urlobject))
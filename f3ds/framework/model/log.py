@@ -4,7 +4,6 @@ Log implementation details. (Not to be confused with the logging module called l
 """
 
 # Python standard libraries
-import anydbm
 import os
 
 from datetime import datetime
@@ -15,6 +14,7 @@ from os import path
 # Our modules
 from f3ds.framework.log import Logger
 from f3ds.framework.exceptions import ContainerFullError
+from f3ds.framework.model.logstore import openstore
 from f3ds.framework.util import Present
 
 
@@ -35,11 +35,21 @@ class Log(object):
 
     @ivar saved: whether this log has been saved since items were added.
     @type saved: C{bool}
+
+    @ivar db: storage for the keys, values and metadata
+    @type db: a backend from L{f3ds.framework.model.logstore.stores}
+
+    @cvar storetype: name of the storage backend for new logs, by default: C{'dbm'}, which
+                     every peer reads, or C{'segment'}, which peers running versions from
+                     before it cannot read.  Existing logs are opened with the backend that
+                     wrote them.
+    @type storetype: C{str}
     """
     logger = Logger('Log')
+    storetype = 'dbm'
     bool_string_map = {'1': True, '0': False}
 
-    def __init__(self, maxcapacity, meta, dbpath):
+    def __init__(self, maxcapacity, meta, dbpath, storetype=None):
         """
         @param maxcapacity: maximum capacity of Log.  Should be the same as the
                             corresponding ScanDigest's maxcapacity.
@@ -48,8 +58,12 @@ class Log(object):
         @param meta: meta data about what items are stored in this Log.  Type will be
         determined by subclasses.
 
-        @param db: database containing url/content hash keys and attribute present values
-        @type db: L{anydbm} database
+        @param dbpath: file of the storage containing url/content hash keys and attribute
+                       present values
+        @type dbpath: C{str}
+
+        @param storetype: storage backend of a new log, instead of the class's L{storetype}
+        @type storetype: C{str}
         """
         self.maxcapacity = maxcapacity
         self.meta = meta
@@ -58,9 +72,9 @@ class Log(object):
         self.metadata_keys = ['maxcapacity', 'meta', 'urlcount']
         if not path.isdir(dbdir):
             os.makedirs(dbdir)
-        self.db = anydbm.open(self.dbpath, 'c')
-        if 'hits' in self.db:
-            self.hits = self.db['hits']
+        self.db = openstore(self.dbpath, storetype or self.storetype)
+        if self.db.hasmeta('hits'):
+            self.hits = self.db.getmeta('hits')
         self.urlcount = 0
         # Save metadata after setting it.
         self.saved = False
@@ -75,9 +89,12 @@ class Log(object):
         present = True
         if not urlobject:
             return None
-        for key in [urlobject.url, urlobject.contenthash]:
-            if key in self.db:
-                (confident, present) = (True, self.bool_string_map[self.db[key]])
+        for key in [urlobject.rawurl, urlobject.rawcontenthash]:
+            if not key:
+                continue
+            value = self.db.lookup(key)
+            if value is not None:
+                (confident, present) = (True, self.bool_string_map[value])
             if confident:
                 break
         return Present(confident, present) if confident else None
@@ -95,10 +112,10 @@ class Log(object):
             raise ContainerFullError
 
         self.saved = False
-        for key in [urlobject.url, urlobject.contenthash]:
+        for key in [urlobject.rawurl, urlobject.rawcontenthash]:
             if not key:
                 continue
-            self.db[key] = '1' if present.ispresent else '0'
+            self.db.put(key, '1' if present.ispresent else '0')
             added = True
         if added:
             self.urlcount += 1
@@ -114,11 +131,7 @@ class Log(object):
             self.saved = True
 
     def close(self):
-        try:
-            if self.db:
-                self.db.close()
-        except anydbm.error:
-            pass
+        self.db.close()
 
     @classmethod
     def _ignore_microseconds(cls, dtstring):
@@ -128,10 +141,10 @@ class Log(object):
         return dtstring
 
     def _set_metadata(self):
-        self.db['meta'] = '%s' % self.meta
-        self.db['urlcount'] = '%s' % self.urlcount
+        self.db.setmeta('meta', '%s' % self.meta)
+        self.db.setmeta('urlcount', '%s' % self.urlcount)
         if hasattr(self, 'hits'):
-            self.db['hits'] = '%s' % self.hits
+            self.db.setmeta('hits', '%s' % self.hits)
         self.saved = False
 
     def set_metadata(self, maxcapacity=None, meta=None):
@@ -146,9 +159,10 @@ class Log(object):
     @classmethod
     def load(cls, filepath):
         try:
-            db = anydbm.open(filepath, 'c')
-        except anydbm.error, e:
+            db = openstore(filepath, cls.storetype)
+        except Exception, e:
             Log.logger.log(e)
+            raise
 
         now = datetime.utcnow()
         now = datetime(now.year, now.month, now.day, now.hour, now.minute, now.second, tzinfo=None)
@@ -160,14 +174,13 @@ class Log(object):
         defaults = {'maxcapacity': maxcapacity, 'meta': '', 'urlcount': 0}
 
         for k in defaults:
-            if k in db:
-                defaults[k] = db[k]
+            defaults[k] = db.getmeta(k, defaults[k])
         db.close()
         # Make sure types are as expected.
         defaults['maxcapacity'] = int(defaults['maxcapacity'])
         defaults['urlcount'] = int(defaults['urlcount'])
         defaults['meta'] = str(defaults['meta'])
-        log = cls(defaults['maxcapacity'], meta, filepath)
+        log = cls(defaults['maxcapacity'], defaults['meta'], filepath)
         log.urlcount = defaults['urlcount']
         return log
 
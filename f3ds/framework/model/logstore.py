@@ -0,0 +1,360 @@
+#!/usr/bin/python
+"""
+Storage backends for logs.
+
+A log keeps two kinds of entries: records, which map a raw url hash or content hash (see
+L{f3ds.framework.util.UrlObject}) to a one character value, and metadata, which maps a name
+to a string.  L{DbmLogStore} is the default backend, which every peer reads; L{SegmentLogStore}
+is faster to save and search, but peers running versions from before it cannot read it.
+
+The segment store is a single append-only file:
+
+    header:      magic, format version, key width                (C{SegmentLogStore.header})
+    blocks:      kind and payload length, then the payload, repeated (C{SegmentLogStore.block})
+
+A segment block holds the records of one save, sorted by key, each a fixed width raw hash
+followed by its value.  A metadata block holds every metadata entry; the last one wins.
+Lookups binary search the mapped segments, newest first, after narrowing the search with a
+sparse in-memory index of every C{stride}th key.
+"""
+
+# Python standard libraries
+import anydbm
+import mmap
+import os
+import struct
+
+from bisect import bisect_right
+from os import path
+from whichdb import whichdb
+
+# 3rd party modules
+
+# Our modules
+from f3ds.framework.sethash import hasher
+
+MAGIC = 'F3DL'
+VERSION = 1
+
+SEGMENT = 1
+METADATA = 2
+
+
+class DbmLogStore(object):
+    """
+    Log storage in whichever C{anydbm} module is installed, with records and metadata
+    sharing one key space.  This is how logs were stored before L{SegmentLogStore}, with
+    hex record keys.
+    """
+
+    def __init__(self, filepath):
+        self.db = anydbm.open(filepath, 'c')
+
+    @classmethod
+    def ismine(cls, filepath):
+        """
+        Whether C{filepath} is a database of one of the C{anydbm} modules.
+        """
+        return bool(whichdb(filepath))
+
+    def lookup(self, key):
+        key = key.encode('hex')
+        if key in self.db:
+            return self.db[key]
+        return None
+
+    def put(self, key, value):
+        self.db[key.encode('hex')] = value
+
+    def hasmeta(self, name):
+        return name in self.db
+
+    def getmeta(self, name, default=None):
+        if name in self.db:
+            return self.db[name]
+        return default
+
+    def setmeta(self, name, value):
+        self.db[name] = value
+
+    def sync(self):
+        self.db.sync()
+
+    def close(self):
+        try:
+            if self.db:
+                self.db.close()
+        except anydbm.error:
+            pass
+
+
+class SegmentLogStore(object):
+    """
+    Append-only log storage of immutable sorted segments.
+
+    Records put since the last L{sync} wait in an in-memory write buffer; L{sync} appends
+    them to the file as one sorted segment, so a save is a single sequential write whatever
+    the size of the log.  Once there are more than C{max_segments} segments, they are merged
+    into one and the file is rewritten.
+
+    @ivar buffer: records not yet written, by raw key
+    @type buffer: C{dict}
+
+    @ivar meta: metadata entries
+    @type meta: C{dict}
+
+    @ivar segments: C{(start, count, fences)} of each segment in the file, oldest first;
+                    C{fences} holds every C{stride}th key of the segment
+    @type segments: C{list}
+    """
+    # Packing is for str: MAGIC
+    #                int: VERSION
+    #                int: width in bytes of the keys
+    header = struct.Struct('<4sHH')
+    # Packing is for int: SEGMENT or METADATA
+    #                int: length in bytes of the payload
+    block = struct.Struct('<BI')
+    # Packing is for int: length of a metadata name
+    #                int: length of its value
+    entry = struct.Struct('<HI')
+    keywidth = hasher().digest_size
+    stride = 32
+    max_segments = 8
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.buffer = {}
+        self.meta = {}
+        self.metachanged = False
+        self.segments = []
+        self.mapping = None
+        if not path.isfile(filepath) or not path.getsize(filepath):
+            with open(filepath, 'wb') as f:
+                f.write(self.header.pack(MAGIC, VERSION, self.keywidth))
+        self._read()
+
+    @classmethod
+    def ismine(cls, filepath):
+        """
+        Whether C{filepath} is a segment store.
+        """
+        try:
+            with open(filepath, 'rb') as f:
+                return f.read(len(MAGIC)) == MAGIC
+        except IOError:
+            return False
+
+    @property
+    def recordsize(self):
+        return self.keywidth + 1
+
+    def _read(self):
+        """
+        Read the block headers and metadata of the file, and map it.  A block cut short, as
+        by a crash during L{sync}, ends the file; the next L{sync} writes over it.
+        """
+        with open(self.filepath, 'rb') as f:
+            data = f.read(self.header.size)
+            try:
+                magic, version, keywidth = self.header.unpack(data)
+            except struct.error:
+                raise ValueError('truncated log header in %s' % self.filepath)
+            if magic != MAGIC or version > VERSION:
+                msg = 'unsupported log format %r version %r in %s'
+                raise ValueError(msg % (magic, version, self.filepath))
+            self.keywidth = keywidth
+            size = os.fstat(f.fileno()).st_size
+            self.end = position = self.header.size
+            locations = []
+            while position + self.block.size <= size:
+                kind, length = self.block.unpack(f.read(self.block.size))
+                start = position + self.block.size
+                if start + length > size:
+                    break
+                if kind == SEGMENT:
+                    locations.append((start, length // self.recordsize))
+                    f.seek(length, os.SEEK_CUR)
+                elif kind == METADATA:
+                    self.meta = self._unpackmeta(f.read(length))
+                else:
+                    f.seek(length, os.SEEK_CUR)
+                position = self.end = start + length
+        self._map()
+        self.segments = [self._segment(start, count) for start, count in locations]
+
+    def _map(self):
+        if self.mapping is not None:
+            self.mapping.close()
+        with open(self.filepath, 'rb') as f:
+            self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _segment(self, start, count):
+        mapping = self.mapping
+        size = self.recordsize
+        width = self.keywidth
+        fences = [mapping[start + i * size:start + i * size + width]
+                  for i in xrange(0, count, self.stride)]
+        return (start, count, fences)
+
+    def _search(self, segment, key):
+        start, count, fences = segment
+        block = bisect_right(fences, key) - 1
+        if block < 0:
+            return None
+        mapping = self.mapping
+        size = self.recordsize
+        width = self.keywidth
+        lo = block * self.stride
+        hi = min(lo + self.stride, count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = start + mid * size
+            found = mapping[offset:offset + width]
+            if found < key:
+                lo = mid + 1
+            elif found > key:
+                hi = mid
+            else:
+                return mapping[offset + width]
+        return None
+
+    def rawkey(self, key):
+        """
+        The fixed width form of C{key}: C{key} itself when it is a digest of the key width,
+        as it is unless the hash algorithm was changed, or else a hash of C{key}.
+        """
+        if len(key) != self.keywidth:
+            key = hasher(key).digest()[:self.keywidth]
+        return key
+
+    def lookup(self, key):
+        key = self.rawkey(key)
+        try:
+            return self.buffer[key]
+        except KeyError:
+            pass
+        for segment in reversed(self.segments):
+            value = self._search(segment, key)
+            if value is not None:
+                return value
+        return None
+
+    def put(self, key, value):
+        self.buffer[self.rawkey(key)] = value[:1]
+
+    def hasmeta(self, name):
+        return name in self.meta
+
+    def getmeta(self, name, default=None):
+        return self.meta.get(name, default)
+
+    def setmeta(self, name, value):
+        value = '%s' % value
+        if self.meta.get(name) != value:
+            self.meta[name] = value
+            self.metachanged = True
+
+    def _packmeta(self):
+        parts = []
+        for name, value in sorted(self.meta.items()):
+            parts.append(self.entry.pack(len(name), len(value)))
+            parts.append(name)
+            parts.append(value)
+        return ''.join(parts)
+
+    def _unpackmeta(self, data):
+        meta = {}
+        position = 0
+        while position < len(data):
+            namelength, valuelength = self.entry.unpack_from(data, position)
+            position += self.entry.size
+            name = data[position:position + namelength]
+            position += namelength
+            meta[name] = data[position:position + valuelength]
+            position += valuelength
+        return meta
+
+    def _writeblock(self, f, kind, payload):
+        f.write(self.block.pack(kind, len(payload)))
+        f.write(payload)
+
+    def sync(self):
+        """
+        Append the write buffer as a new segment, and the metadata if it changed.
+        """
+        if not self.buffer and not self.metachanged:
+            return
+        records = ''.join([key + self.buffer[key] for key in sorted(self.buffer)])
+        with open(self.filepath, 'r+b') as f:
+            f.seek(self.end)
+            f.truncate()
+            if records:
+                self._writeblock(f, SEGMENT, records)
+                start = self.end + self.block.size
+            if self.metachanged:
+                self._writeblock(f, METADATA, self._packmeta())
+            self.end = f.tell()
+        self._map()
+        if records:
+            self.segments.append(self._segment(start, len(self.buffer)))
+        self.buffer = {}
+        self.metachanged = False
+        if len(self.segments) > self.max_segments:
+            self.compact()
+
+    def compact(self):
+        """
+        Merge every segment into one and rewrite the file with only the current metadata.
+        """
+        merged = {}
+        size = self.recordsize
+        width = self.keywidth
+        for start, count, fences in self.segments:
+            data = self.mapping[start:start + count * size]
+            for offset in xrange(0, len(data), size):
+                merged[data[offset:offset + width]] = data[offset + width]
+        merged.update(self.buffer)
+        records = ''.join([key + merged[key] for key in sorted(merged)])
+        temppath = self.filepath + '.compact'
+        with open(temppath, 'wb') as f:
+            f.write(self.header.pack(MAGIC, VERSION, self.keywidth))
+            if records:
+                self._writeblock(f, SEGMENT, records)
+            self._writeblock(f, METADATA, self._packmeta())
+        self.mapping.close()
+        self.mapping = None
+        if os.name == 'nt':
+            os.remove(self.filepath)
+        os.rename(temppath, self.filepath)
+        self.buffer = {}
+        self.metachanged = False
+        self._read()
+
+    def close(self):
+        """
+        Write out anything buffered and release the mapping.
+        """
+        if self.mapping is not None:
+            self.sync()
+            self.mapping.close()
+            self.mapping = None
+
+
+# Log storage backends by name.  Opening a log picks whichever backend recognises the file,
+# so that a new default does not stop older logs from loading.
+stores = {'segment': SegmentLogStore,
+          'dbm': DbmLogStore}
+
+
+def openstore(filepath, default='dbm'):
+    """
+    Open the log storage at C{filepath} with the backend that wrote it, or create it with
+    the C{default} backend.
+
+    @param default: name of the backend in L{stores} for new logs
+    @type default: C{str}
+    """
+    for store in stores.values():
+        if store.ismine(filepath):
+            return store(filepath)
+    return stores[default](filepath)
@@ -0,0 +1,719 @@
+#!/usr/bin/python
+"""
+Memory-mapped digest filters.
+
+A digest written in the mapped format stores its filters as plain bytes behind a small
+table, so that loading it only parses the table and maps the file; the filter bytes are
+probed directly from the mapping and the OS page cache decides what stays resident.
+A digest may also be opened on disk (see L{FileMapping}), reading each probed byte from the
+file, for digests kept searchable at next to no memory cost.
+
+A digest's filter comes from one of several backends, named in L{backends}: the stacked
+bloom filters of a C{ScalableBloomFilter} (L{MappedBloomFilter}), or a filter sized once for
+the digest's capacity (L{BlockedBloomFilter}, L{CuckooFilter}).
+
+Layout, following the digest's own header (see L{Digest.transformer}):
+
+    marker:      magic, format version, number of filters       (C{StoredFilter.marker})
+    generation:  the digest's generation; format version 2 on   (C{generation_field})
+    backend:     code of the filter's backend; format version 3 on, and left out for the
+                 scalable backend, which is written as version 2  (C{backend_field})
+
+followed for the scalable backend by:
+
+    parameters:  ScalableBloomFilter scale, ratio, initial capacity and error rate
+    table:       error rate, slices, bits per slice, capacity, count and byte length,
+                 once per filter                                 (C{MappedBloomFilter.entry})
+    padding:     up to an 8 byte boundary
+    bits:        each filter's bits, little-endian bit order, back to back
+
+and for the other backends by:
+
+    parameters:  capacity, count, error rate and the backend's geometry
+                 (C{parameters} of the backend's class)
+    padding:     up to an 8 byte boundary
+    data:        the filter's bytes
+"""
+
+# Standard python modules
+import hashlib
+import math
+import mmap
+import os
+import random
+import struct
+
+# 3rd party modules
+from bitarray import bitarray
+from pybloom import BloomFilter, ScalableBloomFilter
+from pybloom.pybloom import make_hashfuncs
+
+# Our modules
+from f3ds.framework.exceptions import ContainerFullError
+
+MAGIC = 'F3DB'
+VERSION = 3
+
+
+class FileMapping(object):
+    """
+    Stands in for a read-only mapping of a file, reading what is asked for from the file
+    instead, so that none of the file is held in memory.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.size = os.fstat(f.fileno()).st_size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.size)
+            length = max(stop - start, 0)
+        else:
+            if index < 0:
+                index += self.size
+            if not 0 <= index < self.size:
+                raise IndexError('file mapping index out of range')
+            start, length = index, 1
+        self.f.seek(start)
+        return self.f.read(length)
+
+    def close(self):
+        self.f.close()
+
+
+class MappedFilter(object):
+    """
+    One bloom filter of a L{MappedBloomFilter}, probed in place.
+
+    @ivar num_slices: number of hash functions, each with its own slice of bits
+    @type num_slices: C{int}
+
+    @ivar bits_per_slice: number of bits in each slice
+    @type bits_per_slice: C{int}
+
+    @ivar start: offset of this filter's bits in the mapping
+    @type start: C{int}
+    """
+
+    def __init__(self, mapping, start, error_rate, num_slices, bits_per_slice, capacity,
+                 count, nbytes):
+        self.mapping = mapping
+        self.start = start
+        self.error_rate = error_rate
+        self.num_slices = num_slices
+        self.bits_per_slice = bits_per_slice
+        self.capacity = capacity
+        self.count = count
+        self.nbytes = nbytes
+        self.num_bits = num_slices * bits_per_slice
+        self.make_hashes = make_hashfuncs(num_slices, bits_per_slice)
+
+    def __contains__(self, key):
+        mapping = self.mapping
+        start = self.start
+        offset = 0
+        for k in self.make_hashes(key):
+            position = offset + k
+            if not ord(mapping[start + (position >> 3)]) & (1 << (position & 7)):
+                return False
+            offset += self.bits_per_slice
+        return True
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def bitarray(self):
+        """
+        A copy of this filter's bits.  Reads the whole filter, so only use it when every bit
+        is needed anyway.
+        """
+        bits = bitarray(endian='little')
+        bits.frombytes(self.mapping[self.start:self.start + self.nbytes])
+        return bits
+
+    def thaw(self):
+        """
+        Copy this filter into an ordinary, writable C{BloomFilter}.
+        """
+        bloom = BloomFilter(1)  # Bogus instantiation, we will _setup.
+        bloom._setup(self.error_rate, self.num_slices, self.bits_per_slice, self.capacity,
+                     self.count)
+        bloom.bitarray = self.bitarray
+        return bloom
+
+
+def _map(filename, ondisk=False):
+    """
+    A read-only mapping of C{filename}, or a L{FileMapping} of it when C{ondisk}.
+    """
+    if ondisk:
+        return FileMapping(open(filename, 'rb'))
+    with open(filename, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _hashes(key):
+    """
+    Two independent 64 bit hashes of C{key}.
+    """
+    return struct.unpack('<QQ', hashlib.md5(key).digest())
+
+
+class StoredFilter(object):
+    """
+    What the filters of every backend have in common once opened from a digest file by
+    L{openfilter}.
+
+    @ivar mapping: the mapping the filter is probed from, or C{None} once closed
+    @type mapping: C{mmap.mmap} or L{FileMapping}
+
+    @ivar generation: the generation of the digest this filter was saved with; C{0} for files
+                      written before the format had one
+    @type generation: C{int}
+
+    @ivar filename: the file the filter was opened from
+    @type filename: C{str}
+
+    @ivar offset: where the filter starts in L{filename}
+    @type offset: C{int}
+
+    @cvar name: name of the backend, as given to L{newfilter}
+    @cvar code: code of the backend, as written in the file
+    @cvar version: format version the backend is written with
+    """
+    # Packing is for str: MAGIC
+    #                int: VERSION
+    #                int: number of filters
+    marker = struct.Struct('<4sHH')
+    # Packing is for int: generation
+    generation_field = struct.Struct('<Q')
+    # Packing is for int: code of the backend
+    backend_field = struct.Struct('<H')
+    alignment = 8
+    name = None
+    code = None
+    version = VERSION
+
+    mapping = None
+    generation = 0
+    filename = None
+    offset = 0
+
+    @property
+    def ondisk(self):
+        """
+        Whether the filter is probed from the file rather than from a mapping of it.
+        """
+        return isinstance(self.mapping, FileMapping)
+
+    @classmethod
+    def ismapped(cls, f):
+        """
+        Whether the data at the current position of C{f} is in the mapped format.  Leaves the
+        position of C{f} where it was.
+        """
+        position = f.tell()
+        data = f.read(cls.marker.size)
+        f.seek(position)
+        return len(data) == cls.marker.size and data[:len(MAGIC)] == MAGIC
+
+    @classmethod
+    def _align(cls, position):
+        return position + (-position % cls.alignment)
+
+    @classmethod
+    def _writemarker(cls, f, nfilters, generation):
+        f.write(cls.marker.pack(MAGIC, cls.version, nfilters))
+        f.write(cls.generation_field.pack(generation))
+        if cls.version >= 3:
+            f.write(cls.backend_field.pack(cls.code))
+
+    def reopen(self, ondisk=False):
+        """
+        This filter opened again from its file, on disk or mapped; see L{openfilter}.  This
+        filter is left open.
+        """
+        return openfilter(self.filename, self.offset, ondisk)
+
+    def close(self):
+        """
+        Release the mapping.  The filter can not be probed afterwards.
+        """
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
+
+
+class MappedBloomFilter(StoredFilter):
+    """
+    Read-only stand-in for a C{ScalableBloomFilter}, probed straight from a memory mapped
+    digest file.
+
+    @ivar filters: the stacked filters, oldest first
+    @type filters: C{list} of L{MappedFilter}
+    """
+    name = 'scalable'
+    code = 0
+    # Written without the backend field, so that peers which do not know it can read it.
+    version = 2
+    # Packing is ScalableBloomFilter.FILE_FMT: scale, ratio, initial_capacity, error_rate
+    parameters = struct.Struct(ScalableBloomFilter.FILE_FMT)
+    # Packing is BloomFilter.FILE_FMT: error_rate, num_slices, bits_per_slice, capacity, count
+    #            followed by int: length in bytes of the filter's bits
+    entry = struct.Struct(BloomFilter.FILE_FMT + 'Q')
+
+    def __init__(self, mapping, filters, scale, ratio, initial_capacity, error_rate,
+                 generation=0):
+        self.mapping = mapping
+        self.filters = filters
+        self.generation = generation
+        self.scale = scale
+        self.ratio = ratio
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+
+    def __contains__(self, key):
+        for f in reversed(self.filters):
+            if key in f:
+                return True
+        return False
+
+    def __len__(self):
+        return sum([f.count for f in self.filters])
+
+    @property
+    def capacity(self):
+        return sum([f.capacity for f in self.filters])
+
+    @classmethod
+    def frommapping(cls, mapping, position, nfilters, generation, filename):
+        """
+        The filter whose parameters start at C{position} of C{mapping}; see L{openfilter}.
+        Only the filter table is read.
+        """
+        end = position + cls.parameters.size
+        parameters = cls.parameters.unpack(mapping[position:end])
+        entries = []
+        for i in xrange(nfilters):
+            start, end = end, end + cls.entry.size
+            entries.append(cls.entry.unpack(mapping[start:end]))
+        start = cls._align(end)
+        filters = []
+        for entry in entries:
+            nbytes = entry[-1]
+            if start + nbytes > len(mapping):
+                raise ValueError('truncated digest filter in %s' % filename)
+            filters.append(MappedFilter(mapping, start, *entry))
+            start += nbytes
+        return cls(mapping, filters, *parameters, generation=generation)
+
+    @classmethod
+    def write(cls, f, source, generation=0):
+        """
+        Write C{source} to the seekable file-like object C{f} in the mapped format.
+
+        @param source: the filter to write
+        @type source: C{ScalableBloomFilter} or L{MappedBloomFilter}
+
+        @param generation: the generation of the digest being written
+        @type generation: C{int}
+        """
+        filters = source.filters
+        cls._writemarker(f, len(filters), generation)
+        f.write(cls.parameters.pack(source.scale, source.ratio, source.initial_capacity,
+                                    source.error_rate))
+        data = [bloom.bitarray.tobytes() for bloom in filters]
+        for bloom, bits in zip(filters, data):
+            f.write(cls.entry.pack(bloom.error_rate, bloom.num_slices, bloom.bits_per_slice,
+                                   bloom.capacity, bloom.count, len(bits)))
+        position = f.tell()
+        f.write('\0' * (cls._align(position) - position))
+        for bits in data:
+            f.write(bits)
+
+    def tofile(self, f):
+        """
+        Write this filter to C{f} in C{ScalableBloomFilter}'s own format.
+        """
+        self.thaw().tofile(f)
+
+    def thaw(self):
+        """
+        Copy this filter into an ordinary, writable C{ScalableBloomFilter}.
+        """
+        scalable = ScalableBloomFilter()
+        scalable._setup(self.scale, self.ratio, self.initial_capacity, self.error_rate)
+        scalable.filters = [f.thaw() for f in self.filters]
+        return scalable
+
+
+class FixedFilter(StoredFilter):
+    """
+    A filter sized once for the number of keys it is to hold, kept in one run of bytes: a
+    writable C{bytearray} when made in memory, or the read-only mapping of the file it was
+    opened from, which L{thaw} copies into memory.
+
+    @ivar data: the bytes holding the filter, from C{start} on
+    @type data: C{bytearray}, C{mmap.mmap} or L{FileMapping}
+
+    @ivar capacity: number of keys the filter was sized for
+    @type capacity: C{int}
+
+    @ivar count: number of keys added
+    @type count: C{int}
+
+    @ivar geometry: the backend's own parameters, as written after the common ones
+    @type geometry: C{tuple}
+
+    @ivar nbytes: length of the filter's bytes
+    @type nbytes: C{int}
+    """
+    # Packing is for int: capacity
+    #                int: count
+    #              float: error rate
+    #            followed by the backend's geometry
+    parameters = None
+
+    def __init__(self, data, start, capacity, count, error_rate, geometry, nbytes):
+        self.data = data
+        self.start = start
+        self.capacity = capacity
+        self.count = count
+        self.error_rate = error_rate
+        self.geometry = geometry
+        self.nbytes = nbytes
+
+    def __len__(self):
+        return self.count
+
+    def _read(self, position, length):
+        start = self.start + position
+        return self.data[start:start + length]
+
+    def thaw(self):
+        """
+        Copy this filter into a writable one in memory.
+        """
+        return type(self)(bytearray(self._read(0, self.nbytes)), 0, self.capacity, self.count,
+                          self.error_rate, *self.geometry)
+
+    @classmethod
+    def frommapping(cls, mapping, position, nfilters, generation, filename):
+        """
+        The filter whose parameters start at C{position} of C{mapping}; see L{openfilter}.
+        """
+        end = position + cls.parameters.size
+        fixed = cls(mapping, cls._align(end), *cls.parameters.unpack(mapping[position:end]))
+        if fixed.start + fixed.nbytes > len(mapping):
+            raise ValueError('truncated digest filter in %s' % filename)
+        fixed.mapping = mapping
+        fixed.generation = generation
+        return fixed
+
+    @classmethod
+    def write(cls, f, source, generation=0):
+        """
+        Write C{source} to the seekable file-like object C{f} in the mapped format.
+        """
+        cls._writemarker(f, 1, generation)
+        f.write(cls.parameters.pack(source.capacity, source.count, source.error_rate,
+                                    *source.geometry))
+        position = f.tell()
+        f.write('\0' * (cls._align(position) - position))
+        f.write(str(source._read(0, source.nbytes)))
+
+
+class BlockedBloomFilter(FixedFilter):
+    """
+    A bloom filter whose keys set all their bits within one block of L{blockbits} bits, so
+    that a probe reads one block, a cache line, instead of bits from all over the filter.
+    Blocks fill unevenly, so the filter is made a L{slack} larger than a plain bloom filter
+    of the same error rate.
+
+    @ivar nblocks: number of blocks
+    @type nblocks: C{int}
+
+    @ivar nhashes: number of bits each key sets
+    @type nhashes: C{int}
+    """
+    name = 'blocked'
+    code = 1
+    # Packing is for int: capacity
+    #                int: count
+    #              float: error rate
+    #                int: number of blocks
+    #                int: number of bits set per key
+    parameters = struct.Struct('<QQdQH')
+    blockbits = 512
+    # Packing is for the block's bits as little-endian words
+    block = struct.Struct('<8Q')
+    slack = 1.5
+
+    def __init__(self, data, start, capacity, count, error_rate, nblocks, nhashes):
+        if not nblocks > 0 or not 0 < nhashes <= self.blockbits:
+            raise ValueError('bad blocked bloom filter of %r blocks, %r hashes' %
+                             (nblocks, nhashes))
+        FixedFilter.__init__(self, data, start, capacity, count, error_rate,
+                             (nblocks, nhashes), nblocks * self.block.size)
+        self.nblocks = nblocks
+        self.nhashes = nhashes
+
+    @classmethod
+    def create(cls, capacity, error_rate):
+        """
+        An empty filter for C{capacity} keys.
+        """
+        capacity = max(capacity, 1)
+        nhashes = max(1, min(16, int(round(-math.log(error_rate, 2)))))
+        bits = cls.slack * capacity * -math.log(error_rate) / math.log(2) ** 2
+        nblocks = max(1, int(math.ceil(bits / cls.blockbits)))
+        return cls(bytearray(nblocks * cls.block.size), 0, capacity, 0, error_rate, nblocks,
+                   nhashes)
+
+    def _positions(self, key):
+        """
+        Where the block for C{key} starts, and the bits it sets in the block.
+        """
+        a, b = _hashes(key)
+        step = (b >> 32) | 1
+        mask = self.blockbits - 1
+        return ((a % self.nblocks) * self.block.size,
+                [(b + i * step) & mask for i in xrange(self.nhashes)])
+
+    def __contains__(self, key):
+        start, positions = self._positions(key)
+        words = self.block.unpack(self._read(start, self.block.size))
+        for position in positions:
+            if not words[position >> 6] >> (position & 63) & 1:
+                return False
+        return True
+
+    def add(self, key):
+        """
+        Add C{key}.  Only a filter in memory can be added to.
+
+        @return: True if the key was already present
+        @rtype: C{bool}
+        """
+        start, positions = self._positions(key)
+        data = self.data
+        start += self.start
+        present = True
+        for position in positions:
+            i = start + (position >> 3)
+            bit = 1 << (position & 7)
+            if not data[i] & bit:
+                data[i] |= bit
+                present = False
+        if not present:
+            self.count += 1
+        return present
+
+
+class CuckooFilter(FixedFilter):
+    """
+    A cuckoo filter: each key leaves a short fingerprint in one of two buckets of L{slots}
+    entries, and a probe compares the key's fingerprint with those two buckets only.  Holds
+    keys in fewer bits than a bloom filter at low error rates.  Keys are moved to their
+    other bucket to make room for more, which works until about L{load} of the entries are
+    taken.
+
+    @ivar nbuckets: number of buckets, a power of two
+    @type nbuckets: C{int}
+
+    @ivar fpbytes: bytes in a fingerprint
+    @type fpbytes: C{int}
+    """
+    name = 'cuckoo'
+    code = 2
+    # Packing is for int: capacity
+    #                int: count
+    #              float: error rate
+    #                int: number of buckets
+    #                int: bytes per fingerprint
+    parameters = struct.Struct('<QQdQB')
+    slots = 4
+    load = 0.9
+    maxkicks = 500
+    formats = {1: 'B', 2: 'H', 4: 'I'}
+
+    def __init__(self, data, start, capacity, count, error_rate, nbuckets, fpbytes):
+        if not nbuckets > 0 or nbuckets & (nbuckets - 1) or fpbytes not in self.formats:
+            raise ValueError('bad cuckoo filter of %r buckets, %r byte fingerprints' %
+                             (nbuckets, fpbytes))
+        self.bucket = struct.Struct('<%d%s' % (self.slots, self.formats[fpbytes]))
+        FixedFilter.__init__(self, data, start, capacity, count, error_rate,
+                             (nbuckets, fpbytes), nbuckets * self.bucket.size)
+        self.nbuckets = nbuckets
+        self.fpbytes = fpbytes
+        self.mask = (1 << (8 * fpbytes)) - 1
+
+    @classmethod
+    def create(cls, capacity, error_rate):
+        """
+        An empty filter for C{capacity} keys, with fingerprints long enough that the
+        C{2 * slots} compared by a probe match by chance less often than C{error_rate}.
+        """
+        for fpbytes in sorted(cls.formats):
+            if 2.0 * cls.slots / 2 ** (8 * fpbytes) <= error_rate:
+                break
+        nbuckets = 1
+        while nbuckets * cls.slots * cls.load < capacity:
+            nbuckets *= 2
+        return cls(bytearray(nbuckets * cls.slots * fpbytes), 0, capacity, 0, error_rate,
+                   nbuckets, fpbytes)
+
+    def _locate(self, key):
+        """
+        The fingerprint of C{key}, never 0, which marks an empty entry, and its first bucket.
+        """
+        a, b = _hashes(key)
+        return (b & self.mask) or 1, a & (self.nbuckets - 1)
+
+    def _other(self, index, fingerprint):
+        """
+        The other bucket of a fingerprint in bucket C{index}, and so back again.
+        """
+        return (index ^ (fingerprint * 0x5bd1e995)) & (self.nbuckets - 1)
+
+    def _entries(self, index):
+        size = self.bucket.size
+        return self.bucket.unpack(self._read(index * size, size))
+
+    def _store(self, index, entries):
+        self.bucket.pack_into(self.data, self.start + index * self.bucket.size, *entries)
+
+    def _place(self, index, fingerprint):
+        entries = list(self._entries(index))
+        if 0 not in entries:
+            return False
+        entries[entries.index(0)] = fingerprint
+        self._store(index, entries)
+        return True
+
+    def __contains__(self, key):
+        fingerprint, index = self._locate(key)
+        return (fingerprint in self._entries(index) or
+                fingerprint in self._entries(self._other(index, fingerprint)))
+
+    def add(self, key):
+        """
+        Add C{key}.  Only a filter in memory can be added to.
+
+        @return: True if the key was already present
+        @rtype: C{bool}
+
+        @raise ContainerFullError: if no room could be made for the key; the filter is left
+                                   as it was
+        """
+        if key in self:
+            return True
+        fingerprint, index = self._locate(key)
+        other = self._other(index, fingerprint)
+        if not self._place(index, fingerprint) and not self._place(other, fingerprint):
+            self._kick(random.choice((index, other)), fingerprint)
+        self.count += 1
+        return False
+
+    def _kick(self, index, fingerprint):
+        """
+        Put C{fingerprint} in the full bucket C{index}, moving the fingerprint it replaces
+        to its other bucket, and so on until one lands in a bucket with room.
+        """
+        moved = []
+        for i in xrange(self.maxkicks):
+            entries = list(self._entries(index))
+            slot = random.randrange(self.slots)
+            entries[slot], fingerprint = fingerprint, entries[slot]
+            self._store(index, entries)
+            moved.append((index, slot, fingerprint))
+            index = self._other(index, fingerprint)
+            if self._place(index, fingerprint):
+                return
+        for index, slot, fingerprint in reversed(moved):
+            entries = list(self._entries(index))
+            entries[slot] = fingerprint
+            self._store(index, entries)
+        raise ContainerFullError('cuckoo filter full at %d keys' % self.count)
+
+
+backends = dict((cls.name, cls) for cls in (MappedBloomFilter, BlockedBloomFilter,
+                                            CuckooFilter))
+_codes = dict((cls.code, cls) for cls in backends.values())
+
+
+def newfilter(backend, capacity, error_rate=0.001):
+    """
+    An empty, writable filter from C{backend} for C{capacity} keys.  The scalable backend
+    grows as keys are added, and makes a C{ScalableBloomFilter}.
+
+    @raise ValueError: if there is no such backend
+    """
+    if backend == MappedBloomFilter.name:
+        return ScalableBloomFilter(error_rate=error_rate)
+    try:
+        cls = backends[backend]
+    except KeyError:
+        raise ValueError('unknown digest filter backend %r' % (backend,))
+    return cls.create(capacity, error_rate)
+
+
+def openfilter(filename, offset, ondisk=False):
+    """
+    Map C{filename}, whose filter starts at C{offset}, as the backend recorded in the file.
+
+    @param ondisk: read probed bytes from the file instead of mapping it; see
+                   L{FileMapping}
+    @type ondisk: C{bool}
+
+    @rtype: L{StoredFilter}
+    @raise ValueError: if the filter is truncated, or in a format or from a backend not
+                       known here
+    """
+    mapping = _map(filename, ondisk)
+    try:
+        marker = StoredFilter.marker
+        end = offset + marker.size
+        magic, version, nfilters = marker.unpack(mapping[offset:end])
+        if magic != MAGIC or version > VERSION:
+            msg = 'unsupported digest format %r version %r in %s'
+            raise ValueError(msg % (magic, version, filename))
+        generation = 0
+        code = MappedBloomFilter.code
+        if version >= 2:
+            field = StoredFilter.generation_field
+            start, end = end, end + field.size
+            generation, = field.unpack(mapping[start:end])
+        if version >= 3:
+            field = StoredFilter.backend_field
+            start, end = end, end + field.size
+            code, = field.unpack(mapping[start:end])
+        if code not in _codes:
+            msg = 'unsupported digest filter backend %r in %s'
+            raise ValueError(msg % (code, filename))
+        stored = _codes[code].frommapping(mapping, end, nfilters, generation, filename)
+    except (ValueError, struct.error), e:
+        mapping.close()
+        raise ValueError(e)
+    stored.filename = filename
+    stored.offset = offset
+    return stored
+
+
+def writefilter(f, source, generation=0):
+    """
+    Write C{source} to the seekable file-like object C{f} in the mapped format, recording
+    its backend.
+
+    @param source: the filter to write
+    @type source: C{ScalableBloomFilter} or L{StoredFilter}
+    """
+    if isinstance(source, FixedFilter):
+        type(source).write(f, source, generation)
+    else:
+        MappedBloomFilter.write(f, source, generation)
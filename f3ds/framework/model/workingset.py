@@ -0,0 +1,166 @@
+#!/usr/bin/python
+"""
+Ranking of the foreign containers loaded for searching, and admission of more within a budget.
+"""
+
+# Standard python modules
+import heapq
+import itertools
+import math
+import time
+
+# 3rd party modules
+
+# Our modules
+
+
+class WorkingSet(object):
+    """
+    The loaded containers, each with its cost in bytes and a score of its recent hits, kept
+    in a heap so that the weakest is found without sorting them all.
+
+    A container's score is its count of hits, each weighing half as much after every
+    C{halflife} seconds.  Scores are not stored as such but as keys,
+    C{log2(score) + t / halflife} for the time C{t} they were last changed.  Decay lowers
+    every score by the same factor, so it leaves keys unchanged and their order right: the
+    heap never needs rebuilding as time passes, and a hit only pushes the container with its
+    new key, leaving its old entry to be skipped when it comes up.
+
+    @ivar budget: most bytes to load; C{0} to count containers against L{limit} instead
+    @type budget: C{int}
+
+    @ivar limit: most containers to load when there is no L{budget}
+    @type limit: C{int}
+
+    @ivar used: bytes taken by the loaded containers
+    @type used: C{int}
+    """
+    # key of a container which has never been hit
+    NEVER = float('-inf')
+
+    def __init__(self, budget=0, limit=0, halflife=3600.0, clock=time.time):
+        """
+        @param halflife: seconds for a hit to count half as much
+        @type halflife: C{float}
+
+        @param clock: returns the time in seconds
+        """
+        self.budget = budget
+        self.limit = limit
+        self.halflife = float(halflife)
+        self.clock = clock
+        self.keys = {}
+        self.costs = {}
+        self.heap = []
+        self.used = 0
+        self.order = itertools.count()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, container):
+        return container in self.keys
+
+    def __iter__(self):
+        return iter(list(self.keys))
+
+    def keyOf(self, score, now=None):
+        """
+        The key of C{score} hits at time C{now}, by default the present.
+        """
+        if score <= 0:
+            return self.NEVER
+        if now is None:
+            now = self.clock()
+        return math.log(score, 2) + now / self.halflife
+
+    def scoreOf(self, key, now=None):
+        """
+        The score at time C{now}, by default the present, of a container with C{key}.
+        """
+        if key == self.NEVER:
+            return 0.0
+        if now is None:
+            now = self.clock()
+        return 2.0 ** (key - now / self.halflife)
+
+    def bumped(self, key):
+        """
+        The key of a container with C{key} after one more hit now.
+        """
+        now = self.clock()
+        return self.keyOf(self.scoreOf(key, now) + 1, now)
+
+    def rate(self, hitrate):
+        """
+        The score of a container which has been hit C{hitrate} times a second for long, such
+        as L{ContainerMixin.usefulness}: each second's hits weigh C{2 ** (-age / halflife)},
+        which sums to C{halflife / ln 2} seconds' worth.
+        """
+        return hitrate * self.halflife / math.log(2)
+
+    def full(self, cost=0):
+        """
+        Whether loading another container costing C{cost} bytes would overrun the budget or
+        the limit.
+        """
+        if self.budget:
+            return self.used + cost > self.budget
+        return len(self.keys) + 1 > self.limit
+
+    def fits(self, cost):
+        """
+        Whether a container costing C{cost} bytes fits at all, even with nothing else loaded.
+        """
+        if self.budget:
+            return cost <= self.budget
+        return self.limit > 0
+
+    def add(self, container, cost, key=NEVER):
+        """
+        Count C{container} as loaded.  Making room for it is up to the caller; see L{full}.
+        """
+        if container in self.keys:
+            self.remove(container)
+        self.keys[container] = key
+        self.costs[container] = cost
+        self.used += cost
+        self._push(container, key)
+
+    def remove(self, container):
+        """
+        Count C{container} as no longer loaded.
+
+        @return: its key, by which it may be compared with the loaded containers again
+        """
+        key = self.keys.pop(container)
+        self.used -= self.costs.pop(container)
+        return key
+
+    def hit(self, container):
+        """
+        Count one more hit of the loaded C{container}.
+        """
+        key = self.keys[container] = self.bumped(self.keys[container])
+        self._push(container, key)
+
+    def weakest(self):
+        """
+        The loaded container with the lowest score, and its key.
+
+        @return: C{(container, key)}, or C{(None, None)} when nothing is loaded
+        """
+        heap = self.heap
+        while heap:
+            key, order, container = heap[0]
+            if self.keys.get(container) == key:
+                return container, key
+            heapq.heappop(heap)  # stale: removed, or hit since
+        return None, None
+
+    def _push(self, container, key):
+        heapq.heappush(self.heap, (key, next(self.order), container))
+        if len(self.heap) > 2 * len(self.keys) + 16:
+            # drop the stale entries left by hits and removals
+            self.heap = [entry for entry in self.heap if self.keys.get(entry[2]) == entry[0]]
+            heapq.heapify(self.heap)
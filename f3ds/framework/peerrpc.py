@@ -0,0 +1,286 @@
+#!/usr/bin/python
+"""
+Calls to peers' rpccommands over kept-alive XML-RPC connections, and the same call made to
+many peers at once.
+"""
+
+# Standard python modules
+import collections
+import threading
+import xmlrpclib
+
+# 3rd party modules
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+# Our modules
+from f3ds.framework import util
+from f3ds.framework.workers import getPool
+
+
+class ProxyPool(object):
+    """
+    Idle XML-RPC proxies by peer url, each holding its HTTP connection open between calls.
+    A proxy serves one call at a time, so calls made at once to the same peer each take
+    their own; proxies whose call failed are thrown away rather than reused.
+    """
+
+    def __init__(self):
+        self.idle = collections.defaultdict(list)
+        self.lock = threading.Lock()
+
+    def acquire(self, url, timeout):
+        with self.lock:
+            idle = self.idle[url, timeout]
+            if idle:
+                return idle.pop()
+        transport = util.TimeoutedTransport()
+        transport.set_timeout(timeout)
+        return xmlrpclib.ServerProxy(url, allow_none=True, transport=transport)
+
+    def release(self, url, timeout, proxy):
+        with self.lock:
+            self.idle[url, timeout].append(proxy)
+
+    def close(self):
+        """
+        Close the connections of all the idle proxies.
+        """
+        with self.lock:
+            idle = [proxy for proxies in self.idle.values() for proxy in proxies]
+            self.idle.clear()
+        for proxy in idle:
+            proxy("close")()
+
+    def call(self, url, timeout, method, *args):
+        """
+        Call C{method} of the rpccommands at C{url}.  Blocks until the peer answers.
+        """
+        proxy = self.acquire(url, timeout)
+        try:
+            result = getattr(proxy, method)(*args)
+        except:
+            proxy("close")()
+            raise
+        self.release(url, timeout, proxy)
+        return result
+
+pool = ProxyPool()
+
+
+class PooledProxy(object):
+    """
+    Stands in for C{xmlrpclib.ServerProxy}: C{proxy.method(*args)} calls the peer at
+    C{url} through L{pool}.  Holds nothing but the url and timeout, so it may be used from
+    any thread.
+    """
+
+    def __init__(self, url, timeout):
+        self.url = url
+        self.timeout = timeout
+
+    def __getattr__(self, method):
+        def call(*args):
+            return pool.call(self.url, self.timeout, method, *args)
+        return call
+
+    def __repr__(self):
+        return "PooledProxy(%r)" % self.url
+
+
+class _Batch(object):
+    """
+    Calls waiting to be sent to one peer together.
+    """
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.items = []
+        self.waiting = []
+        self.timer = None
+
+
+class CallBatcher(object):
+    """
+    Gathers the calls made to the same peer within C{window} seconds of each other into one
+    call of a batch method, which takes the list of the calls' arguments and answers with
+    the list of their results.  Peers without the batch method are sent the calls one by
+    one instead.
+
+    @ivar pending: the batch being gathered for each peer, by url and timeout
+    @type pending: C{dict} of L{_Batch}
+    """
+    # what twisted.web.xmlrpc answers for a method it does not have
+    NOT_FOUND = 8001
+
+    def __init__(self, method, single, args=(), window=0.05, maxsize=100, threads=8,
+                 reactor=None, workers=None):
+        """
+        @param method: name of the batch method
+        @param single: name of the method taking the arguments of one call
+        @param args: arguments given to every call before those of the call
+        @type args: C{tuple}
+        @param window: seconds to wait for more calls to the same peer
+        @param maxsize: most calls to send in one batch; a full batch is sent at once
+        @param threads: most batches in flight at once
+        @param workers: to send the batches from, instead of the shared C{'PeerRPC'} pool
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        if workers is None:
+            workers = getPool('PeerRPC', threads)
+        self.method = method
+        self.single = single
+        self.args = tuple(args)
+        self.window = window
+        self.maxsize = maxsize
+        self.reactor = reactor
+        self.workers = workers
+        self.pending = {}
+
+    def add(self, peer, *item):
+        """
+        Call the peer with the arguments C{item}, batched with the other calls to the peer.
+        Call on the reactor thread.
+
+        @return: a Deferred firing with the result of this call
+        @rtype: C{twisted.internet.defer.Deferred}
+        """
+        proxy = peer.transport
+        key = proxy.url, proxy.timeout
+        batch = self.pending.get(key)
+        if batch is None:
+            batch = self.pending[key] = _Batch(proxy)
+            batch.timer = self.reactor.callLater(self.window, self.flush, key)
+        d = defer.Deferred()
+        batch.items.append(list(item))
+        batch.waiting.append(d)
+        if len(batch.items) >= self.maxsize:
+            self.flush(key)
+        return d
+
+    def flush(self, key):
+        """
+        Send the batch gathered for the peer at C{key} now.
+        """
+        batch = self.pending.pop(key, None)
+        if batch is None:
+            return
+        if batch.timer.active():
+            batch.timer.cancel()
+        d = self.workers.run(self._send, batch.proxy, batch.items)
+        d.addBoth(self._sent, batch)
+
+    def _send(self, proxy, items):
+        """
+        Make the batch call.  Blocks; run on a worker thread.
+        """
+        try:
+            return getattr(proxy, self.method)(*(self.args + (items,)))
+        except xmlrpclib.Fault, e:
+            if e.faultCode != self.NOT_FOUND:
+                raise
+        call = getattr(proxy, self.single)
+        return [call(*(self.args + tuple(item))) for item in items]
+
+    def _sent(self, results, batch):
+        if isinstance(results, Failure):
+            for d in batch.waiting:
+                d.errback(results)
+        elif isinstance(results, list) and len(results) == len(batch.waiting):
+            for d, result in zip(batch.waiting, results):
+                d.callback(result)
+        else:
+            # an answer for the whole batch, such as "peer not known"
+            for d in batch.waiting:
+                d.callback(results)
+
+
+_batchers = {}
+
+
+def getBatcher(method, single, args=(), window=0.05, maxsize=100, threads=8):
+    """
+    The shared L{CallBatcher} for C{method}, created with the given arguments by the first
+    caller.
+    """
+    try:
+        return _batchers[method]
+    except KeyError:
+        batcher = _batchers[method] = CallBatcher(method, single, args, window, maxsize,
+                                                  threads)
+        return batcher
+
+
+def fanout(peers, method, *args, **kwargs):
+    """
+    Call C{method} with the same arguments on every peer at once; see L{fanoutCalls}, which
+    takes the same keyword arguments.
+    """
+    return fanoutCalls([(peer, args) for peer in peers], method, **kwargs)
+
+
+def fanoutCalls(calls, method, deadline=None, threads=8, reactor=None, workers=None):
+    """
+    Call C{method} on every peer at once, each from a thread of the C{'PeerRPC'}
+    L{WorkerPool}, and wait for the answers at most C{deadline} seconds.
+
+    The peers' transports are looked up on the calling thread, before anything is sent,
+    since looking at a peer may touch the database session.
+
+    @param calls: each peer to call, with the arguments to call it with
+    @type calls: C{list} of (L{BasePeer}, C{tuple})
+    @param method: name of the method to call, or a function taking the peer and the
+                   arguments which makes the call and returns a Deferred, such as
+                   L{CallBatcher.add}
+    @param deadline: seconds to wait for the slowest peer; by default as long as it takes
+    @param threads: most calls in flight at once; further calls wait their turn
+    @param reactor: to schedule the deadline on
+    @param workers: to make the calls from, instead of the shared C{'PeerRPC'} pool
+
+    @return: a Deferred firing with two C{dict}s by peer, of the results of the peers which
+             answered, and of the L{Failure}s of those which did not, a
+             C{defer.TimeoutError} for those which had not answered by the deadline
+    @rtype: C{twisted.internet.defer.Deferred}
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    if workers is None:
+        workers = getPool('PeerRPC', threads)
+    results, failures = {}, {}
+    finished = defer.Deferred()
+    outstanding = set(peer for peer, args in calls)
+    timer = []
+
+    def finish():
+        for call in timer:
+            if call.active():
+                call.cancel()
+        for peer in outstanding:
+            failures[peer] = Failure(defer.TimeoutError("no answer from %r" % (peer,)))
+        outstanding.clear()
+        finished.callback((results, failures))
+
+    def answered(result, peer):
+        if peer not in outstanding:
+            return  # too late
+        outstanding.discard(peer)
+        if isinstance(result, Failure):
+            failures[peer] = result
+        else:
+            results[peer] = result
+        if not outstanding:
+            finish()
+
+    if not calls:
+        finish()
+        return finished
+    if deadline is not None:
+        timer.append(reactor.callLater(deadline, finish))
+    if callable(method):
+        for peer, args in calls:
+            method(peer, *args).addBoth(answered, peer)
+    else:
+        proxies = [(peer, getattr(peer.transport, method), args) for peer, args in calls]
+        for peer, call, args in proxies:
+            workers.run(call, *args).addBoth(answered, peer)
+    return finished
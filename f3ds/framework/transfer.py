@@ -0,0 +1,168 @@
+#!/usr/bin/python
+"""
+Compressed transfer of container files between peers.
+
+A container is offered compressed by sharing an encoded copy of its file next to the file
+itself, at the same url with L{SUFFIX} added.  The encoding is:
+
+    header:  magic, format version, length and CRC-32 of the file   (C{HEADER})
+    body:    the file, compressed as one zlib stream
+
+Downloaders decompress the body as it arrives, straight into the container file, and check
+the length and checksum before the container is loaded.
+"""
+
+# Standard python modules
+import os
+import struct
+import tempfile
+import zlib
+
+# 3rd party modules
+
+# Our modules
+from f3ds.framework.exceptions import CorruptTransferError
+from f3ds.framework.filehash import BLOCKSIZE, FileIter
+
+MAGIC = 'F3DZ'
+VERSION = 1
+SUFFIX = '.z'
+# Packing is for str: MAGIC
+#                int: VERSION
+#                int: length of the file
+#                int: CRC-32 of the file
+HEADER = struct.Struct('<4sHQI')
+
+
+def encodedUrl(url):
+    """
+    The url of the encoded copy of the container at C{url}.
+    """
+    return url + SUFFIX
+
+
+def containerUrl(url):
+    """
+    The url of the container itself, for a url which may be that of its encoded copy.
+    """
+    if url.endswith(SUFFIX):
+        return url[:-len(SUFFIX)]
+    return url
+
+
+def isEncoded(url):
+    """
+    Whether C{url} is that of an encoded copy of a container.
+    """
+    return url.endswith(SUFFIX)
+
+
+def encode(source, dest, level=6, blocksize=BLOCKSIZE):
+    """
+    Write an encoded copy of the file C{source} to C{dest}.  The copy is written to a
+    temporary file first and renamed over C{dest}, so that a peer downloading the previous
+    copy still gets all of it.
+
+    @param level: zlib compression level
+    @type level: C{int}
+    """
+    compressor = zlib.compressobj(level)
+    checksum = 0
+    length = 0
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dest) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write(HEADER.pack(MAGIC, VERSION, 0, 0))  # rewritten once known
+            with open(source, 'rb') as f:
+                for block in FileIter(f, blocksize):
+                    checksum = zlib.crc32(block, checksum)
+                    length += len(block)
+                    out.write(compressor.compress(block))
+            out.write(compressor.flush())
+            out.seek(0)
+            out.write(HEADER.pack(MAGIC, VERSION, length, checksum & 0xffffffff))
+        os.rename(tmp, dest)
+    except:
+        os.remove(tmp)
+        raise
+
+
+class DecodingWriter(object):
+    """
+    Stands in for the file an encoded download is written to: decompresses the body as it
+    arrives and writes the file's own bytes to C{f}.
+
+    @ivar length: length of the file according to the header, once it has been read
+    @type length: C{int} or C{None}
+
+    @ivar written: bytes of the file written so far
+    @type written: C{int}
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.header = ''
+        self.length = None
+        self.checksum = None
+        self.written = 0
+        self.crc = 0
+        self.decompressor = zlib.decompressobj()
+
+    def write(self, data):
+        """
+        Take the next bytes of the download.
+
+        @raise CorruptTransferError: if they are not an encoded container, or decompress
+                                     to more than the header said
+        """
+        if self.length is None:
+            self.header += data
+            if len(self.header) < HEADER.size:
+                return
+            data = self.header[HEADER.size:]
+            magic, version, self.length, self.checksum = HEADER.unpack(
+                self.header[:HEADER.size])
+            if magic != MAGIC or version > VERSION:
+                raise CorruptTransferError('not an encoded container: %r version %r' %
+                                           (magic, version))
+        try:
+            # Never inflate more than the header promised, however the body is made.
+            self._output(self.decompressor.decompress(data, self.length - self.written + 1))
+            while self.decompressor.unconsumed_tail and self.written <= self.length:
+                tail = self.decompressor.unconsumed_tail
+                self._output(self.decompressor.decompress(tail,
+                                                          self.length - self.written + 1))
+        except zlib.error, e:
+            raise CorruptTransferError('corrupt encoded container: %s' % e)
+
+    def _output(self, data):
+        self.written += len(data)
+        if self.written > self.length:
+            raise CorruptTransferError('encoded container longer than its %d bytes' %
+                                       self.length)
+        self.crc = zlib.crc32(data, self.crc)
+        self.f.write(data)
+
+    def finish(self):
+        """
+        Check that the whole file arrived intact.  Call once the download is complete.
+
+        @raise CorruptTransferError: if the download was cut short, or the file written does
+                                     not match the length and checksum it was sent with
+        """
+        if self.length is None:
+            raise CorruptTransferError('encoded container cut short in its header')
+        try:
+            self._output(self.decompressor.flush())
+        except zlib.error, e:
+            raise CorruptTransferError('corrupt encoded container: %s' % e)
+        if self.decompressor.unused_data:
+            raise CorruptTransferError('trailing data after encoded container')
+        if self.written != self.length:
+            raise CorruptTransferError('got only %d of %d bytes of encoded container' %
+                                       (self.written, self.length))
+        if self.crc & 0xffffffff != self.checksum:
+            raise CorruptTransferError('checksum mismatch in encoded container')
+
+    def close(self):
+        self.f.close()
@@ -1,8 +1,184 @@
 #!/usr/bin/python2
 
-import urllib
+import collections
+import os
 import pickle
 import sys
+import urllib
+import urllib2
+
+# Modify the path to include the F3DS modules.
+# __file__ is <framework source>/f3ds/framework/urlretrieve.py
+pdn = os.path.dirname
+projectdir = pdn(pdn(os.path.abspath(__file__)))
+if projectdir not in sys.path:
+    sys.path.append(projectdir)
+
+from twisted.internet import defer
+from twisted.internet.protocol import Protocol
+from twisted.web.client import Agent, RedirectAgent, ResponseDone, ResponseFailed
+from twisted.web.http import PotentialDataLoss
+
+from f3ds.framework.filehash import BLOCKSIZE, FileIter
+from f3ds.framework.sethash import hasher
+
+
+class Retrieval(collections.namedtuple("Retrieval",
+                                       ["filepath", "headers", "contenthash", "filesize"])):
+    """
+    The outcome of downloading a url: where the body was written, the response headers with
+    lower case names, the hexdigest of the body and its size in bytes.
+    """
+
+
+class HashingWriter(object):
+    """
+    Writes a body to a file as it arrives, hashing it on the way, so that the hash and size
+    are known as soon as the last chunk is written.
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.f = open(filepath, 'wb')
+        self.sum = hasher()
+        self.size = 0
+
+    def write(self, data):
+        self.f.write(data)
+        self.sum.update(data)
+        self.size += len(data)
+
+    def close(self):
+        self.f.close()
+
+    def retrieval(self, headers):
+        return Retrieval(self.filepath, headers, self.sum.hexdigest(), self.size)
+
+
+def _length(headers):
+    """
+    The Content-Length in C{headers}, or C{None} if none was sent.
+    """
+    try:
+        return int(headers['content-length'])
+    except (KeyError, ValueError):
+        return None
+
+
+def _checklength(url, headers, writer):
+    length = _length(headers)
+    if length is not None and writer.size != length:
+        raise IOError('%s: got %d of %d bytes' % (url, writer.size, length))
+
+
+def retrieve(url, filepath, blocksize=BLOCKSIZE, timeout=None):
+    """
+    Download C{url} to C{filepath}, hashing the body while it is written.  Blocks until the
+    download is done.
+
+    @param timeout: seconds to wait to connect and for each read, or C{None} for the socket
+                    default
+    @rtype: L{Retrieval}
+    @raise IOError: if the url can not be opened or read, answers with other than a 2xx
+                    status, is cut short of its Content-Length, or the file can not be written
+    """
+    if timeout is None:
+        response = urllib2.urlopen(url)
+    else:
+        response = urllib2.urlopen(url, timeout=timeout)
+    try:
+        headers = dict(response.info().items())
+        writer = HashingWriter(filepath)
+        try:
+            for block in FileIter(response, blocksize):
+                writer.write(block)
+        finally:
+            writer.close()
+    finally:
+        response.close()
+    _checklength(url, headers, writer)
+    return writer.retrieval(headers)
+
+
+class _BodyWriter(Protocol):
+    """
+    Hands each chunk of a response body to a L{HashingWriter}.  A body whose end could not
+    be told from the connection closing (C{PotentialDataLoss}) only counts as whole if it
+    is as long as the Content-Length sent with it, if any.
+    """
+    def __init__(self, writer, finished, length=None):
+        self.writer = writer
+        self.finished = finished
+        self.length = length
+
+    def dataReceived(self, data):
+        self.writer.write(data)
+
+    def stop(self):
+        """
+        Stop receiving the body, such as when the download is cancelled.
+        """
+        if self.transport is not None:
+            self.transport.stopProducing()
+
+    def connectionLost(self, reason):
+        self.writer.close()
+        if self.finished.called:
+            return
+        if reason.check(PotentialDataLoss) and self.length not in (None, self.writer.size):
+            msg = 'got %d of %d bytes' % (self.writer.size, self.length)
+            self.finished.errback(ResponseFailed([reason, IOError(msg)]))
+        elif reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback(None)
+        else:
+            self.finished.errback(reason)
+
+
+def fetch(url, filepath, agent=None, timeout=None, reactor=None):
+    """
+    Download C{url} to C{filepath} on the reactor, hashing the body while it is written.
+
+    @param agent: the C{twisted.web.client.Agent} to make the request with; by default one
+                  which follows redirects
+    @param timeout: seconds to wait to connect, and for the whole download before it is
+                    cancelled; C{None} to wait as long as it takes
+    @return: a Deferred firing with a L{Retrieval}, or failing with C{IOError} when the url
+             answers with other than a 2xx status, or C{CancelledError} if it timed out
+    @rtype: C{twisted.internet.defer.Deferred}
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    if agent is None:
+        if timeout is None:
+            agent = RedirectAgent(Agent(reactor))
+        else:
+            agent = RedirectAgent(Agent(reactor, connectTimeout=timeout))
+    d = agent.request('GET', url)
+
+    def gotResponse(response):
+        if not 200 <= response.code < 300:
+            response.deliverBody(Protocol())
+            raise IOError('%s: HTTP %d %s' % (url, response.code, response.phrase))
+        headers = {}
+        for name, values in response.headers.getAllRawHeaders():
+            headers[name.lower()] = ', '.join(values)
+        writer = HashingWriter(filepath)
+        body = _BodyWriter(writer, None, _length(headers))
+        body.finished = finished = defer.Deferred(lambda ignored: body.stop())
+        response.deliverBody(body)
+        finished.addCallback(lambda ignored: writer.retrieval(headers))
+        return finished
+
+    d.addCallback(gotResponse)
+    if timeout is not None:
+        timer = reactor.callLater(timeout, d.cancel)
+
+        def done(result):
+            if timer.active():
+                timer.cancel()
+            return result
+        d.addBoth(done)
+    return d
+
 
 def urlretrieve(url, filepath):
     try:
@@ -12,4 +188,5 @@ def urlretrieve(url, filepath):
     return [filepath, headers]
 
 
-print pickle.dumps(urlretrieve(sys.argv[1], sys.argv[2]))
+if __name__ == "__main__":
+    print pickle.dumps(urlretrieve(sys.argv[1], sys.argv[2]))
@@ -8,9 +8,12 @@ __author__ = 'Jun Park, Matt Probst, Henry Longmore'
 __version__ = '0.1'
 
 import collections
+import functools
+import httplib
 import os
 import re
 import subprocess
+import time
 import xmlrpclib
 
 
@@ -26,59 +29,80 @@ def delta_seconds(td):
 
 class UrlObject(object):
     """
-    Represents a url and the file at the url.
+    Represents a url and the file at the url, by hashes of both.
 
-    @ivar url: the url to represent.
-    @type url: C{str}
+    The hashes are kept as raw digest bytes, which is the form digests and logs use as
+    keys; L{url} and L{contenthash} give the hex form for logging and RPC.  An empty hash
+    means the url or the content is unknown.
+
+    @ivar rawurl: digest of the url, or C{''}
+    @type rawurl: C{str}
+
+    @ivar rawcontenthash: digest of the content hash of the file at the url, or C{''}
+    @type rawcontenthash: C{str}
 
     @ivar filesize: the filesize in bytes of the file at the url.
     @type filesize: C{int}
 
-    @ivar hash: hexdigest of a hash of the content of the file at the url. May be C{None}.
-    @type hash: C{str} or C{None}
+    @ivar plain: kept for compatibility; the plain url is dropped once it is hashed.
+    @ivar objecthash: kept for compatibility; the content hash is dropped once it is hashed.
     """
+    __slots__ = ('rawurl', 'rawcontenthash', 'filesize', 'nonce', 'prehashed', 'plain',
+                 'objecthash', '_url', '_contenthash')
+
     def __init__(self, url, filesize, nonce='', hash='', is_hashed=False):
         """
-        @param url: the url to represent.
+        @param url: the url to represent, or the hexdigest of its hash if C{is_hashed}.
         @param filesize: the filesize in bytes of the file at the url.
         @param hash: optional; if provided, the hexdigest of a hash of the file at the url.
+                     If C{is_hashed}, it is used as the content hash as it is.
         """
-        self.hash = ''
-        self.filehash = ''
-        self.filesize = filesize 
-        self.objecthash = hash if hash and isinstance(hash, basestring) else ''
+        self.filesize = filesize
         self.nonce = nonce
-        noncehash = self._makehash(self.nonce)
-        self.empty_contenthash = noncehash.hexdigest()
-        noncehash.update(str(self.filesize))
-        self.empty_url = noncehash.hexdigest()
-        self.prehashed = False
+        self.prehashed = is_hashed
+        self.plain = ''
+        self.objecthash = ''
+        # Prehashed values which are not hexdigests, as given; see _unhex.
+        self._url = self._contenthash = None
         if is_hashed:
-            self.hash = url
-            self.filehash = hash
-            self.plain = ''
-            self.objecthash = ''
-            self.prehashed = True
+            self.rawurl = self._unhex(url)
+            if self.rawurl and self.url != url:
+                self._url = url
+            self.rawcontenthash = self._unhex(hash)
+            if self.rawcontenthash and self.contenthash != hash:
+                self._contenthash = hash
         else:
-            self.plain = url if url and isinstance(url, basestring) else ''
-            trash = self.url if self.plain else ''
-            refuse = self.contenthash if self.objecthash else ''
+            self.rawurl = self._makehash(url).digest() if self._given(url) else ''
+            self.rawcontenthash = self._makehash(hash).digest() if self._given(hash) else ''
 
-    @property 
+    @property
     def url(self):
-        if not self.hash:
-            #self.hash = self._makehash(self.nonce, self.plain, str(self.filesize))
-            self.hash = self._makehash(self.plain)
-            #self.plain = ''
-        return self._extracthash(self.hash, self.empty_url)
+        if self._url is not None:
+            return self._url
+        return self.rawurl.encode('hex')
 
     @property
     def contenthash(self):
-        if not self.filehash:
-            #self.filehash = self._makehash(self.nonce, self.objecthash)
-            self.filehash = self._makehash(self.objecthash)
-            #self.objecthash = ''
-        return self._extracthash(self.filehash, self.empty_contenthash)
+        if self._contenthash is not None:
+            return self._contenthash
+        return self.rawcontenthash.encode('hex')
+
+    @staticmethod
+    def _given(value):
+        return bool(value) and isinstance(value, basestring)
+
+    def _unhex(self, hexdigest):
+        """
+        The raw form of a hexdigest received from elsewhere.  Anything which is not a
+        hexdigest is hashed, so that keys are always raw digests; L{url} and L{contenthash}
+        still give it back as it was received.
+        """
+        if not self._given(hexdigest):
+            return ''
+        try:
+            return hexdigest.decode('hex')
+        except TypeError:
+            return self._makehash(hexdigest).digest()
 
     def _makehash(self, *values):
         hash = hasher()
@@ -86,38 +110,26 @@ class UrlObject(object):
             hash.update(value)
         return hash
 
-    def _extracthash(self, hashobj, empty):
-        try:
-            digest = hashobj.hexdigest()
-        except AttributeError:
-            return hashobj
-        else:
-            #if digest == empty:
-            #    return ''
-            return digest
-
     def __repr__(self):
         repr_string = 'UrlObject(%r, %r' % (self.url, self.filesize)
         if self.nonce:
             repr_string += ', nonce=%r' % (self.nonce)
-        if self.hash:
-            repr_string += ', hash=%r' % (self.filehash)
-        repr_string += ', is_hashed=True)' 
+        repr_string += ', hash=%r, is_hashed=True)' % (self.contenthash)
         return repr_string
 
     def __str__(self):
         return '(%s, %s)' % (self.url, self.contenthash)
 
     def __nonzero__(self):
-        if not self.url and not self.contenthash:
+        if not self.rawurl and not self.rawcontenthash:
             return False
         return True
 
     def __eq__(self, other):
         'Two UrlObjects are equal if they have the same url, contenthash, and nonce.'
         if other == None: return False
-        if self.url != other.url: return False
-        if self.contenthash != other.contenthash: return False
+        if self.rawurl != other.rawurl: return False
+        if self.rawcontenthash != other.rawcontenthash: return False
         if self.nonce != other.nonce: return False
         return True
 
@@ -127,7 +139,8 @@ class UrlObject(object):
 
 class TimeoutedTransport(xmlrpclib.Transport):
     """
-    Timeouted xmlrpclib transport used in model.Peer.transport.
+    Timeouted xmlrpclib transport used in model.Peer.transport.  Keeps its connection to
+    the host open between requests.
     """
     timeout = 10
 
@@ -179,6 +192,71 @@ class WeightedAverager(object):
         self.total += weight * float(item)
         self.totalweight += weight
 
+class ExpiringLRUCache(object):
+    """
+    A bounded mapping which forgets the least recently used entry once it is full, and any
+    entry older than C{ttl} seconds.  Counts hits and misses of L{get}.
+
+    @ivar hits: lookups which found a live entry
+    @type hits: C{int}
+
+    @ivar misses: lookups which did not
+    @type misses: C{int}
+    """
+    def __init__(self, maxsize, ttl, clock=time.time):
+        """
+        @param maxsize: most entries to keep; 0 keeps none
+        @type maxsize: C{int}
+
+        @param ttl: seconds an entry is kept for
+        @type ttl: C{float}
+
+        @param clock: returns the current time in seconds
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        """
+        The value stored for C{key}, or C{default} if there is none or it has expired.
+        """
+        try:
+            expires, value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires <= self.clock():
+            self.misses += 1
+            return default
+        self.entries[key] = expires, value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Store C{value} for C{key}, forgetting the least recently used entries to make room.
+        """
+        if self.maxsize <= 0:
+            return
+        self.entries.pop(key, None)
+        while len(self.entries) >= self.maxsize:
+            self.entries.popitem(last=False)
+        self.entries[key] = self.clock() + self.ttl, value
+
+    def clear(self):
+        """
+        Forget every entry; the counters are kept.
+        """
+        self.entries.clear()
+
+
 ################## Decorators ##################
 
 def cached(method, cache_name="_{0}_cache"):
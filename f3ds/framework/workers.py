@@ -0,0 +1,74 @@
+#!/usr/bin/python
+"""
+Bounded pools of threads for work which would otherwise block the reactor.
+"""
+
+# Standard python modules
+
+# 3rd party modules
+from twisted.internet import threads
+from twisted.python.threadpool import ThreadPool
+
+# Our modules
+
+
+class WorkerPool(object):
+    """
+    Runs blocking calls on a bounded pool of threads and hands their results back to the
+    reactor as Deferreds.  Calls beyond C{maxthreads} wait their turn.
+
+    Anything run here must not touch the database session, which belongs to the reactor
+    thread.
+
+    @ivar pool: the threads; started by the first call to L{run}
+    @type pool: C{twisted.python.threadpool.ThreadPool}
+    """
+
+    def __init__(self, name, maxthreads=4, reactor=None):
+        """
+        @param maxthreads: most calls to run at once
+        @type maxthreads: C{int}
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.pool = ThreadPool(minthreads=0, maxthreads=maxthreads, name=name)
+        self.trigger = None
+
+    def run(self, f, *args, **kwargs):
+        """
+        Call C{f(*args, **kwargs)} on one of the threads.
+
+        @return: a Deferred firing with the result of the call, or failing with what it
+                 raised
+        @rtype: C{twisted.internet.defer.Deferred}
+        """
+        if not self.pool.started:
+            self.pool.start()
+            self.trigger = self.reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+        return threads.deferToThreadPool(self.reactor, self.pool, f, *args, **kwargs)
+
+    def stop(self):
+        """
+        Stop the threads once the calls already running are done.
+        """
+        if self.trigger is not None:
+            self.reactor.removeSystemEventTrigger(self.trigger)
+            self.trigger = None
+        if self.pool.started:
+            self.pool.stop()
+
+
+_pools = {}
+
+
+def getPool(name, maxthreads=4):
+    """
+    The shared L{WorkerPool} called C{name}, created with C{maxthreads} threads by the
+    first caller.
+    """
+    try:
+        return _pools[name]
+    except KeyError:
+        pool = _pools[name] = WorkerPool(name, maxthreads)
+        return pool
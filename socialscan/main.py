@@ -55,7 +55,8 @@ def main():
     # construct the sharing system that other peers can download from and talk to
     logger.log("Initialize sharing system")
     root = resource.Resource()
-    root.putChild('RPC2', SocialScanRPCCommands(config, session))
+    managers = dict((manager.cname, manager) for manager in [digestmanager, scanlogmanager])
+    root.putChild('RPC2', SocialScanRPCCommands(config, session, managers))
 
     # add the local static content under shared/ that other peers can download digests and such from
     sharedir = os.path.realpath("data/shared/")
@@ -9,9 +9,10 @@ see http://wiki.squid-cache.org/Features/Redirectors
 __author__ = 'Christian "lahwran" Horne, Matt Probst, and Jun Park'
 
 # Python standard library imports
+import collections
 import os
 
-from datetime import datetime, timedelta
+from datetime import datetime
 
 # 3rd party imports
 from twisted.internet import stdio, reactor
@@ -20,7 +21,7 @@ from twisted.internet.endpoints import TCP4ClientEndpoint
 
 # Our imports
 from f3ds.framework.log import Logger
-from f3ds.framework.core import CoreClientFactory
+from f3ds.framework.core import CoreConnection
 from socialscan.config import loadDefaultConfig
 
 
@@ -30,30 +31,42 @@ class Redirector(basic.LineOnlyReceiver):
     it is used from. Currently only uses the url field from the squid redirector protocol,
     so leaving out the other fields will have no effect.
 
+    Squid's concurrent helper protocol (C{url_rewrite_children ... concurrency=N}) is
+    supported: lines starting with a channel ID are all sent to the core at once, and each
+    answer is written, prefixed with its channel ID, as soon as the core has decided it.
+    Lines without a channel ID are answered in the order they came in.
+
     @ivar logger: 'Redirector' logger
     @type logger: L{Logger}
 
     @ivar config: config instance
     @type config: L{AttributeConfig}
 
-    @ivar endpoint: endpoint location of Core server on localhost
-    @type endpoint: C{twisted.internet.endpoints.TCP4ClientEndpoint}
+    @ivar core: persistent connection to the Core server on localhost, shared by all lines
+    @type core: L{CoreConnection}
+
+    @ivar unnumbered: answers to lines without a channel ID, in the order the lines came in;
+                      C{None} where the core has not answered yet
+    @type unnumbered: C{collections.deque} of C{[str]}
     """
-    begin = None
-    end = None
     delimiter = "\n"
-    def __init__(self, config):
+    def __init__(self, config, core=None):
         self.logger = Logger('Redirector')
         self.config = config
-        self.endpoint = TCP4ClientEndpoint(reactor, "127.0.0.1", int(config.scanning._core_port))
+        if core is None:
+            endpoint = TCP4ClientEndpoint(reactor, "127.0.0.1",
+                                          int(config.scanning._core_port))
+            core = CoreConnection(endpoint)
+        self.core = core
+        self.unnumbered = collections.deque()
 
     def parseLine(self, line):
         """
         Parse a line from squid
         @param line: line received from squid
         @type line: C{str}
-        @return: url from the line
-        @rtype: C{str}
+        @return: channel ID (C{None} if there is none) and url from the line
+        @rtype: C{tuple} of C{int} and C{str}
         """
         # IDnum URLstr ip/fqdn ident method key=value key=value
         # or
@@ -68,11 +81,12 @@ class Redirector(basic.LineOnlyReceiver):
         try:
             channelid = int(first)
         except ValueError:
+            channelid = None
             url = first
         else:
-            url = fields.next()
+            url = next(fields, "")
 
-        return url
+        return channelid, url
 
     def stop(self):
         """
@@ -81,25 +95,24 @@ class Redirector(basic.LineOnlyReceiver):
         """
         reactor.stop()
 
-    @property
-    def totaltime(self):
-        if self.begin and self.end:
-            return self.end - self.begin
-        elif self.begin:
-            return datetime.now() - self.begin
-        else:
-            return timedelta(0)
-
-    def callback(self, result):
+    def answer(self, result, channelid, begin):
         """
-        Callback provided to CoreClientFactory.
-        @param result: url to redirect to, or C{""}.
+        Write the core's answer for a line.
+        @param result: url to redirect to, C{""}, or C{None} if the core could not decide
         @type result: C{str}
+        @param channelid: channel ID of the line, or C{None}
+        @type channelid: C{int}
+        @param begin: when the line was received
+        @type begin: C{datetime}
         """
-        self.end = datetime.now()
+        result = result or ""
+        totaltime = datetime.now() - begin
         msg = 'Decision took %s seconds; URL result: %s'
-        self.logger.log(msg % (self.totaltime.total_seconds(), result))
-        self.transport.write("%s\n" % result)
+        self.logger.log(msg % (totaltime.total_seconds(), result))
+        if channelid is None:
+            self.transport.write("%s\n" % result)
+        else:
+            self.transport.write("%d %s\n" % (channelid, result))
 
     def dataReceived(self, data):
         """
@@ -114,19 +127,43 @@ class Redirector(basic.LineOnlyReceiver):
         @type line: C{str}
         @param line: line received
         """
-        self.begin = datetime.now()
+        begin = datetime.now()
         self.logger.log("Got a new request: [%s]" % line.replace("\n", ""))
         if not line:
             self.logger.log("Line empty, exiting: %r" % line)
             self.stop()
+            return
 
-        url = self.parseLine(line)
+        channelid, url = self.parseLine(line)
         if not url:
             self.logger.log("URL empty, ignoring: %r" % url)
             return
 
-        factory = CoreClientFactory(url, self.callback)
-        self.endpoint.connect(factory)
+        d = self.core.request(url)
+        d.addErrback(self.failed, url)
+        if channelid is None:
+            answer = [None]
+            self.unnumbered.append(answer)
+            d.addCallback(self.inorder, answer, begin)
+        else:
+            d.addCallback(self.answer, channelid, begin)
+
+    def failed(self, failure, url):
+        """
+        The core could not be asked about a url; let squid fetch it unchanged rather than
+        leave it waiting.
+        """
+        self.logger.log("Asking the core about %s failed: %s" % (url, failure.getErrorMessage()))
+        return ""
+
+    def inorder(self, result, answer, begin):
+        """
+        Write the answers to lines without a channel ID which are ready, in order.
+        """
+        answer[0] = (result, begin)
+        while self.unnumbered and self.unnumbered[0][0] is not None:
+            result, begin = self.unnumbered.popleft()[0]
+            self.answer(result, None, begin)
 
 
 def main(config):
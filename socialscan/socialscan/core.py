@@ -6,17 +6,22 @@ import datetime
 from twisted.internet import defer, reactor
 from twisted.internet.protocol import Factory, Protocol
 from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.python.failure import Failure
 
 # Our modules
 from f3ds.framework.log import Logger
 from f3ds.framework.core import (Core, CoreRequest, CoreClientRequest,
                                  CoreClientFactory, BaseHandlerProxy)
+from f3ds.framework.model import taints
+from f3ds.framework.util import ExpiringLRUCache, UrlObject
 from socialscan import decisionhandlers
+from socialscan import scanhandlers
 from socialscan import scanning
 from socialscan.config import loadDefaultConfig
 from socialscan.db import setupDB
 from socialscan.model import Peer, Scan
-from socialscan.util import Safety, WeightedAverager
+from f3ds.framework.util import WeightedAverager
+from socialscan.util import Safety
 
 class DecisionHandlerProxy(BaseHandlerProxy):
     """
@@ -51,11 +56,22 @@ class DecisionHandlerProxy(BaseHandlerProxy):
         """
         Determine the safety status of a url.
         Overridden to provide documentation for decision_handler writers.
-        
+
+        Anything slow should not block the reactor: rather than returning the Safety value,
+        return a Deferred firing with it, or make C{process} a resolver which yields the
+        Deferred of each stage that has to wait and finishes with C{defer.returnValue} (see
+        L{f3ds.framework.core.resolve}).  L{socialscan.scanning.ScannableRequest} offers
+        Deferred versions of its slow stages, such as C{prepare}, C{deferLocalscan} and
+        C{deferActiveScans}, which run off the reactor thread.  Handlers returning the
+        Safety value directly still work, but hold up every other request while they run.
+        C{deferLocalscan} fails with L{socialscan.exceptions.ScanQueueFullError} when the
+        scan executor turns the scan away; answer from the evidence at hand, without
+        confidence, rather than failing the request.
+
         @type request: L{socialscan.scanning.ScannableRequest}
         @param request: Request object 
 
-        @rtype: L{socialscan.util.Safety}
+        @rtype: L{socialscan.util.Safety}, or a Deferred or resolver giving one
         @return: Computed Safety value of the request
         """
         raise NotImplementedError(self.not_implemented)
@@ -63,54 +79,150 @@ class DecisionHandlerProxy(BaseHandlerProxy):
 
 class SocialScanCoreRequest(CoreRequest):
     def __init__(self, core):
-        super(SocialScanCoreRequest, self).__init__(core, logger_name='SocialScan Request')
+        CoreRequest.__init__(self, core, logger_name='SocialScan Request')
 
     @defer.inlineCallbacks
     def handle_url(self, url):
         """
-        Run the loop for an individual url
+        Run the loop for an individual url, unless it was decided recently or is being
+        decided already.
+        """
+        self.logger.log("handling url %r" % url)
+        key = self.core.verdictKey(url)
+        verdict = self.core.verdicts.get(key)
+        msg = 'verdict cache %s (%d hits, %d misses)'
+        if verdict is not None:
+            self.logger.log(msg % ('hit', self.core.verdicts.hits, self.core.verdicts.misses))
+            defer.returnValue(verdict)
+        self.logger.log(msg % ('miss', self.core.verdicts.hits, self.core.verdicts.misses))
+        verdict = yield self.core.coalesce(key, self.decide, url, key)
+        defer.returnValue(verdict)
+
+    @defer.inlineCallbacks
+    def decide(self, url, key):
+        """
+        Run the decision handler on C{url} until it is confident or time is up.
+
+        @return: a Deferred firing with the reply for the url
+        @rtype: C{twisted.internet.defer.Deferred}
         """
-        try:
-            self.logger.log("handling url %r" % url)
-            request = scanning.ScannableRequest(self.core.config, self.core.session, url,
-                                                digestmanager=self.core.digestmanager,
-                                                scanlogmanager=self.core.scanlogmanager)
-
-            if self.handler.isUrlExempt(self.core, request):
-                self.logger.log("url exempt from scanning")
-                self.reply(self.handler.allow(self.core, request))
-                return
-
-            start = datetime.datetime.utcnow()
-            confident = False
-            while not confident:
-                status = self.handler.process(self.core, request)
-                elapsed = datetime.datetime.utcnow() - start
-                self.logger.log('handle_url: elapsed time: %s' % elapsed)
-                confident = status.isconfident
-                if elapsed > self.timeout:
-                    msg = 'timed out: took %s (timeout: %s) (confident?: %s)'
-                    self.logger.log(msg % (elapsed, self.timeout, confident))
-                    break
-                yield request.sleep()
-
-            if status.ismalicious:
-                self.reply(self.handler.deny(self.core, request))
-            else:
-                self.reply(self.handler.allow(self.core, request))
-        except:
-            self.logger.exception()
-            self.transport.loseConnection()
+        request = scanning.ScannableRequest(self.core.config, self.core.session, url,
+                                            digestmanager=self.core.digestmanager,
+                                            scanlogmanager=self.core.scanlogmanager)
+
+        if self.handler.isUrlExempt(self.core, request):
+            self.logger.log("url exempt from scanning")
+            defer.returnValue(self.handler.allow(self.core, request))
+
+        start = datetime.datetime.utcnow()
+        confident = False
+        while not confident:
+            status = yield self.handler.resolve(self.core, request)
+            elapsed = datetime.datetime.utcnow() - start
+            self.logger.log('handle_url: elapsed time: %s' % elapsed)
+            confident = status.isconfident
+            if elapsed > self.timeout:
+                msg = 'timed out: took %s (timeout: %s) (confident?: %s)'
+                self.logger.log(msg % (elapsed, self.timeout, confident))
+                break
+            yield request.sleep()
+
+        if status.ismalicious:
+            verdict = self.handler.deny(self.core, request)
+        else:
+            verdict = self.handler.allow(self.core, request)
+        if confident:
+            self.core.verdicts.put(key, verdict)
+        defer.returnValue(verdict)
 
 
 class SocialScanCore(Core):
+    """
+    @ivar verdicts: replies for urls decided with confidence, by L{verdictKey}
+    @type verdicts: L{ExpiringLRUCache}
+
+    @ivar inflight: Deferreds waiting on the verdict of a url being decided, by
+                    L{verdictKey}
+    @type inflight: C{dict} of C{list}
+
+    @ivar scanhandler: the scan handler's shared SigInfo cache, which tells
+                       L{newSignatures} when the signatures change
+    @type scanhandler: L{scanhandlers.SigInfoCache}
+
+    @ivar siginfo: the scanner's signatures, as last told to L{newSignatures}
+    @type siginfo: L{socialscan.util.SigInfo}
+    """
     def __init__(self, config, session, digestmanager, scanlogmanager):
-        super(SocialScanCore, self).__init__(config, session, digestmanager,
-                                             scanlogmanager, logname='SocialScan')
+        Core.__init__(self, config, session, digestmanager, scanlogmanager,
+                      logname='SocialScan')
         self.confidence_threshold = float(config.core.confidence_threshold)
         self.logger.log("confidence threshold: %f" % self.confidence_threshold)
         self.handler = DecisionHandlerProxy(decisionhandlers.get(config.core.decision_handler))
         self.handler.port = config.sharing.port
+        self.scanhandler = scanhandlers.sigInfoCache(config.scanning.handler)
+        self.scanhandler.subscribe(self.newSignatures)
+        self.verdicts = ExpiringLRUCache(int(config.core.verdict_cache_size),
+                                         float(config.core.verdict_cache_ttl))
+        self.siginfo = None
+        self.taints = taints()
+        self.inflight = {}
+
+    def newSignatures(self, siginfo):
+        """
+        Told by the scan handler's L{scanhandlers.SigInfoCache} that its signatures changed:
+        drop every verdict, as they may rest on the old signatures.
+        """
+        self.logger.log("new signatures %r" % (siginfo,))
+        if len(self.verdicts):
+            self.logger.log("dropping %d cached verdicts" % len(self.verdicts))
+        self.verdicts.clear()
+        self.siginfo = siginfo
+
+    def verdictKey(self, url):
+        """
+        The key of the verdict for C{url} in L{verdicts}: the hash of the url and the
+        current signatures of the scanner.  Every verdict is dropped when the signatures
+        change (see L{newSignatures}) or something is marked tainted, as they may rest on
+        what changed.  The scanner is only asked for its signatures by the first request;
+        some scan handlers run the scanner to find them.
+        """
+        if self.siginfo is None:
+            self.siginfo = self.scanhandler.getSigInfo()
+        if taints() != self.taints:
+            if len(self.verdicts):
+                self.logger.log("dropping %d cached verdicts" % len(self.verdicts))
+            self.verdicts.clear()
+            self.taints = taints()
+        return UrlObject(url, -1).rawurl, self.siginfo
+
+    def coalesce(self, key, decide, *args):
+        """
+        Call C{decide(*args)} for the verdict of C{key}, unless it is already being decided;
+        then wait for that verdict instead, so that a url asked about several times at once
+        is only downloaded and scanned once.
+
+        @param decide: returns a Deferred firing with the verdict
+        @return: a Deferred firing with the verdict
+        @rtype: C{twisted.internet.defer.Deferred}
+        """
+        if key in self.inflight:
+            self.logger.log("joining the request in flight for the same url")
+            d = defer.Deferred()
+            self.inflight[key].append(d)
+            return d
+
+        def landed(result):
+            for waiting in self.inflight.pop(key):
+                if isinstance(result, Failure):
+                    waiting.errback(result)
+                else:
+                    waiting.callback(result)
+            return result
+
+        self.inflight[key] = []
+        d = decide(*args)
+        d.addBoth(landed)
+        return d
 
     def buildProtocol(self, addr):
         return SocialScanCoreRequest(self)
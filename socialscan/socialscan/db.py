@@ -14,7 +14,7 @@ from socialscan import model
 
 
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy import bindparam, create_engine, func, inspect, or_
 #from sqlalchemy import event
 
 Session = sessionmaker()
@@ -36,5 +36,57 @@ def setupDB(url):
     session.configure(bind=engine)
     model.Base.metadata.bind = engine
     model.Base.metadata.create_all()
+    migrateDB(engine)
 
     return session, engine
+
+
+def migrateDB(engine, batchsize=1000):
+    """
+    Bring the scans table of a database made by an older version up to date: create_all
+    makes missing tables but leaves existing ones alone, so add the url_hash column, fill
+    it in for existing scans and create the indexes on the table.  Local scans not yet both
+    digested and logged are put in an empty scan feed, for the container managers to find.
+    """
+    logger = Logger("db")
+    scans = model.Scan.__table__
+    inspector = inspect(engine)
+    if scans.name not in inspector.get_table_names():
+        return
+    if 'url_hash' not in [c['name'] for c in inspector.get_columns(scans.name)]:
+        logger.log("Adding url_hash column to %s" % scans.name)
+        engine.execute('ALTER TABLE %s ADD COLUMN url_hash VARCHAR(40)' % scans.name)
+
+    update = scans.update().where(scans.c.id==bindparam('scan_id')).values(
+        url_hash=bindparam('hashed'))
+    select = scans.select().with_only_columns([scans.c.id, scans.c.url]).where(
+        scans.c.url_hash==None).limit(batchsize)
+    filled = 0
+    while True:
+        rows = engine.execute(select).fetchall()
+        if not rows:
+            break
+        engine.execute(update, [{'scan_id': id, 'hashed': model.urlHash(url)}
+                                for id, url in rows])
+        filled += len(rows)
+    if filled:
+        logger.log("Filled in url_hash for %s scans" % filled)
+
+    existing = set(i['name'] for i in inspect(engine).get_indexes(scans.name))
+    for index in scans.indexes:
+        if index.name not in existing:
+            logger.log("Creating index %s" % index.name)
+            index.create(bind=engine)
+
+    feed = model.ScanFeedEntry.__table__
+    feed.create(bind=engine, checkfirst=True)
+    if engine.execute(feed.select().with_only_columns([feed.c.id]).limit(1)).first() is None:
+        waiting = scans.select().with_only_columns([scans.c.owner_id, scans.c.id])\
+            .where(scans.c.type=='local')\
+            .where(scans.c.owner_id!=None)\
+            .where(or_(func.coalesce(scans.c.digested, False)==False,
+                       func.coalesce(scans.c.logged, False)==False))\
+            .order_by(scans.c.timestamp, scans.c.id)
+        fed = engine.execute(feed.insert().from_select(['owner_id', 'scan_id'], waiting))
+        if fed.rowcount:
+            logger.log("Added %s waiting scans to %s" % (fed.rowcount, feed.name))
@@ -11,7 +11,11 @@ from datetime import datetime
 import math
 import time
 
+# 3rd party modules
+from twisted.internet import defer
+
 # Our modules
+from f3ds.framework.core import resolve
 from socialscan.decisionhandlers.paranoid import process as normal_process
 from socialscan.model import Scan
 from socialscan.util import Safety, paranoid_update_counts
@@ -19,11 +23,13 @@ from socialscan.util import Safety, paranoid_update_counts
 def process(core, request):
     core.logger.log('using dynamic paranoid decision handler')
     core.logger.log('determining confidence for url %r' % request.url)
+    yield request.deferHeaders()  # the age comes from the headers
     age_in_days = (datetime.now() - request.age).total_seconds() / (24.0 * 3600.0)
     freshness_limit = float(core.config.core.freshness_limit)
     core.confidence_threshold = math.ceil(1/math.log(max(freshness_limit, age_in_days), 10))
     msg = 'age in days: %s, freshness_limit: %s, confidence_threshold: %s'
     core.logger.log(msg % (age_in_days, freshness_limit, core.confidence_threshold))
 
-    return normal_process(core, request)
+    safety = yield resolve(normal_process(core, request))
+    defer.returnValue(safety)
 
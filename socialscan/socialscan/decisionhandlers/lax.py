@@ -4,10 +4,11 @@ socialdistance), with a signature set updated in the last 10 days. A
 positive (malicious) will block the object.
 """
 
-# Standard Python modules
-import time
+# 3rd party modules
+from twisted.internet import defer
 
 # Our modules
+from socialscan.exceptions import ScanQueueFullError
 from socialscan.util import Safety, update_counts
 
 def process(core, request):
@@ -20,6 +21,9 @@ def process(core, request):
     # Check for result in digests, if found, use.
     # Otherwise, if no scans exist, request them.
     # Look for result in scans, if not found use local scan.
+    if not (yield request.prepare()):
+        core.logger.log("could not download %r; nothing to search by" % request.url)
+        defer.returnValue(Safety(False, False))
     core.logger.log('searching digests')
     for ds in request.digestscans():
         found, malicious = update_counts(found, malicious, ds,
@@ -29,13 +33,13 @@ def process(core, request):
     scans = request.getRelevantScans()
     if not scans:
         core.logger.log("performing active scan requests")
-        request.requestActiveScans()
+        yield request.deferActiveScans()
         core.logger.log('giving peers time to respond')
         # TODO: get sleep amount from config.  The current amount is based
         # on being greater than the response time from one host with a
         # particular AV product, for a particular file, for which getting
         # the hash failed, and being less than 1 second.
-        time.sleep(0.92)
+        yield request.sleep(0.92)
     core.logger.log('checking scans')
     scans = request.getRelevantScans()
     for scan in scans:
@@ -45,7 +49,12 @@ def process(core, request):
             break
     if not found > 0:
         core.logger.log('performing local scan')
-        found, malicious = update_counts(found, malicious, request.localscan,
-                                         days=core.config.core.signature_age)
+        try:
+            localscan = yield request.deferLocalscan()
+        except ScanQueueFullError:
+            core.logger.log('local scan turned away by a full scan queue')
+        else:
+            found, malicious = update_counts(found, malicious, localscan,
+                                             days=core.config.core.signature_age)
 
-    return Safety (found > 0, malicious >= 1)
+    defer.returnValue(Safety (found > 0, malicious >= 1))
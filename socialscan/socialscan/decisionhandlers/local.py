@@ -1,3 +1,6 @@
+from twisted.internet import defer
+
+from socialscan.exceptions import ScanQueueFullError
 from socialscan.util import Safety
 from socialscan.model import Scan
 
@@ -6,12 +9,15 @@ def process(core, request):
     confident = False
     malicious = False
     core.logger.log('searching local scans')
-    scan = request.localscan
+    try:
+        scan = yield request.deferLocalscan()
+    except ScanQueueFullError:
+        core.logger.log('local scan turned away by a full scan queue')
+        scan = None
     if scan:
         confident = True
         core.logger.log('got local scan')
         if scan.safety == Safety.malicious:
             malicious = True
             core.logger.log('file was deemed malicious by scanner')
-    return Safety(confident, malicious)
-
+    defer.returnValue(Safety(confident, malicious))
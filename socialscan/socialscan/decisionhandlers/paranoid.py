@@ -7,7 +7,11 @@ positive (malicious) result will block the object.
 from datetime import datetime
 import time
 
+# 3rd party modules
+from twisted.internet import defer
+
 # Our modules
+from socialscan.exceptions import ScanQueueFullError
 from socialscan.model import Scan
 from socialscan.util import Safety, paranoid_update_counts
 
@@ -39,26 +43,33 @@ def process(core, request):
             malicious = True
         return confident, malicious
 
-    def resolver():
-        scans = request.getRelevantActiveScans()
-        core.logger.log('checking %d scans' % len(scans))
-        for scan in scans:
-            scans_to_consider.append(scan)
-        yield
-        digestscans = request.digestscans()
-        core.logger.log('checking %d digestscans' % len(digestscans))
-        for scan in digestscans:
-            scans_to_consider.append(scan)
-        yield
-        core.logger.log('performing active scan requests')
-        request.requestActiveScans()
-        core.logger.log('checking local scan')
-        scans_to_consider.append(request.localscan)
-        yield # To let evaluate_scans run with local scan results
-
-    for pause in resolver():
-        confident, malicious = evaluate_scans(required, scans_to_consider, max_days)
-        if confident:
-            break
-    return Safety (confident, malicious)
+    if not (yield request.prepare()):  # scans are looked up by hash
+        core.logger.log('could not download %r; nothing to search by' % request.url)
+        # not confident, so malicious in case the timeout expires, as in evaluate_scans
+        defer.returnValue(Safety(False, True))
+    scans = request.getRelevantActiveScans()
+    core.logger.log('checking %d scans' % len(scans))
+    for scan in scans:
+        scans_to_consider.append(scan)
+    confident, malicious = evaluate_scans(required, scans_to_consider, max_days)
+    if confident:
+        defer.returnValue(Safety (confident, malicious))
+    digestscans = request.digestscans()
+    core.logger.log('checking %d digestscans' % len(digestscans))
+    for scan in digestscans:
+        scans_to_consider.append(scan)
+    confident, malicious = evaluate_scans(required, scans_to_consider, max_days)
+    if confident:
+        defer.returnValue(Safety (confident, malicious))
+    core.logger.log('performing active scan requests')
+    yield request.deferActiveScans()
+    core.logger.log('checking local scan')
+    try:
+        localscan = yield request.deferLocalscan()
+    except ScanQueueFullError:
+        core.logger.log('local scan turned away by a full scan queue')
+    else:
+        scans_to_consider.append(localscan)
+    confident, malicious = evaluate_scans(required, scans_to_consider, max_days)
+    defer.returnValue(Safety (confident, malicious))
 
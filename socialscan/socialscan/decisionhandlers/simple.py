@@ -1,4 +1,8 @@
-from socialscan.util import Safety, WeightedAverager
+from twisted.internet import defer
+
+from f3ds.framework.util import WeightedAverager
+from socialscan.exceptions import ScanQueueFullError
+from socialscan.util import Safety
 
 def process(core, request):
     core.logger.log("determining confidence for url %r" % request.url)
@@ -11,27 +15,35 @@ def process(core, request):
         Safety.benign: -1.0
     }
 
-    request.retrieveHeaders()  # try to get the filesize, if possible via the headers
-
-    def resolver():
-        core.logger.log("searching digests")
-        for scan in request.digestscans():
-            maliciousness.add(safetyWeights[scan.safety], 0.8)
-        yield
-        core.logger.log("searching previous scans")
-        for scan in request.getRelevantScans():
-            maliciousness.add(safetyWeights[scan.safety])
-        yield
-        core.logger.log("performing active scan requests")
-        request.requestActiveScans()
-        yield
-        core.logger.log("performing local scan")
-        maliciousness.add(safetyWeights[request.localscan.safety])
+    def confident():
+        return abs(maliciousness.average) > core.confidence_threshold
 
-    for pause in resolver():
-        if abs(maliciousness.average) > core.confidence_threshold:
-            break
+    def result():
+        core.logger.log("average: %f - scan" % maliciousness.average)
+        return Safety(confident(), maliciousness.average > 0)
 
-    core.logger.log("average: %f - scan" % maliciousness.average)
-    return Safety(abs(maliciousness.average) > core.confidence_threshold,
-                  maliciousness.average > 0)
+    if not (yield request.prepare()):  # the digests are searched by filesize and hash
+        core.logger.log("could not download %r; nothing to search by" % request.url)
+        defer.returnValue(result())
+    core.logger.log("searching digests")
+    for scan in request.digestscans():
+        maliciousness.add(safetyWeights[scan.safety], 0.8)
+    if confident():
+        defer.returnValue(result())
+    core.logger.log("searching previous scans")
+    for scan in request.getRelevantScans():
+        maliciousness.add(safetyWeights[scan.safety])
+    if confident():
+        defer.returnValue(result())
+    core.logger.log("performing active scan requests")
+    yield request.deferActiveScans()
+    if confident():
+        defer.returnValue(result())
+    core.logger.log("performing local scan")
+    try:
+        localscan = yield request.deferLocalscan()
+    except ScanQueueFullError:
+        core.logger.log("local scan turned away by a full scan queue")
+        defer.returnValue(result())
+    maliciousness.add(safetyWeights[localscan.safety])
+    defer.returnValue(result())
@@ -15,3 +15,9 @@ class IncompleteScanError(Exception):
 
 class TaintedScanError(Exception):
     pass
+
+
+class ScanQueueFullError(IncompleteScanError):
+    """
+    The scan executor had too many more urgent scans waiting to take this one.
+    """
@@ -5,6 +5,7 @@ __version__ = '0.1'
 
 # Standard python modules
 import collections
+import hashlib
 import os
 import random
 import string
@@ -16,16 +17,16 @@ import xmlrpclib
 from datetime import datetime
 
 # 3rd party modules
-from sqlalchemy import (Boolean, Column, DateTime, Enum, Float, Integer, String,
+from sqlalchemy import (Boolean, Column, DateTime, Enum, Float, Index, Integer, String,
                         ForeignKey, MetaData, and_, or_)
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
-from sqlalchemy.orm import mapper, relationship, backref
+from sqlalchemy.orm import mapper, relationship, backref, validates
 
 # Our modules
 from f3ds.framework.model import (ContainerMixin, BaseQueuedRequest,
                                   BaseSentRequest, map_to_UrlObject, BasePeer,
                                   SocialRelationship, baseRelationshipsQuery,
-                                  baseRequestQuery)
+                                  baseRequestQuery, countTaint)
 from f3ds.framework.util import UrlObject
 from socialscan import util
 from socialscan.exceptions import TaintedScanError
@@ -35,6 +36,17 @@ from socialscan.model.scanlog import ScanLog
 Base = declarative_base()
 
 
+def urlHash(url):
+    """
+    The fixed-width hash of a url kept in L{Scan.url_hash}.
+
+    @rtype: C{str}
+    """
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    return hashlib.sha1(url).hexdigest()
+
+
 # TODO: write tests (can use ScanDigestFile, ScanLogFile tests as starting point).
 class SocialScanContainerMixin(ContainerMixin):
     """
@@ -72,6 +84,10 @@ class Scan(Base):
     @type url: C{string}
     @ivar url: the url which was scanned
 
+    @type url_hash: C{string}
+    @ivar url_hash: L{urlHash} of url, kept up to date as url is set; scans of a url are
+                    looked up by it, since url is too wide to index
+
     @type hash: C{string}
     @ivar hash: a hash of the file which was scanned, if applicable; null if not
 
@@ -139,10 +155,16 @@ class Scan(Base):
 
     """
     __tablename__ = 'scans'
+    # What ScannableRequest._scansQuery and the digested/logged queries look up.
+    # Databases made before these existed get them from socialscan.db.migrateDB.
+    __table_args__ = (Index('ix_scans_url_hash_tainted_hash', 'url_hash', 'tainted', 'hash'),
+                      Index('ix_scans_owner_digested_type_timestamp',
+                            'owner_id', 'digested', 'type', 'timestamp'))
 
     # id: priamry key, unique
     id = Column(Integer, nullable=False, primary_key=True)
     url = Column(String(1024), nullable=False)
+    url_hash = Column(String(40))
     hash = Column(String(128))
     filesize = Column(Integer)
     owner_id = Column(Integer, ForeignKey('peers.id'))
@@ -195,6 +217,11 @@ class Scan(Base):
 
     to_UrlObject = map_to_UrlObject
 
+    @validates('url')
+    def _hashUrl(self, key, url):
+        self.url_hash = urlHash(url)
+        return url
+
     @property
     def safety(self):
         if self.tainted:
@@ -223,10 +250,63 @@ class Scan(Base):
         relationship = self.owner.getRelationship(session, self.peer)
         relationship.punish(punishment)
         self.tainted = True
+        countTaint()
         session.add(relationship)
         session.add(self)
 
 
+class ScanFeedEntry(Base):
+    """
+    An entry in the feed of new local scans.  One is appended in the same commit as each
+    local scan, and the container managers read the feed on from their L{FeedCursor} rather
+    than look through the scans table for scans they have not yet added.
+
+    @type id: C{int}
+    @ivar id: position in the feed; entries are only ever appended, so positions only grow
+    """
+    __tablename__ = 'scanfeed'
+    __table_args__ = (Index('ix_scanfeed_owner_id', 'owner_id', 'id'),
+                      {'sqlite_autoincrement': True})
+
+    id = Column(Integer, nullable=False, primary_key=True)
+    owner_id = Column(Integer, ForeignKey('peers.id'), nullable=False)
+    scan_id = Column(Integer, ForeignKey('scans.id'), nullable=False)
+
+    owner = relationship('Peer')
+    scan = relationship(Scan)
+
+    def __init__(self, scan):
+        self.owner = scan.owner
+        self.scan = scan
+
+    def __repr__(self):
+        return "ScanFeedEntry(id=%r, scan_id=%r)" % (self.id, self.scan_id)
+
+
+class FeedCursor(Base):
+    """
+    How far a consumer of the scan feed has got: every L{ScanFeedEntry} up to and including
+    C{position} has been dealt with.
+
+    @type name: C{str}
+    @ivar name: the consumer, e.g. the cname of a container manager
+    """
+    __tablename__ = 'feedcursors'
+
+    owner_id = Column(Integer, ForeignKey('peers.id'), primary_key=True)
+    name = Column(String(64), primary_key=True)
+    position = Column(Integer, default=0, nullable=False)
+
+    owner = relationship('Peer')
+
+    def __init__(self, owner, name, position=0):
+        self.owner = owner
+        self.name = name
+        self.position = position
+
+    def __repr__(self):
+        return "FeedCursor(%r, %r, position=%r)" % (self.owner, self.name, self.position)
+
 class ScanDigestFile(SocialScanContainerMixin, Base):
     """
     Represents a scan digest file and information about it.
@@ -1,12 +1,17 @@
 #!/usr/bin/python
 
 # Standard Python modules
+import collections
 import os
+import shutil
+import socket
 import sys
 import tempfile
 import time
 import urllib
 import urllib2
+import xmlrpclib
+import zlib
 
 from datetime import datetime
 from datetime import timedelta
@@ -24,17 +29,24 @@ for d in [projectdir,
         sys.path.append(d)
 
 # 3rd party modules
+from sqlalchemy.orm import joinedload
+from twisted.internet import defer
 from twisted.internet.task import LoopingCall
+from twisted.python.failure import Failure
 
 # Our modules
+from f3ds.framework import peerrpc, transfer
 from f3ds.framework.log import Logger
 from f3ds.framework.model.containers import ContainerManager
 from f3ds.framework.exceptions import ContainerFullError
 from f3ds.framework.util import UrlObject
-from socialscan import scanhandlers, scanning
+from f3ds.framework.workers import getPool
+from socialscan import scanexecutor, scanhandlers, scanning
 from socialscan import util
-from socialscan.model import (QueuedRequest, relationshipsQuery, requestQuery,
-                              Scan, ScanDigestFile, ScanLogFile)
+from socialscan.exceptions import ScanQueueFullError
+from socialscan.model import (FeedCursor, QueuedRequest, SocialRelationship,
+                              relationshipsQuery, requestQuery, ScanDigestFile, ScanFeedEntry,
+                              ScanLogFile)
 from socialscan.model.scandigest import ScanDigest
 from socialscan.model.scanlog import ScanLog
 from socialscan.searchutil import SearchResult
@@ -49,16 +61,41 @@ class ScanResultContainerManager(ContainerManager):
 
     Variables added by this class:
 
-    @ivar scanhandler: ScanHandler module, used for C{getSigInfo()}
-    @type scanhandler: scanhandler module
+    @ivar scanhandler: the scan handler's shared SigInfo cache, used for C{getSigInfo()}
+    @type scanhandler: L{scanhandlers.SigInfoCache}
+
+    @ivar finished: the container we last finished building, kept so that peers holding an
+                    earlier generation of it can still be sent what changed
+    @type finished: L{ContainerMixin} or C{None}
+
+    @ivar announced: url and generation of our container when it was last announced, if
+                     C{config.container_manager.announce_active} is on
+    @type announced: C{tuple} or C{None}
+
+    @ivar retrieving: the offers being retrieved: peer ID and container url by request ID
+    @type retrieving: C{dict}
+
+    @ivar workers: the pool offers are downloaded on
+    @type workers: L{WorkerPool}
     """
 
     def __init__(self, config, session, container_mixin):
+        self.finished = None
+        self.announced = None
         super(ScanResultContainerManager, self).__init__(config, session, container_mixin)
-        self.scanhandler = scanhandlers.get(config.scanning.handler)
+        self.scanhandler = scanhandlers.sigInfoCache(config.scanning.handler)
         self.added_property_name = 'contained'
         self.timeout = config.container_manager.download_timeout
         self.singlesd = config.container_manager.process_single_sd in ['True', 'true']
+        announceactive = getattr(config.container_manager, 'announce_active', 'False')
+        self.announceactive = announceactive in ['True', 'true']
+        compress = getattr(config.container_manager, 'compress_transfers', 'False')
+        self.compress = compress in ['True', 'true']
+        self.downloadthreads = int(getattr(config.container_manager, 'download_threads', 4))
+        self.peerdownloads = int(getattr(config.container_manager, 'downloads_per_peer', 1))
+        self.feedbatch = int(getattr(config.container_manager, 'feed_batch_size', 1000))
+        self.retrieving = {}
+        self.workers = getPool('%sRetrieval' % self.name, self.downloadthreads)
         if not self.loaded:
             # Discard default container from parent class; it had siginfo==None
             self.ourcontainer = None
@@ -86,15 +123,36 @@ class ScanResultContainerManager(ContainerManager):
         self.session.commit()  # release the session lock for following long operations
         msg = '%s url: %s, owner: %s, name: %s'
         owner, name = (self.config.owner, self.config.owner.name)
+        announcements = []
         for container in containers:
-            self.logger.log(msg % (self.cname, container.url, owner, name))
-            for peer in targetpeers:
-                try:
-                    peer.transport.containerOffer(self.config.owner.name, container.url,
-                                                  self.cname)
-                except Exception, e:
-                    self.logger.log('Exception while sending to peer %r: %r' %
-                                    (peer, e))
+            url = self._offerUrl(container)
+            self.logger.log(msg % (self.cname, url, owner, name))
+            d = peerrpc.fanout(targetpeers, 'containerOffer', name, url, self.cname,
+                               deadline=float(self.config.core.network_timeout),
+                               threads=int(self.config.sharing.rpc_threads))
+            d.addCallback(self._announced, container)
+            announcements.append(d)
+        return defer.DeferredList(announcements)
+
+    def _offerUrl(self, container):
+        """
+        The url to offer one of our containers at.  With
+        C{config.container_manager.compress_transfers} on, that is the url of an encoded copy
+        of the container's file, which is written next to it; see L{f3ds.framework.transfer}.
+        """
+        if not self.compress:
+            return container.url
+        transfer.encode(container.filename, container.filename + transfer.SUFFIX)
+        return transfer.encodedUrl(container.url)
+
+    def _announced(self, outcome, container):
+        """
+        Log the peers an announcement did not reach.
+        """
+        results, failures = outcome
+        for peer, failure in failures.items():
+            self.logger.log('Exception while sending %s %s to peer %r: %s' %
+                            (self.cname, container.url, peer, failure.getErrorMessage()))
 
     def _newcontainer(self, siginfo):
         """
@@ -108,89 +166,204 @@ class ScanResultContainerManager(ContainerManager):
             self.ourcontainer.save()
             self.ourcontainer.complete = True
             self.session.add(self.ourcontainer)
+            self.finished = self.ourcontainer
 
         self.ourcontainer = self.container(self.config.owner, self.config, siginfo=siginfo)
-        self.ourcontainer.create(int(self.config.container_manager.maxcapacity))
+        self.ourcontainer.create(int(self.config.container_manager.maxcapacity),
+                                 **self._createoptions())
         self.ourcontainer.save()
         self.logger.log("New %s's filename: %s" % (self.cname, self.ourcontainer.filename))
 
+    def _createoptions(self):
+        """
+        Options for making our new containers with; see L{ContainerMixin.create}.
+        """
+        return {}
+
     def _addScans(self, scans):
         """
         Add some scans to the currently active container. Scans are assumed to be siginfo-compatible,
         i.e. they have the same siginfo as the container that is being added to.
 
-        This function will recursively create new containers if the current one fills up.
+        Scans are added in batches; whenever the current container fills up, a new one is
+        created and the scans that did not fit go into it.
 
         @param scans: scans to add to the container
         @type scans: C{list} of L{Scan}
+
+        @return: the scans that were left over, if even a new container took none of them
+        @rtype: C{list} of L{Scan}
         """
-        if not len(scans):
-            return
-        self.logger.log('adding %d scans to currently active %s' % (len(scans), self.cname))
-        it = iter(list(scans))  # we use an separate iterator so we
-                                # can grab the uniterated objects if necessary
-        lastone = None # preserve the one that *caused* the overflow to handle in new container
-        try:
-            for scan in it:
-                lastone = scan
-                self.ourcontainer.add(scan.to_UrlObject(), scan.safety)
-                setattr(scan, self.added_property_name, True)
-                self.session.add(scan)
+        remaining = list(scans)
+        fresh = False
+        while remaining:
+            msg = 'adding %d scans to currently active %s'
+            self.logger.log(msg % (len(remaining), self.cname))
+            items = [scan.to_UrlObject() for scan in remaining]
+            extras = [scan.safety for scan in remaining]
+            taken = self.ourcontainer.add_many(items, extras)
             self.session.add(self.ourcontainer)
-        except ContainerFullError:
-            self.logger.log('scans overflowed')
-            overflow = [lastone] + list(it)
-            self._newcontainer(overflow[0].siginfo)
-            self._addScans(overflow)
+            remaining = remaining[taken:]
+            if not remaining:
+                break
+            if fresh and not taken:
+                msg = 'a new %s took none of %d scans; leaving them for the next update'
+                self.logger.log(msg % (self.cname, len(remaining)))
+                break
+            self.logger.log('scans overflowed after %d; %d left over' % (taken, len(remaining)))
+            self._newcontainer(remaining[0].siginfo)
+            fresh = True
+        return remaining
+
+    def _feedCursor(self):
+        """
+        Our cursor into the scan feed, made at the start of the feed if we have none yet.
+
+        @rtype: L{FeedCursor}
+        """
+        cursor = self.session.query(FeedCursor)\
+                             .filter(FeedCursor.owner==self.config.owner)\
+                             .filter(FeedCursor.name==self.cname)\
+                             .first()
+        if cursor is None:
+            cursor = FeedCursor(self.config.owner, self.cname)
+            self.session.add(cursor)
+        return cursor
+
+    def _feedLimit(self):
+        """
+        The last position in the scan feed we may read up to, or C{None} for no limit.
+        """
+        return None
 
     def _findScans(self):
-        return  self.session.query(Scan)\
-                            .filter(Scan.type=='local')\
-                            .order_by(Scan.timestamp) \
-                            .all()
+        """
+        Read the next page of at most L{feedbatch} entries of the scan feed on from our
+        cursor.  Scans already added under the digested and logged flags of databases made
+        before the feed existed are passed over.
+
+        @return: the feed entries read, and the scans in them still to be added, oldest first
+        @rtype: C{tuple} of C{list} of L{ScanFeedEntry} and C{list} of L{Scan}
+        """
+        query = self.session.query(ScanFeedEntry)\
+                            .options(joinedload(ScanFeedEntry.scan))\
+                            .filter(ScanFeedEntry.owner==self.config.owner)\
+                            .filter(ScanFeedEntry.id > self._feedCursor().position)
+        limit = self._feedLimit()
+        if limit is not None:
+            query = query.filter(ScanFeedEntry.id <= limit)
+        entries = query.order_by(ScanFeedEntry.id).limit(self.feedbatch).all()
+        scans = [entry.scan for entry in entries
+                 if not getattr(entry.scan, self.added_property_name, False)]
+        return entries, scans
+
+    def _advanceFeed(self, entries, leftover):
+        """
+        Move our cursor past the feed entries read, stopping short of the first scan left
+        over so that it is read again by the next update.  Scans are added in feed order and
+        none after the first left over is added, so none is added twice.
+        """
+        if not entries:
+            return
+        position = entries[-1].id
+        if leftover:
+            left = set(scan.id for scan in leftover)
+            position = min(entry.id for entry in entries if entry.scan_id in left) - 1
+        cursor = self._feedCursor()
+        cursor.position = position
+        self.session.add(cursor)
+
+    def _addFeedScans(self, scans, newsiginfo, discardedinfos):
+        """
+        Add a page of scans from the feed, in feed order.  Scans with our container's siginfo
+        go into it until the first scan with the scanner's new siginfo, which starts a new
+        container for it and the scans after it; scans with any other siginfo are passed over
+        and their siginfos added to C{discardedinfos}.  Nothing after the first scan left over
+        is added.
+
+        @return: the scans left over; see L{_addScans}
+        @rtype: C{list} of L{Scan}
+        """
+        batch = []
+        for scan in scans:
+            if scan.siginfo == self.ourcontainer.siginfo:
+                batch.append(scan)
+            elif scan.siginfo == newsiginfo:
+                leftover = self._addScans(batch)
+                if leftover:
+                    return leftover
+                self._newcontainer(newsiginfo)
+                batch = [scan]
+            else:
+                discardedinfos.add(scan.siginfo)
+        return self._addScans(batch)
 
     def updateOurContainer(self):
         """
-        Recurring job: Update our sd with new scans
+        Recurring job: Update our sd with new scans, reading the scan feed a page at a time
+        and moving our cursor past each page as it is added.
         Note: This assumes that multiple updates of the scanner's signatures cannot occur
         in the time between runs of this function. If they do, it will cause an exception.
         """
         try:
             self.logger.log('updating our %s' % self.cname)
-            scans = self._findScans()
-            self.logger.log('processing %d scans' % len(scans))
-            currentsiginfo = self.ourcontainer.siginfo
             newsiginfo = self._determineSiginfo()
-            currentscans = [] # scans that are sigversion-compatible with current container
-            newscans = [] # scans that require a new container for sigversion compatibility
-            discardedscans = [] # not compatible with the current scanner or container sigversion
-            
-            for scan in scans:
-                if scan.siginfo == currentsiginfo:
-                    currentscans.append(scan)
-                elif scan.siginfo == newsiginfo:
-                    newscans.append(scan)
-                else:
-                    discardedscans.append(scan)
-            self._addScans(currentscans)
-
-            if newsiginfo != currentsiginfo:
+            discardedinfos = set() # not compatible with the current scanner or container sigversion
+            while True:
+                entries, scans = self._findScans()
+                self.logger.log('processing %d scans' % len(scans))
+                leftover = self._addFeedScans(scans, newsiginfo, discardedinfos)
+                self._advanceFeed(entries, leftover)
+                if leftover or len(entries) < self.feedbatch:
+                    break
+            if not leftover and newsiginfo != self.ourcontainer.siginfo:
                 self._newcontainer(newsiginfo)
-                self._addScans(newscans)
-            if discardedscans:
-                discardedinfos = [scan.siginfo for scan in discardedscans]
-                discardedinfos = list(set(discardedinfos))
+            if discardedinfos:
                 msg = 'Warning: scans were discarded when adding to %s' % (self.cname)
-                msg += ' (probably caused by a long update time) with siginfos: %r' % (discardedinfos)
+                msg += ' (probably caused by a long update time) with siginfos: %r' % (list(discardedinfos))
                 self.logger.log(msg)
             self.ourcontainer.save()
+            if self.announceactive:
+                self._queueActive()
+            announced = None
             if self.announcequeue:
-                self._announceContainers()
+                announced = self._announceContainers()
             self.session.commit()
+            return announced
         except:
             self.logger.exception()
             raise
 
+    def _queueActive(self):
+        """
+        Queue our container to be announced if it has changed since it was last announced,
+        so that peers keep up with it while it is still being built.  Peers which already
+        hold it are sent only what changed; see L{containerDelta}.
+        """
+        generation = getattr(self.ourcontainer._container, 'generation', None)
+        if generation is None or (self.ourcontainer.url, generation) == self.announced:
+            return
+        self.announced = (self.ourcontainer.url, generation)
+        if self.ourcontainer not in self.announcequeue:
+            self.announcequeue.append(self.ourcontainer)
+
+    def containerDelta(self, url, since):
+        """
+        What changed in our container at C{url} since generation C{since}, for a peer holding
+        a copy of that generation.  Only our current container and the one finished before it
+        are kept to say what changed.
+
+        @return: see L{f3ds.framework.model.digest.Digest.delta}; C{None} when the peer has
+                 to fetch the whole container
+        @rtype: C{dict} or C{None}
+        """
+        for container in [self.ourcontainer, self.finished]:
+            if container is not None and container.url == url:
+                delta = getattr(container._container, 'delta', None)
+                if delta is not None:
+                    return delta(since)
+        return None
+
     def _splitsuffix(self, url):
         'Split the suffix off of a url.'
         garbage, pathpart = urllib.splittype(url)
@@ -207,6 +380,11 @@ class ScanResultContainerManager(ContainerManager):
         while the actual call uses urllib2.open which has a timeout.
 
         Note that this method does not use a cache to retain recently downloaded urls.
+
+        An encoded container (see L{f3ds.framework.transfer}) is decompressed as it is
+        downloaded, so that C{filename} gets the container itself; a
+        L{f3ds.framework.exceptions.CorruptTransferError} is raised if it does not match the
+        length and checksum it was sent with.
         """
         # Much of this comes from urllib.URLopener.retrieve
         bs = 1024*8
@@ -229,6 +407,9 @@ class ScanResultContainerManager(ContainerManager):
                 # TODO: Would it be useful to store a list of retrieved containers?
                 #self.__tempfiles.append(filename)
                 tfp = os.fdopen(fd, 'wb')
+            decoder = None
+            if transfer.isEncoded(url):
+                decoder = tfp = transfer.DecodingWriter(tfp)
             try:
                 result = filename, headers
                 #if self.tempcache is not None:
@@ -253,6 +434,8 @@ class ScanResultContainerManager(ContainerManager):
                         msg = 'While downloading: %s timed out: took %s (timeout: %s)'
                         self.logger.log(msg % (util.class_name(self), elapsed, timeout))
                         break
+                if decoder:
+                    decoder.finish()
             finally:
                 tfp.close()
         finally:
@@ -265,84 +448,222 @@ class ScanResultContainerManager(ContainerManager):
 
     def retrieveContainer(self):
         """
-        Recurring job: retrieve a container that a peer has offered to us and, if a slot can be
-        made available, load it up.
+        Recurring job: start retrieving the containers that peers have offered to us, offers
+        from the socially nearest peers first.  At most C{download_threads} offers are
+        retrieved at once (one with C{process_single_sd} set), and at most
+        C{downloads_per_peer} from any one peer.  Downloads run on a worker pool, off the
+        reactor thread; see L{_fetch}.  Each retrieval that finishes starts the next.
         """
-        requests = []
-        self.singlesd
         try:
-            self.logger.log('retrieving a %s' % (self.cname))
-            query = requestQuery(self.session, self.config)
-            query = query.filter(QueuedRequest.type=='%s-offer' % (self.cname.lower()))
-            query = query.filter(QueuedRequest.state!='done')
-            if self.singlesd:
-                requests = [query.first()]
-            else:
-                requests = query.all()
+            self.logger.log('retrieving %ss' % (self.cname))
+            requests = self._pendingOffers()
         except Exception, e:
             self.logger.log('unable to get requests from the database: %s' % e)
             return
 
-        requests[:] = [r for r in requests if r]
-        if not requests:
+        requests = self._pickOffers(requests)
+        if not requests and not self.retrieving:
             self.logger.log('no %s offers to retrieve' % (self.cname))
-            return  # no queued requests - nothing to do
         for request in requests:
             try:
-                peer = request.peer
-                self.logger.log('offer: %r' % request)
-                container = self.container(self.config.owner, self.config, url=request.url,
-                                           foreign=True, creator=peer)
-                # do not initialize the version info yet
-
-                self.logger.log('Downloading %s to %s' % (request.url, container.filename))
-                try:
-                    (fname, headers) = self.urlretrieve(request.url, container.filename,
-                                                        self._retrieve_progress)
-                except IOError, error:
-                    msg = 'Error downloading %s from url %r' % (self.cname, request.url)
-                    msg += ' (offered by peer %r): %r' % (request.peer, error)
-                    self.logger.log(msg)
-                    request.state = 'done'
-                    self.session.add(request)
-                    self.session.commit()
-                    return
-                else:
-                    self.logger.log('Finished downloading %s to %s.' % (request.url, fname))
-                    self.logger.log('Headers:')
-                    for h in headers:
-                        self.logger.log('%s: %s' % (h, headers[h]))
-                try:
-                    container.load()
-                except (ValueError, AttributeError, IOError), error:
-                    self.logger.log('Error loading %s %s: %s' % (self.cname, container, error))
-                    request.state = 'done'
-                    self.session.add(request)
-                    self.session.commit()
-                    return
-                # now initialize the version info that we retrieved from the container
-                siginfo = container._container.siginfo
-                container.scannervv, container.sigversion, container.sigdate = siginfo
+                self._startRetrieval(request)
+            except:
+                self.logger.exception()
+                raise
+
+    def _pendingOffers(self):
+        """
+        The offers of our kind of container not yet retrieved, nearest peers first.
+        """
+        query = requestQuery(self.session, self.config)
+        query = query.filter(QueuedRequest.type=='%s-offer' % (self.cname.lower()))
+        query = query.filter(QueuedRequest.state!='done')
+        return query.order_by(QueuedRequest.time).all()
 
+    def _pickOffers(self, requests):
+        """
+        The offers to start retrieving now, out of C{requests} in order of preference, given
+        the retrievals already in flight.  Only one offer of the same container is retrieved
+        at a time.
+        """
+        limit = 1 if self.singlesd else self.downloadthreads
+        inflight = len(self.retrieving)
+        perpeer = collections.Counter(peer for peer, url in self.retrieving.values())
+        urls = set(url for peer, url in self.retrieving.values())
+        picked = []
+        for request in requests:
+            if inflight >= limit:
+                break
+            url = transfer.containerUrl(request.url)
+            if (request.id in self.retrieving or url in urls or
+                perpeer[request.peer_id] >= self.peerdownloads):
+                continue
+            picked.append(request)
+            inflight += 1
+            perpeer[request.peer_id] += 1
+            urls.add(url)
+        return picked
+
+    def _startRetrieval(self, request):
+        """
+        Retrieve one offer on the worker pool.  A container we already hold is taken out of
+        the working set, then patched or downloaded again; otherwise a new container is made
+        for the offer.  Everything the download needs from the database is looked up here,
+        on the reactor thread.
+
+        @return: a Deferred firing once the retrieval has been handled by L{_fetched}
+        @rtype: C{twisted.internet.defer.Deferred}
+        """
+        self.logger.log('offer: %r' % request)
+        url = transfer.containerUrl(request.url)
+        container = self._heldContainer(url)
+        transport = None
+        loaded = False
+        if container is not None:
+            loaded = container in self.containers or container in self.demoted
+            if loaded:
+                self._unloadcontainer(container)
+            container.container_type = eval(container.container_type_name)
+            transport = request.peer.transport
+        else:
+            container = self.container(self.config.owner, self.config, url=url, foreign=True,
+                                       creator=request.peer)
+            # do not initialize the version info yet
+        self.logger.log('Retrieving %s to %s' % (request.url, container.filename))
+        self.retrieving[request.id] = (request.peer_id, url)
+        d = self.workers.run(self._fetch, container.container_type, request.url,
+                             container.filename, transport, self.config.owner.name)
+        d.addBoth(self._fetched, request, container, transport is not None, loaded)
+        return d
+
+    def _fetch(self, container_type, url, filename, transport, ownername):
+        """
+        Bring the container offered at C{url} into C{filename} and load it to check it.  When
+        we already hold the container, the peer is first asked for just what changed; see
+        L{_patch}.  The work is done on a copy beside C{filename}, which replaces it only once
+        the copy has loaded, so a failed retrieval leaves the copy we hold as it was.  Blocks;
+        run on a worker thread, so it must not touch the database.
+
+        @param transport: call proxy to the offering peer when we hold the container, or
+                          C{None} to download it whole
+
+        @return: the loaded contents of the container
+        """
+        fd, partial = tempfile.mkstemp(prefix=path.basename(filename) + '.', suffix='.part',
+                                       dir=path.dirname(filename))
+        os.close(fd)
+        try:
+            contents = None
+            if transport is not None and path.exists(filename):
+                shutil.copyfile(filename, partial)
+                contents = self._patch(container_type, transport.containerDelta, ownername,
+                                       transfer.containerUrl(url), partial)
+            if contents is None:
+                (fname, headers) = self.urlretrieve(url, partial, self._retrieve_progress)
+                self.logger.log('Finished downloading %s to %s.' % (url, fname))
+                contents = container_type.load(partial)
+            contents.close()
+            os.rename(partial, filename)
+        except:
+            if path.exists(partial):
+                os.remove(partial)
+            raise
+        return container_type.load(filename)
+
+    def _patch(self, container_type, containerDelta, ownername, url, filename):
+        """
+        Load the copy of a container we hold at C{filename} and patch it in place with what
+        its creator says has changed since our copy's generation.  Blocks; run on a worker
+        thread.
+
+        @param filename: a scratch copy of the container, see L{_fetch}
+
+        @return: the patched contents of the container, or C{None} if it was not patched
+                 and has to be downloaded whole
+        """
+        try:
+            contents = container_type.load(filename)
+        except (ValueError, IOError), error:
+            self.logger.log('Error loading %s %s: %s' % (self.cname, filename, error))
+            return None
+        try:
+            if hasattr(contents, 'patch'):
+                since = contents.generation
+                delta = containerDelta(ownername, url, self.cname, since)
+                if isinstance(delta, dict):
+                    delta['data'] = delta['data'].data
+                    contents.patch(delta)
+                    msg = 'patched %s %s from generation %s to %s: %d blocks of %d changed'
+                    self.logger.log(msg % (self.cname, filename, since, contents.generation,
+                                           len(delta['indexes']),
+                                           -(-delta['length'] // delta['blocksize'])))
+                    return contents
+        except (ValueError, IOError, zlib.error, xmlrpclib.Error, socket.error), error:
+            msg = 'Error patching %s %s from url %r: %r'
+            self.logger.log(msg % (self.cname, filename, url, error))
+        contents.close()
+        return None
+
+    def _fetched(self, result, request, container, held, loaded):
+        """
+        Back on the reactor thread once a retrieval is done: store the container and, if a
+        slot can be made available, put it in the working set, then start retrieving more
+        offers.  A container we held in the working set whose retrieval failed is put back.
+
+        @param held: whether we already held the container before this offer
+        @param loaded: whether the container we held was in the working set
+        """
+        del self.retrieving[request.id]
+        try:
+            if isinstance(result, Failure):
+                msg = 'Error retrieving %s from url %r (offered by peer %r): %s'
+                self.logger.log(msg % (self.cname, request.url, request.peer,
+                                       result.getErrorMessage()))
+                request.state = 'done'
+                self.session.add(request)
+                self.session.commit()
+                if loaded:
+                    container.load()
+                    self._placeContainer(container, loaded)
+            else:
+                container._container = result
+                container.maxcapacity = result.maxcapacity
+                if not held:
+                    # now initialize the version info that we retrieved from the container
+                    siginfo = result.siginfo
+                    container.scannervv, container.sigversion, container.sigdate = siginfo
                 request.state = 'done'
                 self.session.add(request)
                 self.session.add(container)
                 self.session.commit()
+                self._placeContainer(container, loaded or not held)
+        except:
+            self.logger.exception()
+        self.retrieveContainer()
 
-                if len(self.containers) + 1 >= self.loadlimit:
-                    self._unloadone()
-
-                if len(self.containers) + 1 < self.loadlimit:
-                    msg = '%s slot available, putting %s in working set'
-                    self.logger.log(msg % (self.cname, self.cname))
-                    self.containers.append(container)
-                else:
-                    msg = 'no %s slot available, unloading %s'
-                    self.logger.log(msg % (self.cname, self.cname))
-                    container.unload()  # make extra sure that gets unloaded
-            except:
-                self.logger.exception()
-                raise
+    def _placeContainer(self, container, wanted):
+        """
+        Put a retrieved container in the working set if it is C{wanted} there and fits in
+        it, evicting the weakest containers to make room, and unload it otherwise.
+        """
+        if wanted and self.workingset.fits(self._cost(container)):
+            msg = '%s room available, putting %s in working set'
+            self.logger.log(msg % (self.cname, self.cname))
+            self._loadcontainer(container)
+        else:
+            msg = 'no %s room available, unloading %s'
+            self.logger.log(msg % (self.cname, self.cname))
+            container.unload()  # make extra sure that gets unloaded
+
+    def _heldContainer(self, url):
+        """
+        The foreign container we already hold from C{url}, if any.
+        """
+        return self.session.query(self.container)\
+                           .filter(self.container.owner == self.config.owner)\
+                           .filter(self.container.creator != self.config.owner)\
+                           .filter(self.container.url == url)\
+                           .first()
 
     def search(self, url, size, contenthash, aggregate=False):
         """
@@ -367,20 +688,31 @@ class ScanResultContainerManager(ContainerManager):
         """
         msg = 'searching %s for url %r (size: %r, hash: %r)'
         self.logger.log(msg % (self.cname, url, size, contenthash))
-        urlobject = UrlObject(url, size, contenthash)
+        urlobject = UrlObject(url, size, hash=contenthash)
 
         results = []
-        self.logger.log('containers to search: %s' % len(self.containers))
-        for container in self.containers:
+        msg = 'containers to search: %s, %s demoted'
+        self.logger.log(msg % (len(self.containers), len(self.demoted)))
+        # One probe of the index answers for every indexed container at once; only
+        # containers the index cannot hold are asked individually.
+        candidates = set()
+        if self.index is not None:
+            candidates = self.index.candidates(urlobject)
+            msg = 'index: %d candidates among %d indexed %ss'
+            self.logger.log(msg % (len(candidates), len(self.index), self.cname))
+        hit = []
+        for container in list(self.containers) + list(self.demoted):
             if container.tainted:
                 # container is no good, throw it out
-                self.containers.remove(container)
-                container.unload()
+                self._unloadcontainer(container)
                 self.logger.log('unloaded tainted %s %r' % (self.cname, (container,)))
                 continue
-            # TODO: maybe log the filepath?
-            self.logger.log('calling container.get on urlobject %s' % urlobject)
-            found = container.get(urlobject)
+            if self.index is not None and container in self.index:
+                found = container in candidates
+            else:
+                # TODO: maybe log the filepath?
+                self.logger.log('calling container.get on urlobject %s' % urlobject)
+                found = container.get(urlobject)
             # Because found might be a Safety object or a boolean, use a tuple
             # to print it to the log file.
             self.logger.log('result: found=%s' % (found,))
@@ -397,7 +729,10 @@ class ScanResultContainerManager(ContainerManager):
                 results.append(SearchResult(urlobject, container, found))
                 container.hits += 1
                 self.session.add(container)
+                hit.append(container)
         self.session.commit()
+        for container in hit:
+            self._hit(container)
         rv = results
         if aggregate:
             try:
@@ -444,44 +779,67 @@ class DigestManager(ScanResultContainerManager):
         """
         super(DigestManager, self).__init__(config, session, ScanDigestFile)
         self.added_property_name = 'digested'
+        self.sending = set()
+        # Made now, so that the scan log manager waits for our first update.
+        self._feedCursor()
+        self.session.commit()
 
-    def _findScans(self):
-        # Nota Bene: this query does not go in with the others in model/__init__.py b/c
-        # it needs specific values for digested and type, different from the other Scans
-        # query.
-        # TODO: learn enough about the return value to see if it can be filtered
-        # yet again, and add required filtering.
-        return self.session.query(Scan)\
-                           .filter(Scan.owner==self.config.owner)\
-                           .filter(Scan.digested!=True)\
-                           .filter(Scan.type=='local')\
-                           .order_by(Scan.timestamp)\
-                           .all()
+    def _createoptions(self):
+        """
+        Make our digests with the filter backend of C{config.container_manager.digest_backend},
+        saved in the file format of C{config.container_manager.digest_format}.
+        """
+        manager = self.config.container_manager
+        return {'backend': getattr(manager, 'digest_backend', 'scalable'),
+                'fileformat': getattr(manager, 'digest_format', 'scalable')}
 
     def performRequestedScan(self):
         """
-        Recurring job: perform a scan that a peer has requested and return the result to them,
-        as well as storing the result in our database for future reference.
+        Recurring job: perform scans that peers have requested and return the results to them,
+        as well as storing the results in our database for future reference.
+
+        Requests are taken nearest peer first, a batch's worth for each idle worker of the scan
+        executor (and one if none is idle), and their files scanned in batches (see
+        L{scanexecutor.ScanBatcher}) at their peer's priority (see
+        L{scanexecutor.ScanExecutor}), so that they never hold up the local proxy's scans; the
+        rest wait for a later run.  Results are sent batched with the other results for the
+        same peer (see L{peerrpc.CallBatcher}).  Requests being scanned or whose result is on
+        its way are not picked again.
         """
         try:
-            request = requestQuery(self.session, self.config)\
+            query = requestQuery(self.session, self.config)\
                                 .filter(QueuedRequest.type=='active-scan')\
-                                .filter(QueuedRequest.state!='done')\
-                                .first()
-            if not request:
+                                .filter(QueuedRequest.state!='done')
+            if self.sending:
+                query = query.filter(~QueuedRequest.id.in_(list(self.sending)))
+            executor = scanexecutor.getExecutor(self.config)
+            batchsize = int(self.config.scanning.scan_batch_size)
+            requests = query.add_columns(SocialRelationship.pdistance)\
+                            .limit(max(1, executor.idle) * batchsize)\
+                            .all()
+            if not requests:
                 #self.logger.log('no scans requested')
                 return #nothing to do
-            self.logger.log('Performing a requested scan')
-            peer = request.peer
-            self.logger.log('handling request %r' % request)
-
-            wasprocessed = request.state == 'processed'
-            done = request.state == 'done'
+            for request, distance in requests:
+                self.sending.add(request.id)
+                self._performRequest(request, distance)
+        except:
+            self.logger.exception()
+            raise
 
-            if not wasprocessed and not done:
+    @defer.inlineCallbacks
+    def _performRequest(self, request, distance):
+        """
+        Scan a request picked by L{performRequestedScan}, unless it was scanned already, and
+        send the result to the peer who requested it.
+        """
+        try:
+            self.logger.log('handling request %r' % request)
+            if request.state != 'processed':
                 self.logger.log('request unprocessed, sending to scanner')
-                scanner = scanning.ScannableRequest(self.config, self.session, parentrequest=request)
-                scan = scanner.localscan
+                scanner = scanning.ScannableRequest(self.config, self.session,
+                                                    parentrequest=request, distance=distance)
+                scan = yield scanner.deferLocalscan(batched=True)
                 request.scan = scan
                 request.state = 'processed'
             else:
@@ -492,37 +850,44 @@ class DigestManager(ScanResultContainerManager):
                     request.state = 'done'
                     self.session.add(request)
                     self.session.commit()
+                    self.sending.discard(request.id)
                     return
 
             self.logger.log('sending result to peer who requested it')
-            #retries = int(self.config.scanning.max_active_retries)
-            successful = False
-            #while retries > 0 and not successful:
-            try:
-                result = peer.transport.scanResult(self.config.owner.name, request.url,
-                                        scan.hash, request.key, scan.malicious, scan.scannervv,
-                                        scan.sigversion, time.mktime(scan.sigdate.timetuple()))
-            except:
-                self.logger.exception()
-            else:
-                if result == 'success':
-                    self.logger.log('send successful, marking request done')
-                    request.state = 'done'
-                    successful = True
-                else:
-                    msg = 'send unsuccessful, peer responded with non-success response %r'
-                    self.logger.log(msg % result)
-            #    retries -= 1
-
-            if wasprocessed and successful:
-                request.state = 'done'
-
             self.session.add(request)
             self.session.commit()
-            self.logger.log('done')
+            batcher = peerrpc.getBatcher('scanResults', 'scanResult', (self.config.owner.name,),
+                                         **util.batchOptions(self.config))
+            d = batcher.add(request.peer, request.url, scan.hash, request.key, scan.malicious,
+                            scan.scannervv, scan.sigversion,
+                            time.mktime(scan.sigdate.timetuple()))
+            d.addBoth(self._resultSent, request)
+        except ScanQueueFullError:
+            self.logger.log('no room to scan %r now, leaving it for later' % request)
+            self.sending.discard(request.id)
+        except:
+            self.logger.exception()
+            self.sending.discard(request.id)
+
+    def _resultSent(self, result, request):
+        """
+        Mark a requested scan done once its result has reached the peer who requested it.
+        """
+        self.sending.discard(request.id)
+        try:
+            if isinstance(result, Failure):
+                self.logger.log('sending result of %r failed: %s' %
+                                (request, result.getErrorMessage()))
+            elif result == 'success':
+                self.logger.log('send successful, marking request done')
+                request.state = 'done'
+                self.session.add(request)
+                self.session.commit()
+            else:
+                msg = 'send unsuccessful, peer responded with non-success response %r'
+                self.logger.log(msg % result)
         except:
             self.logger.exception()
-            raise
 
     def _initJobs(self):
         """
@@ -549,17 +914,20 @@ class ScanLogManager(ScanResultContainerManager):
         super(ScanLogManager, self).__init__(config, session, ScanLogFile)
         self.added_property_name = 'logged'
 
-    def _findScans(self):
-        # Nota Bene: this query does not go in with the others in model/__init__.py b/c
-        # it needs specific values for digested, type, and logged different from the other Scans
-        # query.
-        # TODO: learn enough about the return value to see if it can be filtered
-        # yet again, and add required filtering.
-        return self.session.query(Scan)\
-                           .filter(Scan.owner==self.config.owner)\
-                           .filter(Scan.digested==True)\
-                           .filter(Scan.logged!=True)\
-                           .filter(Scan.type=='local')\
-                           .order_by(Scan.timestamp)\
-                           .all()
+    def _createoptions(self):
+        """
+        Make our scan logs with the storage backend of C{config.container_manager.log_store}.
+        """
+        return {'storetype': getattr(self.config.container_manager, 'log_store', 'dbm')}
+
+    def _feedLimit(self):
+        """
+        Scans are logged only once they have been digested: read no further than the digest
+        manager has.  Without a digest manager's cursor, as on a peer which makes no digests,
+        the feed is read to its end.
+        """
+        return self.session.query(FeedCursor.position)\
+                           .filter(FeedCursor.owner==self.config.owner)\
+                           .filter(FeedCursor.name==ScanDigestFile.__name__.lower())\
+                           .scalar()
 
@@ -37,7 +37,7 @@ class ScanDigest(Digest):
     @type nonce: C{int}
 
     @ivar filterS: Bloom filter representing "scanned" portion of data.
-    @type filterS: C{ScalableBloomFilter}
+    @type filterS: C{ScalableBloomFilter} or L{StoredFilter}
 
     @ivar maxcapacity: maximum number of scans to store in this digest.
     @type maxcapacity: C{int}
@@ -57,36 +57,34 @@ class ScanDigest(Digest):
     #                int: time.mktime(self.siginfo.sigdate.timetuple())
     transformer = struct.Struct('<III50p50pI')
 
-    def __init__(self, maxcapacity, siginfo, filename, filterS=None, nonce=None):
+    def __init__(self, maxcapacity, siginfo, filename, filterS=None, nonce=None, backend=None,
+                 fileformat=None):
         """
         @param filterS: object to use as filterS if not None. if None, a new filter will be created.
-        @type filterS: C{ScalableBloomFilter} or C{None}
+        @type filterS: C{ScalableBloomFilter}, L{StoredFilter} or C{None}
 
         @param nonce: if not None, the nonce to use. When None, a new one will be generated.
         @type nonce: C{int}
+
+        @param backend: backend of the new filter; see L{Digest.backend}
+        @type backend: C{str}
+
+        @param fileformat: how to save the filters; see L{Digest.fileformat}
+        @type fileformat: C{str}
         """
-        super(ScanDigest, self).__init__(maxcapacity, siginfo, filename, filterS, nonce)
+        super(ScanDigest, self).__init__(maxcapacity, siginfo, filename, filterS, nonce,
+                                         backend, fileformat)
         self.siginfo = siginfo
 
 
-    # TODO: should we be saving self.hits as well?
-    def save(self):
+    def _packheader(self):
         """
-        Write the filters for this digest to a seekable file-like object.
-        Based off of the equivalent method in ScalableBloomFilter.  This
-        overrides the base class method so the packing can use the siginfo.
+        This overrides the base class method so the packing can use the siginfo.
         """
-        if not self.saved:
-            now = time.time()
-            with open(self.filename, "wb") as f:
-                f.write(self.transformer.pack(self.nonce, self.maxcapacity,
-                                              self.urlcount,
-                                              str(self.siginfo.scannervv),
-                                              str(self.siginfo.sigversion),
-                                              int(time.mktime(self.siginfo.sigdate.timetuple()))))
-                self.filterS.tofile(f)
-            self.saved = True
-            self.verify_save(now)
+        return self.transformer.pack(self.nonce, self.maxcapacity, self.urlcount,
+                                     str(self.siginfo.scannervv),
+                                     str(self.siginfo.sigversion),
+                                     int(time.mktime(self.siginfo.sigdate.timetuple())))
 
 
     @classmethod
@@ -94,7 +92,6 @@ class ScanDigest(Digest):
         """
         This overrides the base class method to unpack using the siginfo.
         """
-        #import pdb; pdb.set_trace()
         t = cls.transformer
         size = t.size
         with open(filename, "rb") as serialized_digest:
@@ -108,7 +105,7 @@ class ScanDigest(Digest):
             # Read the datetime as non-utc, since that's how we wrote it with mktime.
             siginfo = SigInfo(scannervv, sigversion,
                               datetime.datetime.fromtimestamp(sigtimestamp))
-            filterS = ScalableBloomFilter.fromfile(serialized_digest)
+            filterS = cls._readfilter(serialized_digest, filename)
         scandigest = cls(maxcapacity, siginfo, filename, filterS=filterS, nonce=nonce)
         scandigest.urlcount = urlcount
         return scandigest
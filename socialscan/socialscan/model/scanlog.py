@@ -4,7 +4,6 @@ ScanLog implementation details.
 """
 
 # Python standard libraries
-import anydbm
 import os
 
 from datetime import datetime
@@ -16,6 +15,7 @@ from os import path
 from f3ds.framework.log import Logger
 from f3ds.framework.exceptions import ContainerFullError
 from f3ds.framework.model.log import Log
+from f3ds.framework.model.logstore import openstore
 from socialscan.config import loadDefaultConfig
 from socialscan.util import Safety, SigInfo
 
@@ -44,7 +44,7 @@ class ScanLog(Log):
     logger = Logger('ScanLog')
     bool_string_map = {'1': True, '0': False}
 
-    def __init__(self, maxcapacity, siginfo, dbpath):
+    def __init__(self, maxcapacity, siginfo, dbpath, storetype=None):
         """
         @param maxcapacity: maximum capacity of ScanLog.  Should be the same as the
                             corresponding ScanDigest's maxcapacity.
@@ -54,10 +54,14 @@ class ScanLog(Log):
                         ScanDigest's siginfo.
         @type siginfo: L{SigInfo}
 
-        @param db: database containing url/content hash keys and maliciousness values
-        @type db: L{anydbm} database
+        @param dbpath: file of the storage containing url/content hash keys and
+                       maliciousness values
+        @type dbpath: C{str}
+
+        @param storetype: storage backend of a new log; see L{Log.storetype}
+        @type storetype: C{str}
         """
-        super(ScanLog, self).__init__(maxcapacity, siginfo, dbpath)
+        super(ScanLog, self).__init__(maxcapacity, siginfo, dbpath, storetype)
         self.siginfo = siginfo
         self.metadata_keys = ['maxcapacity', 'scannervv', 'sigversion', 'sigtimestamp', 'urlcount']
         # Save metadata after setting it.
@@ -73,9 +77,12 @@ class ScanLog(Log):
         malicious = True
         if not urlobject:
             return None
-        for key in [urlobject.url, urlobject.contenthash]:
-            if key in self.db:
-                (confident, malicious) = (True, self.bool_string_map[self.db[key]])
+        for key in [urlobject.rawurl, urlobject.rawcontenthash]:
+            if not key:
+                continue
+            value = self.db.lookup(key)
+            if value is not None:
+                (confident, malicious) = (True, self.bool_string_map[value])
             if confident:
                 break
         return Safety(confident, malicious) if confident else None
@@ -90,35 +97,36 @@ class ScanLog(Log):
             raise ContainerFullError
 
         self.saved = False
-        for key in [urlobject.url, urlobject.contenthash]:
+        for key in [urlobject.rawurl, urlobject.rawcontenthash]:
             if not key:
                 continue
-            self.db[key] = '1' if safety.ismalicious else '0'
+            self.db.put(key, '1' if safety.ismalicious else '0')
             added = True
         if added:
             self.urlcount += 1
         return added
 
     def _set_metadata(self):
-        self.db['maxcapacity'] = '%s' % self.maxcapacity
+        self.db.setmeta('maxcapacity', '%s' % self.maxcapacity)
         try:
-            self.db['scannervv'] = '%s' % self.siginfo.scannervv
-            self.db['sigversion'] = '%s' % self.siginfo.sigversion
+            self.db.setmeta('scannervv', '%s' % self.siginfo.scannervv)
+            self.db.setmeta('sigversion', '%s' % self.siginfo.sigversion)
             if not self.siginfo.sigdate:
                 # self.siginfo is a property; assign to self.sigdate instead.
                 self.sigdate = datetime.utcnow()
-                self.db['utc'] = 'True'
-            self.db['sigtimestamp'] = self._ignore_microseconds('%s' % self.siginfo.sigdate)
+                self.db.setmeta('utc', 'True')
+            sigtimestamp = self._ignore_microseconds('%s' % self.siginfo.sigdate)
+            self.db.setmeta('sigtimestamp', sigtimestamp)
         except:
-            self.db['scannervv'] = ''
-            self.db['sigversion'] = ''
+            self.db.setmeta('scannervv', '')
+            self.db.setmeta('sigversion', '')
             # self.siginfo is a property; assign to self.sigdate instead.
             self.sigdate = datetime.utcnow()
-            self.db['utc'] = 'True'
-            self.db['sigtimestamp'] = self._ignore_microseconds('%s' % self.sigdate)
-        self.db['urlcount'] = '%s' % self.urlcount
+            self.db.setmeta('utc', 'True')
+            self.db.setmeta('sigtimestamp', self._ignore_microseconds('%s' % self.sigdate))
+        self.db.setmeta('urlcount', '%s' % self.urlcount)
         if hasattr(self, 'hits'):
-            self.db['hits'] = '%s' % self.hits
+            self.db.setmeta('hits', '%s' % self.hits)
         self.saved = False
 
     def set_metadata(self, maxcapacity=None, siginfo=None):
@@ -133,9 +141,10 @@ class ScanLog(Log):
     @classmethod
     def load(cls, filepath):
         try:
-            db = anydbm.open(filepath, 'c')
-        except anydbm.error, e:
+            db = openstore(filepath, cls.storetype)
+        except Exception, e:
             ScanLog.logger.log(e)
+            raise
 
         now = datetime.utcnow()
         now = datetime(now.year, now.month, now.day, now.hour, now.minute, now.second, tzinfo=None)
@@ -146,9 +155,8 @@ class ScanLog(Log):
                     'urlcount': 0}
 
         for k in defaults:
-            if k in db:
-                defaults[k] = db[k]
-        if 'utc' in db:
+            defaults[k] = db.getmeta(k, defaults[k])
+        if db.hasmeta('utc'):
             dtconversion = datetime.utcfromtimestamp
         else:
             dtconversion = datetime.fromtimestamp
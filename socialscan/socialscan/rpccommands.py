@@ -2,6 +2,7 @@
 
 # Python standard library modules
 import datetime
+import xmlrpclib
 
 # 3rd party modules
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
@@ -19,9 +20,15 @@ class BaseRPCCommands(xmlrpc.XMLRPC):
     """
     allowNone = True
     useDateTime = True
-    def __init__(self, config, session):
+    def __init__(self, config, session, managers=None):
+        """
+        @param managers: the container managers whose containers peers may ask about, by
+                         the lower-case container class name peers are offered them under
+        @type managers: C{dict} of L{ContainerManager}
+        """
         self.session = session
         self.config = config
+        self.managers = managers or {}
         self.logger = Logger("BaseRPCFunctions")
 
     def _getpeer(self, peername, action):
@@ -57,6 +64,28 @@ class BaseRPCCommands(xmlrpc.XMLRPC):
             self.logger.exception()
             return "exception"
 
+    def xmlrpc_containerDelta(self, peername, url, name, generation):
+        """
+        Called by a peer holding a copy of one of our containers, at C{generation}, that we
+        offered again.  Answers with what changed since, for the peer to patch its copy with;
+        see L{f3ds.framework.model.digest.Digest.delta}.  C{None} means the peer has to
+        download the whole container.
+        """
+        try:
+            peer = self._getpeer(peername, "asked for changes to %s %s" % (name, url))
+            if not peer:
+                return "peer not known"
+
+            manager = self.managers.get(name)
+            delta = manager.containerDelta(url, generation) if manager else None
+            if delta is None:
+                return None
+            delta['data'] = xmlrpclib.Binary(delta['data'])
+            return delta
+        except:
+            self.logger.exception()
+            return "exception"
+
     def xmlrpc_digestOffer(self, peername, url):
         """
         Called by a peer to offer a digest. Stores the offer so that a worker
@@ -142,8 +171,8 @@ class SocialScanRPCCommands(BaseRPCCommands):
     """
     SocialScan RPC functions that are offered to other peers.
     """
-    def __init__(self, config, session):
-        super(SocialScanRPCCommands, self).__init__(config, session)
+    def __init__(self, config, session, managers=None):
+        super(SocialScanRPCCommands, self).__init__(config, session, managers)
         self.logger = Logger("RPCFunctions")
 
     def xmlrpc_scanlogOffer(self, peername, url):
@@ -159,17 +188,44 @@ class SocialScanRPCCommands(BaseRPCCommands):
             if not peer:
                 return "peer not known"
 
-            request = QueuedRequest(self.config.owner, "active-scan", peer,
-                                    url, key=key)
-            self.session.add(request)
+            self._queueScanRequest(peer, url, key)
             self.session.commit()
-
-            self.logger.log("Scan request %r: %r" % (key, request))
             return "success"
         except:
             self.logger.exception()
             return "exception"
 
+    def xmlrpc_scanRequests(self, peername, requests):
+        """
+        Called by a peer to request scans of several urls at once; the batch version of
+        L{xmlrpc_scanRequest}.  All the requests are stored in one transaction.
+
+        @param requests: C{[url, key]} of each scan requested
+        @return: C{"success"} for each request, or C{"peer not known"} or C{"exception"}
+                 for all of them
+        """
+        try:
+            peer = self._getpeer(peername, "requested scans of %d urls" % len(requests))
+            if not peer:
+                return "peer not known"
+
+            for url, key in requests:
+                self._queueScanRequest(peer, url, key)
+            self.session.commit()
+            return ["success"] * len(requests)
+        except:
+            self.session.rollback()
+            self.logger.exception()
+            return "exception"
+
+    def _queueScanRequest(self, peer, url, key):
+        """
+        Store a scan request from C{peer}; does not commit the session.
+        """
+        request = QueuedRequest(self.config.owner, "active-scan", peer, url, key=key)
+        self.session.add(request)
+        self.logger.log("Scan request %r: %r" % (key, request))
+
     def xmlrpc_scanResult(self, peername, url, hash, key, malicious,
                           scannervv, sigversion, sigdatestr):
         try:
@@ -177,29 +233,60 @@ class SocialScanRPCCommands(BaseRPCCommands):
             if not peer:
                 return "peer not known"
 
-            request = self.session.query(SentScanRequest).\
-                        filter(SentScanRequest.owner == self.config.owner).\
-                        filter(SentScanRequest.key == key).\
-                        filter(SentScanRequest.peer == peer).\
-                        filter(SentScanRequest.url == url).first()
-            if not request:
-                self.log("Peer %r attempted to return a scan result for "
-                            "url %r with key %r, but no such scan was requested"
-                            % (peer, url, key))
-                return "no such request"
+            result = self._storeScanResult(peer, url, hash, key, malicious,
+                                           scannervv, sigversion, sigdatestr)
+            self.session.commit()
+            return result
+        except:
+            self.logger.exception()
+            return "exception"
 
-            sigdate = datetime.datetime.utcfromtimestamp(int(sigdatestr))
+    def xmlrpc_scanResults(self, peername, results):
+        """
+        Called by a peer to return the results of several scans at once; the batch version
+        of L{xmlrpc_scanResult}.  All the results are stored in one transaction.
 
-            hash = hash or None  # if the hash is empty or similar, replace with None
+        @param results: the arguments of L{xmlrpc_scanResult} after C{peername}, for each
+                        scan
+        @return: C{"success"} or C{"no such request"} for each result, or
+                 C{"peer not known"} or C{"exception"} for all of them
+        """
+        try:
+            peer = self._getpeer(peername, "returned scans of %d urls" % len(results))
+            if not peer:
+                return "peer not known"
 
-            scan = Scan(self.config.owner, "social-active", url, malicious,
-                        siginfo=SigInfo(scannervv, sigversion, sigdate),
-                        hash=hash, sentrequest=request, peer=peer)
-            self.session.add(scan)
+            answers = [self._storeScanResult(peer, *result) for result in results]
             self.session.commit()
-            self.logger.log("Scan result %r: %r" % (key, scan))
-            return "success"
+            return answers
         except:
+            self.session.rollback()
             self.logger.exception()
             return "exception"
 
+    def _storeScanResult(self, peer, url, hash, key, malicious,
+                         scannervv, sigversion, sigdatestr):
+        """
+        Store the result of a scan C{peer} was asked for; does not commit the session.
+        """
+        request = self.session.query(SentScanRequest).\
+                    filter(SentScanRequest.owner == self.config.owner).\
+                    filter(SentScanRequest.key == key).\
+                    filter(SentScanRequest.peer == peer).\
+                    filter(SentScanRequest.url == url).first()
+        if not request:
+            self.logger.log("Peer %r attempted to return a scan result for "
+                            "url %r with key %r, but no such scan was requested"
+                            % (peer, url, key))
+            return "no such request"
+
+        sigdate = datetime.datetime.utcfromtimestamp(int(sigdatestr))
+
+        hash = hash or None  # if the hash is empty or similar, replace with None
+
+        scan = Scan(self.config.owner, "social-active", url, malicious,
+                    siginfo=SigInfo(scannervv, sigversion, sigdate),
+                    hash=hash, sentrequest=request, peer=peer)
+        self.session.add(scan)
+        self.logger.log("Scan result %r: %r" % (key, scan))
+        return "success"
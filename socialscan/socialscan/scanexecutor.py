@@ -0,0 +1,325 @@
+#!/usr/bin/python
+
+"""
+scanexecutor.py: runs local scans in parallel, most urgent first
+
+Classes: ScanExecutor, ScanBatcher, Latency
+"""
+
+# Python standard library modules
+import heapq
+import itertools
+import time
+
+# 3rd party modules
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+# Our modules
+from f3ds.framework.log import Logger
+from f3ds.framework.util import TimeMeasurer
+from f3ds.framework.workers import getPool
+from socialscan import scanhandlers
+from socialscan.exceptions import IncompleteScanError, ScanQueueFullError
+
+
+# Scans for the local proxy go ahead of any requested by peers.
+LOCAL = (0, 0.0)
+
+
+def peerPriority(distance):
+    """
+    The priority of a scan requested by a peer at social distance C{distance}: behind the
+    local proxy's scans, nearer peers first.
+    """
+    return (1, float(distance))
+
+
+class Latency(object):
+    """
+    Running latency figures of one scan handler, in seconds.
+
+    @ivar count: scans finished
+    @ivar wait: total time scans waited in the queue
+    @ivar scan: total time scans took once started
+    @ivar slowest: the longest a scan has taken once started
+    """
+    def __init__(self):
+        self.count = 0
+        self.wait = 0.0
+        self.scan = 0.0
+        self.slowest = 0.0
+
+    def add(self, wait, scan):
+        self.count += 1
+        self.wait += wait
+        self.scan += scan
+        self.slowest = max(self.slowest, scan)
+
+    def __str__(self):
+        if not self.count:
+            return 'no scans'
+        return '%d scans, %.3fs wait, %.3fs scan, %.3fs slowest' % \
+               (self.count, self.wait / self.count, self.scan / self.count, self.slowest)
+
+
+class ScanExecutor(object):
+    """
+    Runs local scans on C{workers} threads at once, taking waiting scans in priority order
+    (L{LOCAL}, then L{peerPriority}; first come first served within a priority).  The scanners
+    themselves run as processes of their own, so scans on different threads do run in
+    parallel.
+
+    At most C{maxqueue} scans wait.  Once that many do, a more urgent scan pushes out the least
+    urgent waiting one, and a scan no more urgent than any of them is turned away; either way
+    the scan left out fails with L{ScanQueueFullError}.  Callers which can put a scan off, such
+    as the digest manager with peers' requests, watch L{idle} and L{pressure} instead.
+
+    Everything but the scans themselves happens on the reactor thread.
+
+    @type queue: C{list}
+    @ivar queue: heap of waiting scans: C{(priority, sequence, name, enqueued, f, args, d)}
+
+    @type running: C{int}
+    @ivar running: scans running
+
+    @type rejected: C{int}
+    @ivar rejected: scans failed with L{ScanQueueFullError}
+
+    @type latency: C{dict}
+    @ivar latency: L{Latency} by scan handler name
+    """
+
+    def __init__(self, workers=4, maxqueue=64, reportinterval=60.0, pool=None, clock=time.time):
+        self.logger = Logger("ScanExecutor")
+        self.workers = workers
+        self.maxqueue = maxqueue
+        self.reportinterval = reportinterval
+        self.pool = pool if pool is not None else getPool('ScanExecutor', workers)
+        self.clock = clock
+        self.queue = []
+        self.running = 0
+        self.rejected = 0
+        self.latency = {}
+        self.lastreport = clock()
+        self._sequence = itertools.count()
+
+    @property
+    def idle(self):
+        """
+        Workers which would start a scan straight away.
+        """
+        return max(0, self.workers - self.running - len(self.queue))
+
+    @property
+    def pressure(self):
+        """
+        How loaded the executor is, from 0 (nothing running) to 1 (every worker busy and the
+        queue full).
+        """
+        return (self.running + len(self.queue)) / float(self.workers + self.maxqueue)
+
+    def accepts(self, priority):
+        """
+        Whether a scan at C{priority} would be run or queued now.
+        """
+        return self._room() or bool(self.queue) and priority < max(self.queue)[0]
+
+    def _room(self):
+        # Workers only sit idle while nothing waits.
+        return self.running < self.workers or len(self.queue) < self.maxqueue
+
+    def run(self, priority, name, f, *args):
+        """
+        Call C{f(*args)} on a worker once no more urgent scan is waiting.
+
+        @param priority: L{LOCAL} or a L{peerPriority}
+        @param name: the scan handler, for L{latency}
+        @return: a Deferred firing with the result of the call, or failing with what it
+                 raised or with L{ScanQueueFullError}
+        @rtype: C{twisted.internet.defer.Deferred}
+        """
+        d = defer.Deferred()
+        entry = (priority, next(self._sequence), name, self.clock(), f, args, d)
+        if self._room():
+            heapq.heappush(self.queue, entry)
+        elif self.accepts(priority):
+            worst = max(self.queue)
+            self.queue.remove(worst)
+            heapq.heapify(self.queue)
+            heapq.heappush(self.queue, entry)
+            self._reject(worst)
+        else:
+            self._reject(entry)
+        self._dispatch()
+        return d
+
+    def stats(self):
+        """
+        @return: queue depth, running scans, rejected scans and L{latency}
+        @rtype: C{dict}
+        """
+        return {'queued': len(self.queue), 'running': self.running,
+                'rejected': self.rejected, 'latency': dict(self.latency)}
+
+    def report(self):
+        """
+        Log L{stats}.
+        """
+        self.lastreport = self.clock()
+        self.logger.log('%d scans queued, %d running, %d rejected' %
+                        (len(self.queue), self.running, self.rejected))
+        for name, latency in sorted(self.latency.items()):
+            self.logger.log('handler %s: %s' % (name, latency))
+
+    def _reject(self, entry):
+        self.rejected += 1
+        self.logger.log('scan queue full, turning away a scan of priority %r' % (entry[0],))
+        entry[-1].errback(ScanQueueFullError())
+
+    def _dispatch(self):
+        while self.queue and self.running < self.workers:
+            priority, sequence, name, enqueued, f, args, d = heapq.heappop(self.queue)
+            self.running += 1
+            started = self.clock()
+            self.pool.run(f, *args).addBoth(self._finished, name, enqueued, started, d)
+
+    def _finished(self, result, name, enqueued, started, d):
+        self.running -= 1
+        now = self.clock()
+        self.latency.setdefault(name, Latency()).add(started - enqueued, now - started)
+        if now - self.lastreport >= self.reportinterval:
+            self.report()
+        self._dispatch()
+        if isinstance(result, Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+
+class _ScanBatch(object):
+    def __init__(self, priority):
+        self.priority = priority
+        self.files = []
+        self.waiting = []
+        self.timer = None
+
+
+class ScanBatcher(object):
+    """
+    Gathers the files given to scan within C{window} seconds of each other into one scan of
+    them all on the executor (see L{scanhandlers.scanMany}), so that handlers which can take
+    many files in one run start their scanner once for the lot.  The batch is run at the
+    priority of its most urgent file.
+
+    @ivar pending: the batch being gathered, if any
+    @type pending: L{_ScanBatch}
+    """
+
+    def __init__(self, executor, name, handler, window=0.2, maxsize=16, reactor=None):
+        """
+        @param name: the scan handler's name, for the executor's latency figures
+        @param handler: the scan handler (module or session)
+        @param window: seconds to wait for more files
+        @param maxsize: most files to scan in one batch; a full batch is scanned at once
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.executor = executor
+        self.name = name
+        self.handler = handler
+        self.window = window
+        self.maxsize = maxsize
+        self.reactor = reactor
+        self.pending = None
+
+    def add(self, priority, filepath):
+        """
+        Scan the file at C{filepath}, batched with the other files given meanwhile.  Call on
+        the reactor thread.
+
+        @return: a Deferred firing with malicious, siginfo and the file's share of the time the
+                 batch took in ms, or failing with what kept the file from being scanned
+        @rtype: C{twisted.internet.defer.Deferred}
+        """
+        batch = self.pending
+        if batch is None:
+            batch = self.pending = _ScanBatch(priority)
+            batch.timer = self.reactor.callLater(self.window, self.flush)
+        d = defer.Deferred()
+        batch.priority = min(batch.priority, priority)
+        batch.files.append(filepath)
+        batch.waiting.append(d)
+        if len(batch.files) >= self.maxsize:
+            self.flush()
+        return d
+
+    def flush(self):
+        """
+        Scan the batch gathered so far now.
+        """
+        batch, self.pending = self.pending, None
+        if batch is None:
+            return
+        if batch.timer.active():
+            batch.timer.cancel()
+        d = self.executor.run(batch.priority, self.name, self._scan, batch.files)
+        d.addBoth(self._scanned, batch)
+
+    def _scan(self, files):
+        """
+        Scan the batch.  Blocks; run on a worker thread.
+        """
+        with TimeMeasurer() as scan_timer:
+            results = scanhandlers.scanMany(self.handler, files)
+        return results, int(scan_timer.total * 1000.0 / len(files))
+
+    def _scanned(self, result, batch):
+        if isinstance(result, Failure):
+            for d in batch.waiting:
+                d.errback(result)
+            return
+        results, scantime = result
+        if len(results) != len(batch.waiting):
+            results = [IncompleteScanError('%d results for %d files' %
+                                           (len(results), len(batch.files)))] * len(batch.files)
+        for d, scanned in zip(batch.waiting, results):
+            if isinstance(scanned, Exception):
+                d.errback(Failure(scanned))
+            else:
+                malicious, siginfo = scanned
+                d.callback((malicious, siginfo, scantime))
+
+
+_executor = None
+
+
+def getExecutor(config):
+    """
+    The shared L{ScanExecutor}, sized by C{config.scanning} on first use.
+    """
+    global _executor
+    if _executor is None:
+        scanning = config.scanning
+        _executor = ScanExecutor(int(scanning.scan_workers), int(scanning.scan_queue_limit),
+                                 float(scanning.scan_report_interval))
+    return _executor
+
+
+_batchers = {}
+
+
+def getBatcher(config, handler):
+    """
+    The shared L{ScanBatcher} for C{handler}, the scan handler named by
+    C{config.scanning.handler}, sized by C{config.scanning} on first use.
+    """
+    name = config.scanning.handler
+    try:
+        return _batchers[name]
+    except KeyError:
+        scanning = config.scanning
+        batcher = _batchers[name] = ScanBatcher(getExecutor(config), name, handler,
+                                                float(scanning.scan_batch_window),
+                                                int(scanning.scan_batch_size))
+        return batcher
@@ -16,10 +16,26 @@ def scan(filename):
         if line.startswith("evil"):
             return True, getSigInfo()
     return False, getSigInfo()
+
+A handler may also keep its scanner running between scans, by providing a startDaemon() call
+taking no arguments and returning a daemon.ScannerDaemon; see session().
+
+A handler whose scanner can take many files in one run may provide a scan_many() call taking a
+list of filenames and returning a list with, for each file in turn, (malicious, siginfo) or the
+exception which kept it from being scanned; see scanMany().
+
+Finding the signature info can be slow, so callers use the handler's SigInfoCache (see
+sigInfoCache()).  A handler may help it with sigpaths, a list of the files or directories whose
+modification time changes when its signatures are updated, and loadSigInfo(), which finds the
+signature info afresh where getSigInfo() may cache it.
 """
+import atexit
 import os
+import threading
 from datetime import datetime
 
+from twisted.python import threadable
+
 _cache = {}
 def get(handler):
     try:
@@ -31,6 +47,140 @@ def get(handler):
         return module
 
 
+def scanMany(handler, filenames):
+    """
+    Scan several files with one call of the handler's scan_many(), or with its scan() for each
+    file if it has none.
+
+    @return: for each file in turn, (malicious, siginfo) or the exception scanning it raised
+    @rtype: C{list}
+    """
+    try:
+        scan_many = handler.scan_many
+    except AttributeError:
+        results = []
+        for filename in filenames:
+            try:
+                results.append(handler.scan(filename))
+            except Exception, e:
+                results.append(e)
+        return results
+    return scan_many(filenames)
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+def session(handler):
+    """
+    Get the handler's shared scanner daemon, started by its startDaemon() and stopped when
+    the process exits.  A handler without one is returned as it is; either way the result has
+    the handler's scan() and getSigInfo().
+    """
+    module = get(handler)
+    if not hasattr(module, 'startDaemon'):
+        return module
+    with _sessions_lock:
+        try:
+            return _sessions[handler]
+        except KeyError:
+            daemon = module.startDaemon()
+            atexit.register(daemon.stop)
+            _sessions[handler] = daemon
+            return daemon
+
+
+class SigInfoCache(object):
+    """
+    Keeps a handler's current SigInfo in memory.  It is found again only once the modification
+    time of one of the handler's sigpaths has changed or L{invalidate} has been called; a
+    handler without sigpaths is asked every time, as it has its own expiry.
+
+    Callables given to L{subscribe} are called with the new SigInfo whenever it changes, on
+    the reactor thread while the reactor runs, so nothing has to poll for new signatures.
+    """
+    def __init__(self, load, paths=None):
+        """
+        @param load: finds the current SigInfo
+        @param paths: files or directories to watch, or None to call load every time
+        """
+        self.load = load
+        self.paths = paths
+        self.siginfo = None
+        self.stamp = None
+        self.stale = True
+        self.listeners = []
+        self._lock = threading.Lock()
+
+    def getSigInfo(self):
+        with self._lock:
+            old = self.siginfo
+            if self.paths is not None:
+                stamp = self._stamp()
+                if not self.stale and stamp == self.stamp:
+                    return self.siginfo
+                # taken before loading, so that an update meanwhile is seen next time
+                self.stamp = stamp
+            self.stale = False
+            siginfo = self.siginfo = self.load()
+        if old is not None and siginfo != old:
+            self._notify(siginfo)
+        return siginfo
+
+    def invalidate(self):
+        """
+        Find the SigInfo again on the next L{getSigInfo}, as the signatures have been updated.
+        """
+        self.stale = True
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        self.listeners.remove(listener)
+
+    def _stamp(self):
+        stamp = []
+        for path in self.paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                stamp.append(None)
+            else:
+                stamp.append((st.st_mtime, st.st_size, st.st_ino))
+        return stamp
+
+    def _notify(self, siginfo):
+        from twisted.internet import reactor
+        for listener in list(self.listeners):
+            if reactor.running and not threadable.isInIOThread():
+                reactor.callFromThread(listener, siginfo)
+            else:
+                listener(siginfo)
+
+
+_sigcaches = {}
+_sigcaches_lock = threading.Lock()
+def sigInfoCache(handler):
+    """
+    Get the handler's shared L{SigInfoCache}.
+    """
+    module = get(handler)
+    with _sigcaches_lock:
+        try:
+            return _sigcaches[handler]
+        except KeyError:
+            load = getattr(module, 'loadSigInfo', module.getSigInfo)
+            cache = _sigcaches[handler] = SigInfoCache(load, getattr(module, 'sigpaths', None))
+            return cache
+
+
+def signaturesUpdated(handler):
+    """
+    Hook for whatever updates the handler's signatures: have its SigInfo found again.
+    """
+    sigInfoCache(handler).invalidate()
+
+
 # Some generic functions for determining the signature date from signature files.
 def getMostRecent(dirname, searchstring='', filterfunction=None):
     """
@@ -23,6 +23,7 @@ expiry = timedelta(hours=1)
 
 avira_dir = os.path.join('C:' + os.sep, 'Program Files (x86)', 'Avira', 'AntiVir Desktop')
 avira_bin = os.path.join(avira_dir, 'scancl')
+sigpaths = [avira_dir]
 
 scannervv_re = re.compile("Avira / Windows Version (.*)")
 engineversion_re = re.compile("engine set: (.*)")
@@ -78,14 +79,18 @@ def getVersionInfo():
     return scannervv, sigversion
 
 
+def loadSigInfo():
+    scannervv, sigversion = getVersionInfo()
+    sigdate = getSigDate(avira_dir, search='.vdf')
+    return SigInfo(scannervv, sigversion, sigdate)
+
+
 def getSigInfo():
     global cursiginfo
     global siginfotime
     now = datetime.now()
     if cursiginfo == None or now - siginfotime > expiry:
-        scannervv, sigversion = getVersionInfo()
-        sigdate = getSigDate(avira_dir, search='.vdf')
-        cursiginfo = SigInfo(scannervv, sigversion, sigdate)
+        cursiginfo = loadSigInfo()
         siginfotime = now
     return cursiginfo
 
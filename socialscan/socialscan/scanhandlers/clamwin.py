@@ -27,6 +27,7 @@ scannervv_re = re.compile("^Engine version: (.*)$")
 
 clamwin_bin = r'C:\Program Files (x86)\ClamWin\bin\clamscan.exe'
 clamwin_db = r'C:\ProgramData\.clamwin\db'
+sigpaths = [clamwin_db]
 
 def scan(filename):
     global cursiginfo
@@ -89,24 +90,29 @@ def getSigVersion():
     return '%s.%s.%s' % (main_cvd, daily_cld, bytecode_cld)
 
 
+def loadSigInfo():
+    global sigdate
+    global sigversion
+
+    i = None
+    sigdate = getSigDate(clamwin_db)
+    sigversion = getSigVersion()
+    info = SigInfo('%s Unknown Version' % ''.join(module_name), sigversion, sigdate)
+    with tempfile.NamedTemporaryFile() as tmp:
+        try:
+            r, i = scan(tmp.name)
+        except:
+            pass
+    return i if i else info
+
+
 def getSigInfo():
     global cursiginfo
     global siginfotime
-    global sigdate
-    global sigversion
 
     now = datetime.now()
     if cursiginfo == None or now - siginfotime > expiry:
-        i = None
-        sigdate = getSigDate(clamwin_db)
-        sigversion = getSigVersion()
-        info = SigInfo('%s Unknown Version' % ''.join(module_name), sigversion, sigdate)
-        with tempfile.NamedTemporaryFile() as tmp:
-            try:
-                r, i = scan(tmp.name)
-            except:
-                pass
-        cursiginfo = i if i else info
+        cursiginfo = loadSigInfo()
         siginfotime = now
     return cursiginfo
 
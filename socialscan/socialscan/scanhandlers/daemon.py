@@ -0,0 +1,272 @@
+"""
+Long-lived scanner sessions for scan handlers.
+
+A command-line scanner started once per file pays for its start-up and signature loading on
+every scan.  A handler which can talk to a scanner that stays running provides a
+C{startDaemon()} returning a L{ScannerDaemon} (see L{socialscan.scanhandlers.session}).  File
+paths are written to the process one per line, and its output is read back a line at a time
+until the handler's parser (L{ScannerDaemon.parse}) has the result.  A process which has been idle is
+pinged before it is used, and one which has died, stopped answering or answered with
+something unexpected is restarted and the scan retried.
+
+The reference implementation is the dummy handler's (L{socialscan.scanhandlers.dummy}).
+"""
+
+import Queue
+import subprocess
+import threading
+import time
+
+from f3ds.framework.log import Logger
+
+
+class ScannerDaemonError(Exception):
+    """
+    The scanner process died, did not answer in time or gave output that could not be parsed.
+    """
+
+
+class ScannerDaemon(object):
+    """
+    One long-lived scanner process, shared by the threads scanning files.  Scans are
+    serialized; it stands in for a handler module, offering the same C{scan()} and
+    C{getSigInfo()}.
+
+    Handlers give the command to run and the parser of its output, subclassing this to
+    override L{handshake} if the process prints a banner on start-up.
+
+    @type command: C{list}
+    @ivar command: the scanner's command line
+
+    @type parse: callable
+    @ivar parse: parses a line of output from a scan, called with the filename and the
+                 line.  Raises L{ScannerDaemonError} on output that does not make sense, to
+                 have the process restarted, and any other exception for a file that could
+                 not be scanned.  Returns C{(malicious, siginfo)} once the line completes the
+                 result, C{None} to read another line.
+
+    @type timeout: C{float}
+    @ivar timeout: seconds to wait for each line of output before giving up on the process
+
+    @type idle: C{float}
+    @ivar idle: seconds without a scan after which the process is pinged before the next one
+
+    @type retries: C{int}
+    @ivar retries: how many times a scan is retried on a restarted process before giving up
+
+    @type ping: C{str}
+    @ivar ping: line written to check the process is healthy; C{None} if it has no such
+                command, in which case only whether it is still running is checked
+
+    @type pong: C{str}
+    @ivar pong: the answer expected to L{ping}
+
+    @type restarts: C{int}
+    @ivar restarts: how many times the process has been restarted
+
+    @type siginfo: L{socialscan.util.SigInfo}
+    @ivar siginfo: the signature info of the last result, or that found by L{handshake}
+    """
+    timeout = 30.0
+    idle = 60.0
+    retries = 2
+    ping = 'PING\n'
+    pong = 'PONG'
+
+    def __init__(self, command, parse, env=None, timeout=None):
+        self.logger = Logger("ScannerDaemon")
+        self.command = command
+        self.parse = parse
+        self.env = env
+        if timeout is not None:
+            self.timeout = timeout
+        self.process = None
+        self.restarts = 0
+        self.siginfo = None
+        self.lastused = 0
+        self._started = False
+        self._lines = None
+        self._lock = threading.Lock()
+
+    def handshake(self):
+        """
+        Called once the process has started, to read whatever it prints before its first
+        request (and set L{siginfo} from it).  Does nothing by default.
+        """
+
+    def request(self, filename):
+        """
+        The input asking the process to scan filename.  By default, filename on a line.
+        """
+        return filename + '\n'
+
+    def scan(self, filename):
+        """
+        Scan filename, starting or restarting the process as needed.
+
+        @return: C{(malicious, siginfo)}
+        @raise ScannerDaemonError: if no process could scan the file
+        """
+        return self._retrying(filename, self._scan, filename)
+
+    def scan_many(self, filenames):
+        """
+        Scan the files, writing all their requests before reading any result so that the
+        process never waits on us between files.  Retried as a whole like L{scan}.
+
+        @return: for each file in turn, C{(malicious, siginfo)} or the exception which kept it
+                 from being scanned
+        @raise ScannerDaemonError: if no process could scan the files
+        """
+        return self._retrying('%d files' % len(filenames), self._scanMany, filenames)
+
+    def getSigInfo(self):
+        """
+        The signature info of the last result, starting the process if it has not given any.
+        """
+        with self._lock:
+            if self.siginfo is None:
+                self._ensure()
+        return self.siginfo
+
+    def alive(self):
+        """
+        Whether the process is running.
+        """
+        return self.process is not None and self.process.poll() is None
+
+    def check(self):
+        """
+        Health check: ping the process, and restart it if it is not running or does not
+        answer.
+
+        @return: whether the process was healthy
+        """
+        with self._lock:
+            return self._check()
+
+    def stop(self):
+        """
+        Stop the process, if it is running.
+        """
+        process, self.process = self.process, None
+        if process is None:
+            return
+        try:
+            process.stdin.close()
+        except (IOError, OSError):
+            pass
+        if process.poll() is None:
+            try:
+                process.kill()
+            except OSError:
+                pass
+        process.wait()
+
+    def _ensure(self):
+        if self.alive():
+            return
+        if self.process is not None:
+            self.logger.log("scanner %s exited with %s, restarting" %
+                            (self.command[0], self.process.returncode))
+            self.stop()
+        if self._started:
+            self.restarts += 1
+        self._started = True
+        self._start()
+
+    def _start(self):
+        try:
+            self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE, env=self.env)
+        except OSError, e:
+            raise ScannerDaemonError("could not start %s: %s" % (self.command[0], e))
+        # Read on a thread of its own so that waiting for an answer can time out.  Each
+        # process gets its own queue, so nothing a killed process said is read after it.
+        self._lines = Queue.Queue()
+        reader = threading.Thread(target=self._read, args=(self.process.stdout, self._lines))
+        reader.daemon = True
+        reader.start()
+        self.lastused = time.time()
+        try:
+            self.handshake()
+        except ScannerDaemonError:
+            self.stop()
+            raise
+
+    @staticmethod
+    def _read(stdout, lines):
+        for line in iter(stdout.readline, ''):
+            lines.put(line.rstrip('\r\n'))
+        lines.put(None)
+
+    def _readline(self):
+        try:
+            line = self._lines.get(timeout=self.timeout)
+        except Queue.Empty:
+            raise ScannerDaemonError("no answer in %ss" % self.timeout)
+        if line is None:
+            raise ScannerDaemonError("exited with %s" % self.process.wait())
+        return line
+
+    def _write(self, data):
+        try:
+            self.process.stdin.write(data)
+            self.process.stdin.flush()
+        except (IOError, OSError), e:
+            raise ScannerDaemonError("could not write to the scanner: %s" % e)
+
+    def _check(self):
+        if self.alive():
+            if self.ping is None:
+                return True
+            try:
+                self._write(self.ping)
+                answer = self._readline()
+                if answer == self.pong:
+                    self.lastused = time.time()
+                    return True
+                self.logger.log("scanner %s answered %r to a ping" % (self.command[0], answer))
+            except ScannerDaemonError, e:
+                self.logger.log("scanner %s failed a ping: %s" % (self.command[0], e))
+        self.stop()
+        self._ensure()
+        return False
+
+    def _retrying(self, what, scan, *args):
+        with self._lock:
+            for attempt in range(self.retries + 1):
+                try:
+                    self._ensure()
+                    if time.time() - self.lastused > self.idle:
+                        self._check()
+                    return scan(*args)
+                except ScannerDaemonError, e:
+                    self.logger.log("scanner %s failed on %s: %s" % (self.command[0], what, e))
+                    self.stop()
+            raise e
+
+    def _scan(self, filename):
+        self._write(self.request(filename))
+        return self._result(filename)
+
+    def _scanMany(self, filenames):
+        for filename in filenames:
+            self._write(self.request(filename))
+        results = []
+        for filename in filenames:
+            try:
+                results.append(self._result(filename))
+            except ScannerDaemonError:
+                raise
+            except Exception, e:
+                results.append(e)
+        return results
+
+    def _result(self, filename):
+        while True:
+            result = self.parse(filename, self._readline())
+            if result is not None:
+                self.siginfo = result[1]
+                self.lastused = time.time()
+                return result
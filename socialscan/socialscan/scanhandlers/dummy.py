@@ -1,10 +1,17 @@
 import datetime
+import os
+import sys
 import time
 
+from socialscan import scanhandlers
 from socialscan.util import SigInfo
+from socialscan.scanhandlers.daemon import ScannerDaemon, ScannerDaemonError
 
 
-def getSigInfo():
+sigpaths = ["data/dummy"]
+
+
+def _sigfields():
     try:
         reader = open("data/dummy")
         name, version, date = [x for x in reader.readlines() if x]
@@ -13,13 +20,98 @@ def getSigInfo():
             thetuple = ("data/dummy", "1.0", str(time.time()))
             name, version, date = thetuple
             open("data/dummy", "w").write("\n".join(thetuple))
+        else:
+            raise
+    return name.replace("\n", ""), version.replace("\n", ""), date.replace("\n", "")
+
+
+def _siginfo(name, version, date):
+    return SigInfo(name, version, datetime.datetime.fromtimestamp(float(date)))
+
 
-    return SigInfo(name.replace("\n", ""), version.replace("\n", ""),
-                   datetime.datetime.fromtimestamp(float(date)))
+def _isevil(filename):
+    with open(filename, "rb") as f:
+        for line in f:
+            if line.startswith("evil"):
+                return True
+    return False
+
+
+def loadSigInfo():
+    return _siginfo(*_sigfields())
+
+def getSigInfo():
+    return scanhandlers.sigInfoCache("dummy").getSigInfo()
 
 def scan(filename):
-    f = open(filename, "rb")
-    for line in f:
-        if line.startswith("evil"):
-            return True, getSigInfo()
-    return False, getSigInfo()
+    return _isevil(filename), getSigInfo()
+
+def scan_many(filenames):
+    siginfo = getSigInfo()
+    results = []
+    for filename in filenames:
+        try:
+            results.append((_isevil(filename), siginfo))
+        except IOError, e:
+            results.append(e)
+    return results
+
+
+def serve(stdin=sys.stdin, stdout=sys.stdout):
+    """
+    Reference scanner daemon, run by L{DummyDaemon}.  Tab separated lines out: READY and the
+    signature fields on start-up, then for each path read in, CLEAN or FOUND, the path and
+    the signature fields, or ERROR, the path and what went wrong.  PING is answered with PONG.
+    """
+    def send(*fields):
+        stdout.write("\t".join(fields) + "\n")
+        stdout.flush()
+
+    send("READY", *_sigfields())
+    for line in iter(stdin.readline, ""):
+        filename = line.rstrip("\r\n")
+        if filename == "PING":
+            send("PONG")
+            continue
+        try:
+            malicious = _isevil(filename)
+        except IOError, e:
+            send("ERROR", filename, str(e))
+            continue
+        send("FOUND" if malicious else "CLEAN", filename, *_sigfields())
+
+
+def _parse(filename, line):
+    """
+    Parse a line of L{serve}'s output from a scan of filename; see L{ScannerDaemon.parse}.
+    """
+    fields = line.split("\t")
+    if fields[0] == "ERROR" and len(fields) == 3:
+        raise IOError(fields[2])
+    if fields[0] not in ("CLEAN", "FOUND") or len(fields) != 5 or fields[1] != filename:
+        raise ScannerDaemonError("unexpected answer %r" % line)
+    return fields[0] == "FOUND", _siginfo(*fields[2:])
+
+
+class DummyDaemon(ScannerDaemon):
+    """
+    Client for L{serve}, run in a python subprocess.
+    """
+    def __init__(self, timeout=None):
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+        command = [sys.executable, "-u", "-m", "socialscan.scanhandlers.dummy"]
+        ScannerDaemon.__init__(self, command, _parse, env=env, timeout=timeout)
+
+    def handshake(self):
+        fields = self._readline().split("\t")
+        if fields[0] != "READY" or len(fields) != 4:
+            raise ScannerDaemonError("unexpected banner %r" % fields)
+        self.siginfo = _siginfo(*fields[1:])
+
+
+def startDaemon():
+    return DummyDaemon()
+
+
+if __name__ == "__main__":
+    serve()
@@ -12,8 +12,6 @@ __version__ = '0.1'
 # Python standard library modules
 import httplib
 import os
-import pickle
-import subprocess
 import sys
 import time
 import traceback
@@ -28,18 +26,14 @@ from datetime import datetime
 from twisted.internet import defer, reactor
 
 # Our modules
+from f3ds.framework import filehash, peerrpc, urlretrieve, workers
 from f3ds.framework.log import Logger
 from f3ds.framework.util import cached, TimeMeasurer
-from socialscan import scanhandlers
+from socialscan import scanexecutor, scanhandlers
 from socialscan.exceptions import IncompleteScanError
-from socialscan.model import Peer, Scan, SentScanRequest, ScanDigestFile, SocialRelationship
-from socialscan.util import Safety
-
-# __file__ is <source dir>/socialscan/socialscan/scanning.py
-# F3DS dir is <source dir>/f3ds/framework/
-dn = os.path.dirname
-f3dsdir = os.path.realpath(dn(dn(dn(__file__))))
-frameworkdir = os.path.join(f3dsdir, 'framework')
+from socialscan.model import (Peer, Scan, ScanFeedEntry, SentScanRequest, ScanDigestFile,
+                              SocialRelationship, urlHash)
+from socialscan.util import Safety, batchOptions
 
 
 class ScannableRequest(object):
@@ -65,13 +59,29 @@ class ScannableRequest(object):
 
     @type timeout: C{float}
     @ivar timeout: timeout to schedule when sleep() is called
+
+    @type workers: L{f3ds.framework.workers.WorkerPool}
+    @ivar workers: threads shared by all requests for the blocking parts of the Deferred
+                   stages (L{deferHeaders}, L{deferLocalscan}, L{deferActiveScans}).  The
+                   database session is only ever used from the reactor thread.
+
+    @type executor: L{socialscan.scanexecutor.ScanExecutor}
+    @ivar executor: runs the scan of L{deferLocalscan}, shared by all requests
+
+    @type priority: C{tuple}
+    @ivar priority: the priority of this request's scan in L{executor}: ahead of peers' for
+                    the local proxy's requests, by the requesting peer's social distance for
+                    a peer's (given as C{distance})
     """
     def __init__(self, config, session, url=None, parentrequest=None,
-                 digestmanager=None, scanlogmanager=None):
+                 digestmanager=None, scanlogmanager=None, distance=None):
         self.logger = Logger("Scanner")
         self.config = config
         self.session = session
-        self.handler = scanhandlers.get(config.scanning.handler)
+        if str(getattr(config.scanning, 'daemon', False)).lower() == "true":
+            self.handler = scanhandlers.session(config.scanning.handler)
+        else:
+            self.handler = scanhandlers.get(config.scanning.handler)
 
         if not url and not parentrequest:
             raise Exception("url or parentrequest must be provided!")
@@ -95,47 +105,118 @@ class ScannableRequest(object):
         self.contenthash = ''
         self.scan = None
         self.closepeers = []
+        self.downloadfailed = False
+        try:
+            maxthreads = int(self.config.scanning.blocking_threads)
+        except (AttributeError, ValueError):
+            maxthreads = 4
+        self.workers = workers.getPool('ScannableRequest', maxthreads)
+        self.executor = scanexecutor.getExecutor(config)
+        if parentrequest is None:
+            self.priority = scanexecutor.LOCAL
+        else:
+            self.priority = scanexecutor.peerPriority(distance or 0.0)
 
-    def sleep(self):
+    def sleep(self, seconds=None):
         """
-        @return: a twisted Deferred that will be called L{timeout} seconds after
-        this method is called
+        @return: a twisted Deferred that will be called C{seconds} (by default L{timeout})
+        seconds after this method is called
         @rtype: C{twisted.internet.defer.Deferred}
         """
+        if seconds is None:
+            seconds = self.timeout
         d = defer.Deferred()
-        reactor.callLater(self.timeout, d.callback, None)
+        reactor.callLater(seconds, d.callback, None)
         return d
 
+    def _downloadpath(self):
+        id = str(uuid.uuid4())
+        filepath = self.config.scanning.download_location.format(id=id)
+        if not os.path.exists(os.path.dirname(filepath)):
+            os.makedirs(os.path.dirname(filepath))
+        self.fileid = id
+        return filepath
+
+    def _retrieved(self, retrieval, retrievems):
+        """
+        Take in the results of a download, which already include the content hash and size.
+        """
+        self.downloaded_filepath = retrieval.filepath
+        self.headers = retrieval.headers
+        self.contenthash = retrieval.contenthash
+        self.downloaded_filesize = retrieval.filesize
+        self.retrievems = retrievems
+        self.logger.log('Got contenthash: %s' % self.contenthash)
+
     #@cached
     def retrieve(self):
         """
-        Retrieve the url via http and store it.
+        Retrieve the url via http and store it, hashing it while it is written.  Each connect
+        and read waits at most C{core.network_timeout} seconds, and a response with other
+        than a 2xx status or cut short of its Content-Length counts as a failed download.
         urllib warning: When opening HTTPS URLs, does not attempt to validate the server certificate.
         """
         self.logger.log('ScannableRequest.retrieve called')
         with TimeMeasurer() as retrieve_timer:
-            id = str(uuid.uuid4())
-            filepath = self.config.scanning.download_location.format(id=id)
-            if not os.path.exists(os.path.dirname(filepath)):
-                os.makedirs(os.path.dirname(filepath))
-            self.fileid = id
-            # grab file with a subprocess...
-            script_name = 'urlretrieve.py'
-            script_path = os.path.join(frameworkdir, script_name)
-            proc = subprocess.Popen(["python", script_path, self.url, filepath],
-                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            proc.wait()
-            if(proc.returncode != 0):
-                error = proc.stderr.readlines()
-                self.logger.log("Error downloading url %s for scanning: %s " % (self.url, error))
+            filepath = self._downloadpath()
+            try:
+                retrieval = urlretrieve.retrieve(self.url, filepath,
+                                                 timeout=float(self.config.core.network_timeout))
+            except IOError, e:
+                self.logger.log("Error downloading url %s for scanning: %s " % (self.url, e))
+                self.downloadfailed = True
                 raise IncompleteScanError
-            else:
-                lines = proc.stdout.readlines()
-                lines[:] = [l.strip() for l in lines]
-                filepath, headers = pickle.loads('\n'.join(lines))
-        self.downloaded_filepath = filepath
-        self.headers = dict(headers)
-        self.retrievems = int(retrieve_timer.total * 1000.0)  # time.time() uses seconds, not ms
+        # time.time() uses seconds, not ms
+        self._retrieved(retrieval, int(retrieve_timer.total * 1000.0))
+
+    def fetch(self):
+        """
+        Retrieve the url like L{retrieve}, without blocking the reactor.  The download is
+        cancelled if it has not finished within C{core.network_timeout} seconds, so that the
+        requests waiting on it are not held up by a server which stalls.
+
+        @return: a Deferred firing with L{filepath} once the file is written and hashed, or
+                 failing with L{IncompleteScanError}
+        @rtype: C{twisted.internet.defer.Deferred}
+        """
+        if self.downloaded_filepath:
+            return defer.succeed(self.downloaded_filepath)
+        self.logger.log('ScannableRequest.fetch called')
+        start = time.time()
+
+        def fetched(retrieval):
+            self._retrieved(retrieval, int((time.time() - start) * 1000.0))
+            return self.downloaded_filepath
+
+        def failed(failure):
+            msg = "Error downloading url %s for scanning: %s "
+            self.logger.log(msg % (self.url, failure.getErrorMessage()))
+            self.downloadfailed = True
+            raise IncompleteScanError
+
+        if self.downloadfailed:
+            return defer.fail(IncompleteScanError())
+        d = urlretrieve.fetch(self.url, self._downloadpath(),
+                              timeout=float(self.config.core.network_timeout))
+        d.addCallbacks(fetched, failed)
+        return d
+
+    def prepare(self):
+        """
+        Download and hash the file without blocking the reactor, so that L{filepath},
+        L{hash} and L{filesize} are at hand for the stages which need them.  A failed
+        download is not retried by those stages.
+
+        @return: a Deferred firing with L{filepath}, or C{''} if the download failed
+        @rtype: C{twisted.internet.defer.Deferred}
+        """
+        def failed(failure):
+            failure.trap(IncompleteScanError)
+            return ''
+
+        d = self.fetch()
+        d.addErrback(failed)
+        return d
 
     @property
     def filepath(self):
@@ -143,6 +224,8 @@ class ScannableRequest(object):
         Ensure we have downloaded the file when trying to use filepath.
         """
         if not self.downloaded_filepath:
+            if self.downloadfailed:
+                raise IncompleteScanError
             self.retrieve()
         return self.downloaded_filepath
 
@@ -151,14 +234,46 @@ class ScannableRequest(object):
         Retrieve the headers from the url via HTTP HEAD, if they are not already stored.
         """
         if not self.headers:
-            oururl = urlparse.urlparse(self.url)
-            if oururl.scheme == "http":
-                conn = httplib.HTTPConnection(oururl.netloc)
-            else:
-                conn = httplib.HTTPSConnection(oururl.netloc)
-            conn.request("HEAD", oururl.path)
-            response = conn.getresponse()
-            self.headers = dict(response.getheaders())
+            self.headers = self._headRequest()
+        self._useHeaders()
+
+    def _headRequest(self):
+        """
+        Ask for the headers of the url via HTTP HEAD.  Blocks; touches nothing but the url.
+        """
+        oururl = urlparse.urlparse(self.url)
+        if oururl.scheme == "http":
+            conn = httplib.HTTPConnection(oururl.netloc)
+        else:
+            conn = httplib.HTTPSConnection(oururl.netloc)
+        conn.request("HEAD", oururl.path)
+        response = conn.getresponse()
+        return dict(response.getheaders())
+
+    def deferHeaders(self):
+        """
+        L{retrieveHeaders} without blocking the reactor.
+
+        @return: a Deferred firing with L{headers}
+        @rtype: C{twisted.internet.defer.Deferred}
+        """
+        if self.headers:
+            self._useHeaders()
+            return defer.succeed(self.headers)
+
+        def gotHeaders(headers):
+            self.headers = headers
+            self._useHeaders()
+            return headers
+
+        d = self.workers.run(self._headRequest)
+        d.addCallback(gotHeaders)
+        return d
+
+    def _useHeaders(self):
+        """
+        Take the filesize and age from the headers, where they are not known yet.
+        """
         if self.downloaded_filesize < 0:
             try:
                 content_length = self.headers["content-length"]
@@ -214,7 +329,9 @@ class ScannableRequest(object):
         query = self.session.query(Scan)
         if owner:
             query = query.filter(Scan.owner==self.config.owner)
-        query = query.filter(Scan.url==self.url).filter(Scan.tainted==False)
+        # url_hash leads the index; url itself only guards against a hash collision.
+        query = query.filter(Scan.url_hash==urlHash(self.url)).filter(Scan.tainted==False)
+        query = query.filter(Scan.url==self.url)
         if enforce_hash or self.hash:
             query = query.filter(Scan.hash==self.hash)
         if enforce_size or (use_size and self.filesize > -1):
@@ -238,37 +355,67 @@ class ScannableRequest(object):
         """
         Get the hash of the file, downloading and hashing it as necessary. Cached.
 
+        Hashes in the calling thread; L{computeHash} does the same on the shared hashing
+        threads without blocking.
+
         @rtype: C{str}
         @return: L{hash}
         """
-        # Read file contents using a subprocess.
-        script_name = 'filehash.py'
-        script_path = os.path.join(frameworkdir, script_name)
-        # TODO: add a Timer thread to interrupt if it takes too long.
         try:
-            data = subprocess.check_output(['python', script_path, self.filepath])
+            filepath = self.filepath
+            if self.contenthash:
+                # Hashed while it was downloaded.
+                return self.contenthash
+            self.contenthash = filehash.filehash(filepath)
         except IncompleteScanError:
-            self.logger.log('Failed to download %s, unable to get hash' % (self.filepath))
+            self.logger.log('Failed to download %s, unable to get hash' % (self.url))
             return ''
-        except subprocess.CalledProcessError, e:
-            self.logger.log('Non-zero return code from %s' % script_name)
-            self.logger.log('Return code: %s, output: %s' % (e.returncode, e.output))
+        except (IOError, OSError), e:
+            self.logger.log('Failed to hash %s: %s' % (self.downloaded_filepath, e))
             return ''
         except Exception, e:
             self.logger.log('Unknown failure while trying to download %s' % (self.filepath))
             self.logger.log('Exception was: %s' % e)
             return ''
-        self.logger.log('Waiting: %s' % self.filepath)
-        self.logger.log('output of filehash.py: %s' % data)
-        lines = data.split('\r\n')
-        if 'opened' == lines[0]:
-            if len(lines) > 1:
-                lines[:] = lines[1:]
-            else:
-                return ''
-        lines[:] = [l.strip() for l in lines]
-        self.contenthash = pickle.loads('\n'.join(lines))
         self.logger.log('Got contenthash: %s' % self.contenthash)
+        return self.contenthash
+
+    def computeHash(self):
+        """
+        Get the hash of the file on the shared hashing threads, downloading it first if
+        necessary.
+
+        @return: a Deferred firing with L{hash}, or with C{''} if the file could not be
+                 downloaded or read
+        @rtype: C{twisted.internet.defer.Deferred}
+        """
+        if self.contenthash:
+            return defer.succeed(self.contenthash)
+        try:
+            filepath = self.filepath
+        except IncompleteScanError:
+            self.logger.log('Failed to download %s, unable to get hash' % (self.url))
+            return defer.succeed('')
+        if self.contenthash:
+            # Hashed while it was downloaded.
+            return defer.succeed(self.contenthash)
+        try:
+            maxthreads = int(self.config.scanning.hash_threads)
+        except (AttributeError, ValueError):
+            maxthreads = 4
+
+        def hashed(contenthash):
+            self.contenthash = contenthash
+            self.logger.log('Got contenthash: %s' % self.contenthash)
+            return contenthash
+
+        def failed(failure):
+            self.logger.log('Failed to hash %s: %s' % (filepath, failure.getErrorMessage()))
+            return ''
+
+        d = filehash.getHasher(maxthreads).hash(filepath)
+        d.addCallbacks(hashed, failed)
+        return d
 
     @property
     def hash(self):
@@ -294,7 +441,16 @@ class ScannableRequest(object):
         self.session.commit()  # release the session lock for following long operation
         filepath = self.filepath
         shasum = self.hash
+        self._recordscan(shasum, *self._scanfile(filepath, shasum))
+        return self.scan
+
+    def _scanfile(self, filepath, shasum):
+        """
+        Run the scan handler on the downloaded file.  Blocks; touches neither the database
+        nor anything shared between requests.
 
+        @return: malicious, siginfo and the time the scan took in ms
+        """
         if shasum == None:
             scan_timer = TimeMeasurer()
             try:
@@ -310,7 +466,13 @@ class ScannableRequest(object):
                 scantime = int(scan_timer.total * 1000.0)  # time.time() uses seconds
             except AttributeError:
                 scantime = 0
+        return malicious, siginfo, scantime
 
+    def _recordscan(self, shasum, malicious, siginfo, scantime):
+        """
+        Store the result of L{_scanfile} as this request's local scan, appending it to the
+        scan feed in the same commit.
+        """
         if self.parentrequest:
             request = self.parentrequest
             peer = request.peer
@@ -321,6 +483,7 @@ class ScannableRequest(object):
         scan = Scan(self.config.owner, "local", self.url, malicious, siginfo, hash=shasum,
                     scantime=scantime, retrievems=self.retrievems, peer=peer, request=request)
         self.session.add(scan)
+        self.session.add(ScanFeedEntry(scan))
         self.session.commit()
         self.scan = scan
 
@@ -344,6 +507,42 @@ class ScannableRequest(object):
         self.logger.log('Returning self.scan: %s' % self.scan)
         return self.scan
 
+    @defer.inlineCallbacks
+    def deferLocalscan(self, batched=False):
+        """
+        L{localscan} without blocking the reactor: the download, hashing and scanning happen
+        off the reactor thread, the database lookups and updates on it.
+
+        @param batched: scan the file together with other files given to scan about the same
+                        time (see L{socialscan.scanexecutor.ScanBatcher}), for callers which
+                        can wait a little longer for the result
+
+        @return: a Deferred firing with the L{socialscan.model.Scan}, or failing with
+                 L{IncompleteScanError} if the file could not be downloaded, or its
+                 L{socialscan.exceptions.ScanQueueFullError} if the L{executor} had no room
+        @rtype: C{twisted.internet.defer.Deferred}
+        """
+        if not self.scan:
+            filepath = yield self.fetch()
+            shasum = self.hash
+            scan = self._scansQuery(True, True, True, True).first()
+            if scan:
+                self.logger.log('found scan in database.')
+                self.scan = scan
+            else:
+                self.logger.log('scanning %s off the reactor' % filepath)
+                self.session.commit()  # release the session lock for the scan
+                if batched and shasum is not None:
+                    batcher = scanexecutor.getBatcher(self.config, self.handler)
+                    scanned = batcher.add(self.priority, filepath)
+                else:
+                    scanned = self.executor.run(self.priority, self.config.scanning.handler,
+                                                self._scanfile, filepath, shasum)
+                malicious, siginfo, scantime = yield scanned
+                if not self.scan:
+                    self._recordscan(shasum, malicious, siginfo, scantime)
+        defer.returnValue(self.scan)
+
     def alreadySent(self):
         """
         An sqlalchemy query resulting in peers to whom scan requests have been sent,
@@ -404,6 +603,37 @@ class ScannableRequest(object):
             retries = 0 #-= 1 # Disable retries for now.
         self.session.commit()
 
+    @defer.inlineCallbacks
+    def deferActiveScans(self, peers=None):
+        """
+        L{requestActiveScans} without blocking the reactor: the requests are sent to all
+        peers at once (see L{peerrpc.fanoutCalls}), and recorded on the reactor thread.  Waits
+        no longer than the network timeout for the slowest peer.  Requests to the same peer
+        made within the batch window, by this or other requests, go in one call.
+
+        @return: a Deferred firing with the peers which could not be reached
+        @rtype: C{twisted.internet.defer.Deferred}
+        """
+        if not peers:
+            peers = self.getPeers().except_(self.alreadySent()).all()
+        requests = {}
+        for peer in peers:
+            self.logger.log("Sending active scan request to peer %r" % peer)
+            requests[peer] = SentScanRequest(self.config.owner, self.url, peer)
+        calls = [(peer, (self.url, requests[peer].key)) for peer in peers]
+        self.session.commit()  # release the database lock while the requests are out
+        batcher = peerrpc.getBatcher('scanRequests', 'scanRequest', (self.config.owner.name,),
+                                     **batchOptions(self.config))
+        results, failures = yield peerrpc.fanoutCalls(
+            calls, batcher.add, deadline=float(self.config.core.network_timeout))
+        for peer in results:
+            self.session.add(requests[peer])
+        for peer, failure in failures.items():
+            self.logger.log("Active scan request to peer %r failed: %s" %
+                            (peer, failure.getErrorMessage()))
+        self.session.commit()
+        defer.returnValue(failures.keys())
+
     #@property
     #@cached
     def digestscans(self):
@@ -42,6 +42,16 @@ class SigInfo(collections.namedtuple("SigInfo", ["scannervv", "sigversion", "sig
         return True
 
 
+def batchOptions(config):
+    """
+    The options for a L{f3ds.framework.peerrpc.CallBatcher} from the sharing section of
+    C{config}.
+    """
+    return dict(window=float(config.sharing.rpc_batch_window),
+                maxsize=int(config.sharing.rpc_batch_size),
+                threads=int(config.sharing.rpc_threads))
+
+
 def update_counts(scanned_count, malicious_count, scan, days=10):
     """ Update counts for number of scans found and number of malicious scans found. """
     if (datetime.now() - scan.sigdate).days <= days:
@@ -28,26 +28,43 @@ os.chdir(projectdir)
 
 # import test suite modules
 import test_cnc_table
+import test_core
+import test_decisionhandlers
+import test_digestindex
 import test_filehash
 import test_keymanager
+import test_logstore
 import test_model
+import test_peerrpc
+import test_redirector
 import test_scanhandlers_dummy
 import test_scanhandlers_mcafee
 import test_scanhandlers_msseccli
 import test_scandigest
+import test_scanexecutor
 import test_scanlog
 import test_containermanagers
 import test_searchutil
 import test_sethash
+import test_transfer
+import test_urlretrieve
 import test_util
+import test_workers
+import test_workingset
 
 
 # setup a complete test suite
 tests = unittest.TestSuite()
 tests.addTests(test_cnc_table.suite())
+tests.addTests(test_core.suite())
+tests.addTests(test_decisionhandlers.suite())
+tests.addTests(test_digestindex.suite())
 tests.addTests(test_filehash.suite())
 tests.addTests(test_keymanager.suite())
+tests.addTests(test_logstore.suite())
 tests.addTests(test_model.suite())
+tests.addTests(test_peerrpc.suite())
+tests.addTests(test_redirector.suite())
 tests.addTests(test_scanhandlers_dummy.suite())
 
 # TODO: add these test handlers based on availablility of scanners.
@@ -55,11 +72,16 @@ tests.addTests(test_scanhandlers_dummy.suite())
 #tests.addTests(test_scanhandlers_msseccli.suite())
 
 tests.addTests(test_scandigest.suite())
+tests.addTests(test_scanexecutor.suite())
 tests.addTests(test_scanlog.suite())
 tests.addTests(test_containermanagers.suite())
 tests.addTests(test_searchutil.suite())
 tests.addTests(test_sethash.suite())
+tests.addTests(test_transfer.suite())
+tests.addTests(test_urlretrieve.suite())
 tests.addTests(test_util.suite())
+tests.addTests(test_workers.suite())
+tests.addTests(test_workingset.suite())
 
 
 def run(v=1):
@@ -3,8 +3,10 @@ Unit test module for model.containers module (primarily the manager classes)
 Run tests by executing on the command line: python test_containermanagers.py
 """
 
+import os
 import sys
 import unittest
+import urllib
 
 from datetime import datetime
 from os import path
@@ -23,9 +25,14 @@ for d in [projectdir, path.join(projectdir, 'socialscan'), path.join(projectdir,
     if d not in sys.path:
         sys.path.append(d)
 
+from f3ds.framework.util import UrlObject
 from socialscan.config import loadDefaultConfig
-from socialscan.model import Base, Peer
+from socialscan import scanhandlers
+from socialscan.model import (Base, FeedCursor, Peer, QueuedRequest, Scan, ScanDigestFile,
+                              ScanFeedEntry)
 from socialscan.model.containers import DigestManager, ScanLogManager
+from socialscan.model.scandigest import ScanDigest
+from test_peerrpc import FakeWorkers
 from unittestutils import trim_microseconds
 from socialscan.util import SigInfo
 
@@ -114,10 +121,266 @@ class ScanLogManagerTest(unittest.TestCase):
     # TODO: Add test coverage.  This is very minimal testing.
 
 
+class RetrievalTest(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine('sqlite:///:memory:')
+        self.session = sessionmaker(bind=engine)()
+        Base.metadata.create_all(engine)
+        self.siginfo = SigInfo('Test Model Scanner v1.0', 'Generic Signature 0.3',
+                               trim_microseconds(datetime.utcnow()))
+        self.config = loadDefaultConfig()
+        self.config.container_manager.download_threads = '2'
+        self.config.container_manager.downloads_per_peer = '1'
+        owner = Peer('retrievaltest-owner', 'owner', 'http://owner/')
+        self.near = Peer('retrievaltest-near', 'near', 'http://near/')
+        self.far = Peer('retrievaltest-far', 'far', 'http://far/')
+        self.session.add_all([owner, self.near, self.far])
+        self.session.commit()
+        self.config.owner = owner
+        self.manager = DigestManager(self.config, self.session)
+        self.manager.workers = FakeWorkers()
+        self.manager._pendingOffers = self.pendingOffers
+        self.digests = []
+
+    def pendingOffers(self):
+        'Offers not yet retrieved, nearest peers first, as the social distance query has them.'
+        distance = {self.near: 1.0, self.far: 5.0}
+        offers = self.session.query(QueuedRequest).filter(QueuedRequest.state != 'done').all()
+        return sorted(offers, key=lambda request: (distance[request.peer], request.id))
+
+    def tearDown(self):
+        for container in self.manager.containers + list(self.manager.demoted):
+            container.unload()
+        for filename in self.digests:
+            os.remove(filename)
+
+    def offer(self, peer, name, urls, fileformat=None):
+        'Have peer offer a digest holding urls, saved where it can be downloaded from.'
+        filename = os.path.abspath(os.path.join('data', 'offered-%s' % name))
+        if filename not in self.digests:
+            self.digests.append(filename)
+        digest = ScanDigest(100, self.siginfo, filename, fileformat=fileformat)
+        for url in urls:
+            digest.add(UrlObject(url, -1))
+        digest.save()
+        url = 'file:' + urllib.pathname2url(filename)
+        request = QueuedRequest(self.config.owner, 'scandigestfile-offer', peer, url)
+        self.session.add(request)
+        self.session.commit()
+        return request
+
+    def retrieving(self):
+        'The urls being downloaded, in the order they were started.'
+        return [args[1] for f, args, d in self.manager.workers.calls if not d.called]
+
+    def testNearestFirst(self):
+        'The nearest peers are retrieved from first, a limited number at a time from each.'
+        far = self.offer(self.far, 'far', ['http://a/'])
+        near = [self.offer(self.near, 'near%d' % i, ['http://b/']) for i in range(2)]
+        self.manager.retrieveContainer()
+        self.assertEqual(self.retrieving(), [near[0].url, far.url])
+        self.manager.retrieveContainer()
+        self.assertEqual(len(self.manager.workers.calls), 2)
+        self.manager.workers.answer(0)
+        # the finished retrieval made room for the next offer from the same peer
+        self.assertEqual(self.retrieving(), [far.url, near[1].url])
+        self.assertEqual(near[0].state, 'done')
+        self.assertEqual(len(self.manager.containers), 1)
+        self.assertTrue(self.manager.containers[0].get(UrlObject('http://b/', -1)))
+
+    def testHeldRetrievedAgain(self):
+        'A container offered again is brought up to date, not retrieved as a new one.'
+        self.offer(self.near, 'again', ['http://a/'])
+        self.manager.retrieveContainer()
+        self.manager.workers.answer(0)
+        self.offer(self.near, 'again', ['http://a/', 'http://b/'])
+        self.manager.retrieveContainer()
+        self.manager.workers.answer(1)
+        self.assertEqual(self.session.query(ScanDigestFile)
+                         .filter(ScanDigestFile.creator == self.near).count(), 1)
+        self.assertEqual(len(self.manager.containers), 1)
+        self.assertTrue(self.manager.containers[0].get(UrlObject('http://b/', -1)))
+
+    def testHeldRetrievalFailed(self):
+        'A failed retrieval of a container we hold leaves our copy and puts it back.'
+        self.offer(self.near, 'kept', ['http://a/'])
+        self.manager.retrieveContainer()
+        self.manager.workers.answer(0)
+        held, = self.manager.containers
+        with open(held.filename, 'rb') as f:
+            before = f.read()
+        self.offer(self.near, 'kept', ['http://a/', 'http://b/'])
+        os.remove(self.digests.pop())
+        self.manager.retrieveContainer()
+        self.manager.workers.answer(1)
+        with open(held.filename, 'rb') as f:
+            self.assertEqual(before, f.read())
+        self.assertEqual(self.manager.containers, [held])
+        self.assertTrue(held.get(UrlObject('http://a/', -1)))
+        self.assertEqual([], [name for name in os.listdir(path.dirname(held.filename))
+                              if name.endswith('.part')])
+
+    def testFailed(self):
+        'An offer which can not be retrieved is done with, and makes room for the next.'
+        request = self.offer(self.near, 'missing', ['http://a/'])
+        os.remove(self.digests.pop())
+        self.manager.retrieveContainer()
+        self.manager.workers.answer(0)
+        self.assertEqual(request.state, 'done')
+        self.assertEqual(self.manager.retrieving, {})
+        self.assertEqual(self.manager.containers, [])
+
+    def testDemoted(self):
+        'A container evicted to make room is still searched from disk, and loaded when hit.'
+        self.manager.workingset.limit = 1
+        self.manager.demoted.limit = 1
+        self.offer(self.near, 'a', ['http://a/'], 'mapped')
+        self.offer(self.near, 'b', ['http://b/'], 'mapped')
+        self.manager.retrieveContainer()
+        self.manager.workers.answer(0)
+        self.manager.workers.answer(1)
+        a, = self.manager.demoted
+        b, = self.manager.containers
+        self.assertTrue(a._container.filterS.ondisk)
+        self.assertEqual(self.manager.search('http://a/', -1, None, aggregate=True), 1)
+        self.assertEqual(self.manager.containers, [a])
+        self.assertEqual(list(self.manager.demoted), [b])
+        self.assertFalse(a._container.filterS.ondisk)
+        self.assertEqual(self.manager.search('http://b/', -1, None, aggregate=True), 1)
+
+
+class ScanFeedTest(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine('sqlite:///:memory:')
+        self.session = sessionmaker(bind=engine)()
+        Base.metadata.create_all(engine)
+        self.config = loadDefaultConfig()
+        self.owner = Peer('feedtest-owner', 'owner', 'http://owner/')
+        self.session.add(self.owner)
+        self.session.commit()
+        self.config.owner = self.owner
+        self.siginfo = scanhandlers.sigInfoCache(self.config.scanning.handler).getSigInfo()
+        self.sdmgr = DigestManager(self.config, self.session)
+        self.slmgr = ScanLogManager(self.config, self.session)
+
+    def tearDown(self):
+        for manager in (self.sdmgr, self.slmgr):
+            for container in manager.containers + list(manager.demoted):
+                container.unload()
+
+    def record(self, url, **flags):
+        'Record a local scan of url as ScannableRequest does.'
+        scan = Scan(self.owner, 'local', url, False, self.siginfo)
+        for name, value in flags.items():
+            setattr(scan, name, value)
+        self.session.add(scan)
+        self.session.add(ScanFeedEntry(scan))
+        self.session.commit()
+        return scan
+
+    def position(self, manager):
+        return self.session.query(FeedCursor.position)\
+                           .filter(FeedCursor.name==manager.cname).scalar()
+
+    def testFeedRead(self):
+        'Each manager should add the scans after its cursor and move the cursor past them.'
+        self.record('http://a/')
+        self.record('http://b/')
+        self.sdmgr.updateOurContainer()
+        self.assertEqual(2, self.position(self.sdmgr))
+        self.assertTrue(self.sdmgr.ourcontainer.get(UrlObject('http://b/', -1)))
+        self.record('http://c/')
+        entries, scans = self.sdmgr._findScans()
+        self.assertEqual(['http://c/'], [scan.url for scan in scans])
+        self.sdmgr.updateOurContainer()
+        self.assertEqual(3, self.position(self.sdmgr))
+        self.assertFalse(self.session.query(Scan).filter(Scan.digested==True).count())
+
+    def testLoggedAfterDigested(self):
+        'The log manager should read no further than the digest manager has.'
+        self.record('http://a/')
+        self.slmgr.updateOurContainer()
+        self.assertEqual(0, self.position(self.slmgr))
+        self.sdmgr.updateOurContainer()
+        self.record('http://b/')
+        self.slmgr.updateOurContainer()
+        self.assertEqual(1, self.position(self.slmgr))
+
+    def testLoggedWithoutDigests(self):
+        'Without a digest manager, the log manager should read the whole feed.'
+        self.session.query(FeedCursor).delete()
+        self.session.commit()
+        self.record('http://a/')
+        self.record('http://b/')
+        self.slmgr.updateOurContainer()
+        self.assertEqual(2, self.position(self.slmgr))
+        self.assertEqual(None, self.position(self.sdmgr))
+
+    def testLegacyFlags(self):
+        'Scans flagged as added before the feed existed should be passed over.'
+        self.record('http://a/', digested=True)
+        self.record('http://b/')
+        entries, scans = self.sdmgr._findScans()
+        self.assertEqual(2, len(entries))
+        self.assertEqual(['http://b/'], [scan.url for scan in scans])
+
+    def testLeftover(self):
+        'The cursor should stop short of scans no container would take.'
+        a, b, c = [self.record('http://%s/' % name) for name in 'abc']
+        entries, scans = self.sdmgr._findScans()
+        self.sdmgr._advanceFeed(entries, [b, c])
+        self.assertEqual(a.id, self.position(self.sdmgr))
+        entries, scans = self.sdmgr._findScans()
+        self.assertEqual([b, c], scans)
+
+    def testPaged(self):
+        'The feed should be read a page at a time, each page moving the cursor on.'
+        for name in 'abcde':
+            self.record('http://%s/' % name)
+        self.sdmgr.feedbatch = 2
+        entries, scans = self.sdmgr._findScans()
+        self.assertEqual(['http://a/', 'http://b/'], [scan.url for scan in scans])
+        self.sdmgr.updateOurContainer()
+        self.assertEqual(5, self.position(self.sdmgr))
+        for name in 'abcde':
+            self.assertTrue(self.sdmgr.ourcontainer.get(UrlObject('http://%s/' % name, -1)))
+
+    def testLeftoverNotRepeated(self):
+        'Scans after one left over should not be added until it is, so none is added twice.'
+        a = self.record('http://a/')
+        newsiginfo = SigInfo(self.siginfo.scannervv, self.siginfo.sigversion + '.1',
+                             self.siginfo.sigdate)
+        b = Scan(self.owner, 'local', 'http://b/', False, newsiginfo)
+        self.session.add(b)
+        self.session.add(ScanFeedEntry(b))
+        self.session.commit()
+        self.sdmgr._determineSiginfo = lambda: newsiginfo
+        added = []
+        addScans = self.sdmgr._addScans
+        def sometimesAddScans(scans):
+            # leave the scans made with the old signatures over, the first time round
+            if not added and scans and scans[0].siginfo == self.siginfo:
+                added.append(None)
+                return list(scans)
+            added.extend(scan.url for scan in scans)
+            return addScans(scans)
+        self.sdmgr._addScans = sometimesAddScans
+        self.sdmgr._announceContainers = lambda: None
+        self.sdmgr.updateOurContainer()
+        self.assertEqual(0, self.position(self.sdmgr))
+        self.sdmgr.updateOurContainer()
+        self.assertEqual(b.id, self.position(self.sdmgr))
+        self.assertEqual([None, 'http://a/', 'http://b/'], added)
+        self.assertEqual(newsiginfo, self.sdmgr.ourcontainer.siginfo)
+
 def suite():
     sdmanager_suite = unittest.makeSuite(DigestManagerTest)
     slmanager_suite = unittest.makeSuite(ScanLogManagerTest)
-    suite = unittest.TestSuite((sdmanager_suite, slmanager_suite))
+    retrieval_suite = unittest.makeSuite(RetrievalTest)
+    feed_suite = unittest.makeSuite(ScanFeedTest)
+    suite = unittest.TestSuite((sdmanager_suite, slmanager_suite, retrieval_suite, feed_suite))
     return suite
 
 
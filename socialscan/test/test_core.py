@@ -0,0 +1,271 @@
+"""
+Unit test module for the core protocol
+Run tests by executing on the command line: python test_core.py
+"""
+
+import json
+import sys
+import unittest
+
+from os import path
+
+# Modify the path to include the source under test
+# Then we can run the unit tests from the test directory
+# __file__ is <root>/test/test_core.py
+pdn = path.dirname
+thisfile = path.abspath(__file__)
+projectdir = pdn(pdn(thisfile))
+f3dsdir = pdn(projectdir)
+for d in [projectdir,
+          f3dsdir,
+          path.join(projectdir, 'socialscan'),
+          path.join(projectdir, 'util'),
+          path.join(projectdir, 'test')]:
+    if d not in sys.path:
+        sys.path.append(d)
+
+from twisted.internet import defer
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+
+from f3ds.framework import core, model
+from f3ds.framework.util import UrlObject
+from socialscan.config import loadDefaultConfig
+from socialscan.core import SocialScanCore
+
+
+class FakeCore(object):
+    handler = None
+    handle_timeout = None
+
+
+class PendingRequest(core.CoreRequest):
+    'Leaves every url undecided until the test decides it.'
+
+    def __init__(self):
+        core.CoreRequest.__init__(self, FakeCore())
+        self.urls = {}
+
+    def handle_url(self, url):
+        d = self.urls[url] = defer.Deferred()
+        return d
+
+
+class CoreRequestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = PendingRequest()
+        self.transport = StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def testSingle(self):
+        'A bare url is answered and the connection closed.'
+        self.protocol.dataReceived(json.dumps("http://a/") + "\x04")
+        self.protocol.urls["http://a/"].callback("http://deny/")
+        self.assertEqual(self.transport.value(), json.dumps("http://deny/"))
+        self.assertTrue(self.transport.disconnecting)
+
+    def testMultiplexed(self):
+        'Numbered urls share the connection, and are answered as they are decided.'
+        self.protocol.dataReceived(json.dumps([1, "http://a/"]) + "\x04" +
+                                   json.dumps([2, "http://b/"]) + "\x04" + '[3, "ht')
+        self.protocol.dataReceived('tp://c/"]\x04')
+        self.assertEqual(sorted(self.protocol.urls), ["http://a/", "http://b/", "http://c/"])
+        self.protocol.urls["http://b/"].callback("")
+        self.protocol.urls["http://a/"].callback("http://deny/")
+        self.protocol.urls["http://c/"].errback(Failure(ValueError()))
+        replies = [json.loads(message) for message in self.transport.value().split("\x04")[:-1]]
+        self.assertEqual(replies, [[2, ""], [1, "http://deny/"], [3, None]])
+        self.assertFalse(self.transport.disconnecting)
+
+    def testFramed(self):
+        'Framed messages share the connection, and are answered in frames.'
+        data = core.frame([1, "http://a/"]) + core.frame([2, "http://b/"])
+        self.protocol.dataReceived(data[:3])
+        self.protocol.dataReceived(data[3:-1])
+        self.assertEqual(sorted(self.protocol.urls), ["http://a/"])
+        self.protocol.dataReceived(data[-1:])
+        self.protocol.urls["http://b/"].callback("http://deny/")
+        self.protocol.urls["http://a/"].errback(Failure(ValueError()))
+        replies, rest = core.unframe(self.transport.value())
+        self.assertEqual(replies, [[2, "http://deny/"], [1, None]])
+        self.assertEqual(rest, "")
+        self.assertFalse(self.transport.disconnecting)
+
+    def testFrameTooLong(self):
+        'A frame longer than any message is refused.'
+        self.protocol.dataReceived(core.PREFIX.pack(core.MAX_LENGTH + 1) + "[")
+        self.assertEqual(self.protocol.urls, {})
+        self.assertTrue(self.transport.disconnecting)
+
+
+class UnframeTest(unittest.TestCase):
+
+    def testPartial(self):
+        'Only complete frames are decoded.'
+        data = core.frame([1, "http://a/"]) + core.frame([2, "http://b/"])
+        self.assertEqual(core.unframe(data[:-2]), ([[1, "http://a/"]],
+                                                   core.frame([2, "http://b/"])[:-2]))
+        self.assertEqual(core.unframe(data), ([[1, "http://a/"], [2, "http://b/"]], ""))
+        self.assertEqual(core.unframe("\x00\x00"), ([], "\x00\x00"))
+
+
+class CoreClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = core.CoreClient()
+        self.transport = StringTransport()
+        self.client.makeConnection(self.transport)
+
+    def testOutOfOrder(self):
+        'Replies are matched to their requests by ID.'
+        results = {}
+        for url in ["http://a/", "http://b/"]:
+            self.client.request(url).addCallback(results.__setitem__, url)
+        sent, rest = core.unframe(self.transport.value())
+        self.assertEqual([url for requestid, url in sent], ["http://a/", "http://b/"])
+        ids = dict((url, requestid) for requestid, url in sent)
+        self.client.dataReceived(core.frame([ids["http://b/"], "http://deny/"]))
+        self.assertEqual(results, {"http://deny/": "http://b/"})
+        self.client.dataReceived(core.frame([ids["http://a/"], ""]))
+        self.assertEqual(results, {"http://deny/": "http://b/", "": "http://a/"})
+
+    def testConnectionLost(self):
+        'Requests still waiting when the connection is lost fail.'
+        failures = []
+        self.client.request("http://a/").addErrback(failures.append)
+        self.client.connectionLost(Failure(ConnectionDone()))
+        self.assertEqual(len(failures), 1)
+        self.assertTrue(self.client.lost.called)
+
+
+class FakeEndpoint(object):
+
+    def __init__(self):
+        self.connecting = []
+
+    def connect(self, factory):
+        d = defer.Deferred()
+        self.connecting.append((factory, d))
+        return d
+
+    def finish(self):
+        factory, d = self.connecting.pop(0)
+        protocol = factory.buildProtocol(None)
+        protocol.makeConnection(StringTransport())
+        d.callback(protocol)
+        return protocol
+
+
+class CoreConnectionTest(unittest.TestCase):
+
+    def testSharedConnection(self):
+        'Requests made while connecting share one connection, which is remade when lost.'
+        endpoint = FakeEndpoint()
+        connection = core.CoreConnection(endpoint)
+        failures = []
+        connection.request("http://a/").addErrback(failures.append)
+        connection.request("http://b/").addErrback(failures.append)
+        self.assertEqual(len(endpoint.connecting), 1)
+        client = endpoint.finish()
+        self.assertEqual(len(client.pending), 2)
+        connection.request("http://c/").addErrback(failures.append)
+        self.assertEqual(len(client.pending), 3)
+        client.connectionLost(Failure(ConnectionDone()))
+        self.assertEqual(len(failures), 3)
+        connection.request("http://d/")
+        self.assertEqual(len(endpoint.connecting), 1)
+
+
+class VerdictKeyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.core = SocialScanCore(loadDefaultConfig(), None, None, None)
+
+    def testKey(self):
+        'Verdicts are keyed by the url hash and the signatures.'
+        key = self.core.verdictKey("http://a/")
+        self.assertEqual(key, (UrlObject("http://a/", -1).rawurl,
+                               self.core.scanhandler.getSigInfo()))
+
+    def testDroppedOnTaint(self):
+        'Marking something tainted drops every verdict.'
+        key = self.core.verdictKey("http://a/")
+        self.core.verdicts.put(key, "")
+        self.assertEqual(self.core.verdicts.get(self.core.verdictKey("http://a/")), "")
+        model.countTaint()
+        self.assertEqual(self.core.verdicts.get(self.core.verdictKey("http://a/")), None)
+
+    def testDroppedOnNewSignatures(self):
+        'New signatures drop every verdict.'
+        self.core.verdicts.put(self.core.verdictKey("http://a/"), "")
+        self.core.newSignatures("newer signatures")
+        self.assertEqual(self.core.verdicts.get(self.core.verdictKey("http://a/")), None)
+        self.assertEqual(len(self.core.verdicts), 0)
+        self.assertEqual(self.core.verdictKey("http://a/")[1], "newer signatures")
+
+    def testScannerAskedOnce(self):
+        'The scanner is asked for its signatures once, not on every request.'
+        handler = self.core.scanhandler = FakeScanHandler()
+        self.core.siginfo = None
+        for url in ["http://a/", "http://b/", "http://a/"]:
+            self.core.verdictKey(url)
+        self.assertEqual(handler.asked, 1)
+
+
+class CoalesceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.core = SocialScanCore(loadDefaultConfig(), None, None, None)
+        self.decisions = []
+
+    def decide(self, url):
+        d = defer.Deferred()
+        self.decisions.append(d)
+        return d
+
+    def testCoalesced(self):
+        'Requests for a url being decided wait for that decision.'
+        results = []
+        for i in range(3):
+            self.core.coalesce("key", self.decide, "http://a/").addCallback(results.append)
+        self.assertEqual(len(self.decisions), 1)
+        self.decisions[0].callback("http://deny/")
+        self.assertEqual(results, ["http://deny/"] * 3)
+        self.assertEqual(self.core.inflight, {})
+        self.core.coalesce("key", self.decide, "http://a/")
+        self.assertEqual(len(self.decisions), 2)
+
+    def testFailureShared(self):
+        'A failed decision fails every request waiting on it.'
+        failures = []
+        for i in range(2):
+            self.core.coalesce("key", self.decide, "http://a/").addErrback(failures.append)
+        self.decisions[0].errback(Failure(ValueError()))
+        self.assertEqual(len(failures), 2)
+
+
+class FakeScanHandler(object):
+
+    asked = 0
+
+    def getSigInfo(self):
+        self.asked += 1
+        return "newer signatures"
+
+
+def suite():
+    request_suite = unittest.makeSuite(CoreRequestTest)
+    unframe_suite = unittest.makeSuite(UnframeTest)
+    client_suite = unittest.makeSuite(CoreClientTest)
+    connection_suite = unittest.makeSuite(CoreConnectionTest)
+    verdict_suite = unittest.makeSuite(VerdictKeyTest)
+    coalesce_suite = unittest.makeSuite(CoalesceTest)
+    suite = unittest.TestSuite((request_suite, unframe_suite, client_suite, connection_suite,
+                                verdict_suite, coalesce_suite))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+"""
+Unit test module for the decision handlers
+Run tests by executing on the command line: python test_decisionhandlers.py
+"""
+
+import sys
+import unittest
+
+from os import path
+
+# Modify the path to include the source under test
+# Then we can run the unit tests from the test directory
+# __file__ is <root>/test/test_decisionhandlers.py
+pdn = path.dirname
+thisfile = path.abspath(__file__)
+projectdir = pdn(pdn(thisfile))
+f3dsdir = pdn(projectdir)
+for d in [projectdir,
+          f3dsdir,
+          path.join(projectdir, 'socialscan'),
+          path.join(projectdir, 'util'),
+          path.join(projectdir, 'test')]:
+    if d not in sys.path:
+        sys.path.append(d)
+
+from twisted.internet import defer
+
+from f3ds.framework.log import Logger
+from socialscan import decisionhandlers
+from socialscan.config import loadDefaultConfig
+from socialscan.core import DecisionHandlerProxy
+from socialscan.exceptions import IncompleteScanError, ScanQueueFullError
+from socialscan.scanning import ScannableRequest
+
+
+class FakeCore(object):
+
+    def __init__(self, config):
+        self.config = config
+        self.logger = Logger('DecisionHandlerTest')
+        self.confidence_threshold = float(config.core.confidence_threshold)
+
+
+class FailedDownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config = loadDefaultConfig()
+        self.core = FakeCore(self.config)
+        self.request = ScannableRequest(self.config, None, 'http://a/')
+        self.request.fetch = lambda: defer.fail(IncompleteScanError())
+        self.heads = []
+        self.request._headRequest = lambda: self.heads.append(self.request.url)
+
+    def decide(self, name):
+        handler = DecisionHandlerProxy(decisionhandlers.get(name))
+        results = []
+        handler.resolve(self.core, self.request).addBoth(results.append)
+        self.assertEqual(len(results), 1)
+        return results[0]
+
+    def testSimple(self):
+        'A failed download gives no confidence, without a blocking HEAD request.'
+        safety = self.decide('simple')
+        self.assertFalse(safety.isconfident)
+        self.assertEqual(self.heads, [])
+
+    def testLax(self):
+        'A failed download gives no confidence, without a blocking HEAD request.'
+        safety = self.decide('lax')
+        self.assertFalse(safety.isconfident)
+        self.assertEqual(self.heads, [])
+
+    def testParanoid(self):
+        'A failed download gives no confidence, without a blocking HEAD request.'
+        self.core.confidence_threshold = 1
+        safety = self.decide('paranoid')
+        self.assertFalse(safety.isconfident)
+        self.assertTrue(safety.ismalicious)
+        self.assertEqual(self.heads, [])
+
+
+class QueueFullTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config = loadDefaultConfig()
+        self.core = FakeCore(self.config)
+        self.request = ScannableRequest(self.config, None, 'http://a/')
+        self.request.prepare = lambda: defer.succeed('data/a')
+        self.request.digestscans = lambda: []
+        self.request.getRelevantScans = lambda: []
+        self.request.getRelevantActiveScans = lambda: []
+        self.request.deferActiveScans = lambda: defer.succeed([])
+        self.request.sleep = lambda seconds=None: defer.succeed(None)
+        self.request.deferLocalscan = lambda: defer.fail(ScanQueueFullError())
+
+    def decide(self, name):
+        handler = DecisionHandlerProxy(decisionhandlers.get(name))
+        results = []
+        handler.resolve(self.core, self.request).addBoth(results.append)
+        self.assertEqual(len(results), 1)
+        return results[0]
+
+    def testTurnedAway(self):
+        'A local scan turned away by a full scan queue gives no confidence, not an error.'
+        self.core.confidence_threshold = 1
+        for name in ['simple', 'lax', 'paranoid', 'local']:
+            safety = self.decide(name)
+            self.assertFalse(safety.isconfident, name)
+
+
+def suite():
+    download_suite = unittest.makeSuite(FailedDownloadTest)
+    queue_suite = unittest.makeSuite(QueueFullTest)
+    suite = unittest.TestSuite((download_suite, queue_suite))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,168 @@
+"""
+Unit test module for f3ds.framework.model.index module
+Run tests by executing on the command line: python test_digestindex.py
+"""
+
+import shutil
+import sys
+import tempfile
+import unittest
+
+from datetime import datetime
+from os import path
+
+# Modify the path to include the source under test
+# Then we can run the unit tests from the test directory
+# __file__ is <root>/test/test_digestindex.py
+pdn = path.dirname
+projectdir = pdn(pdn(path.abspath(__file__)))
+for d in [projectdir, path.join(projectdir, 'socialscan'), path.join(projectdir, 'util'),
+          path.join(projectdir, 'test')]:
+    if d not in sys.path:
+        sys.path.append(d)
+
+from f3ds.framework.model.index import DigestIndex
+from f3ds.framework.model.mappedfilter import MappedBloomFilter
+from f3ds.framework.util import UrlObject
+from socialscan.model import scandigest
+from socialscan.util import SigInfo
+from unittestutils import trim_microseconds
+
+
+class DigestIndexTest(unittest.TestCase):
+    name = 'Testbox'
+    urlbase = 'http://www.froogly.com/iownyour%sbase.aspx'
+
+    def makeDigest(self, bases, capacity=300):
+        'Create an unsaved ScanDigest holding a url for each of bases.'
+        now = trim_microseconds(datetime.utcnow())
+        si = SigInfo('Test Scanner Version 0.14', 'signature version 9.12.10', now)
+        sd = scandigest.ScanDigest(capacity, si, 'unused')
+        for base in bases:
+            sd.add(self.urlobject(base))
+        return sd
+
+    def urlobject(self, base, hash=None):
+        'Each base gets its own content, unless a content hash is given.'
+        if hash is None:
+            hash = 'contents of %s' % base
+        return UrlObject(self.urlbase % base, 3425, nonce=self.name, hash=hash)
+
+    def testEmptyIndex(self):
+        'An empty index has no candidates.'
+        index = DigestIndex()
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.candidates(self.urlobject('first')), set())
+
+    def testCandidatesMatchGet(self):
+        'Candidates are exactly the digests whose get() finds the url.'
+        digests = {'a': self.makeDigest(['first', 'second']),
+                   'b': self.makeDigest(['second', 'third']),
+                   'c': self.makeDigest(['fourth'])}
+        index = DigestIndex()
+        for name, sd in digests.items():
+            self.assertTrue(index.add(name, sd))
+        self.assertEqual(len(index), 3)
+        for base in ['first', 'second', 'third', 'fourth', 'fifth']:
+            uo = self.urlobject(base)
+            expected = set(name for name, sd in digests.items() if sd.get(uo))
+            self.assertEqual(index.candidates(uo), expected)
+        self.assertEqual(index.candidates(self.urlobject('second')), set(['a', 'b']))
+
+    def testCandidatesContentHash(self):
+        'A digest holding the content hash is a candidate even if the url differs.'
+        hash = 'e0dbc25fdb98a7e3'
+        sd = self.makeDigest([])
+        sd.add(self.urlobject('first', hash=hash))
+        index = DigestIndex()
+        index.add('a', sd)
+        self.assertEqual(index.candidates(self.urlobject('altered', hash=hash)), set(['a']))
+        self.assertEqual(index.candidates(self.urlobject('altered')), set())
+
+    def testCandidatesStackedFilters(self):
+        'Urls in every stacked filter of a grown digest are found.'
+        bases = ['%d' % i for i in range(250)]
+        sd = self.makeDigest(bases)
+        self.assertTrue(len(sd.filterS.filters) > 1)
+        index = DigestIndex()
+        index.add('a', sd)
+        for base in bases:
+            self.assertEqual(index.candidates(self.urlobject(base)), set(['a']))
+
+    def testCandidatesMappedDigest(self):
+        'Digests loaded from the mapped format are indexed like in-memory ones.'
+        bases = ['first', 'second']
+        sd = self.makeDigest(bases)
+        sdpath = path.join(tempfile.mkdtemp(), 'sdfile')
+        sd.filename = sdpath
+        sd.fileformat = 'mapped'
+        sd.save()
+        mapped = scandigest.ScanDigest.load(sdpath)
+        self.assertTrue(isinstance(mapped.filterS, MappedBloomFilter))
+        index = DigestIndex()
+        index.add('a', mapped)
+        for base in bases:
+            self.assertEqual(index.candidates(self.urlobject(base)), set(['a']))
+        self.assertEqual(index.candidates(self.urlobject('third')), set())
+        mapped.close()
+        shutil.rmtree(path.dirname(sdpath))
+
+    def testRemove(self):
+        'A removed digest is no longer a candidate, and its slot is reused.'
+        index = DigestIndex()
+        index.add('a', self.makeDigest(['first']))
+        index.add('b', self.makeDigest(['first']))
+        index.remove('a')
+        self.assertFalse('a' in index)
+        self.assertEqual(index.candidates(self.urlobject('first')), set(['b']))
+        index.add('c', self.makeDigest(['second']))
+        self.assertEqual(len(index.members), 2)
+        self.assertEqual(index.candidates(self.urlobject('first')), set(['b']))
+        self.assertEqual(index.candidates(self.urlobject('second')), set(['c']))
+        index.remove('b')
+        index.remove('c')
+        self.assertEqual(index.geometries, {})
+        # Removing something not indexed is harmless.
+        index.remove('b')
+
+    def testRemoveLeavesOtherSlots(self):
+        'Removing a digest clears only its own column of the rows.'
+        index = DigestIndex()
+        index.add('a', self.makeDigest(['first', 'second']))
+        index.add('b', self.makeDigest(['second', 'third']))
+        a, b = index.slots['a'], index.slots['b']
+        before = dict((geometry, rows.copy()) for geometry, (rows, refcount)
+                      in index.geometries.items())
+        index.remove('a')
+        for geometry, (rows, refcount) in index.geometries.items():
+            self.assertEqual(rows[b::index.width], before[geometry][b::index.width])
+            self.assertEqual(rows.count(), rows[b::index.width].count())
+        for base in ['second', 'third']:
+            self.assertEqual(index.candidates(self.urlobject(base)), set(['b']))
+        self.assertEqual(index.candidates(self.urlobject('first')), set())
+
+    def testWiden(self):
+        'Rows widen to take more digests than they have slots for.'
+        index = DigestIndex(width=2)
+        bases = ['base%d' % i for i in range(5)]
+        for base in bases:
+            index.add(base, self.makeDigest([base]))
+        self.assertEqual(index.width, 8)
+        for base in bases:
+            self.assertEqual(index.candidates(self.urlobject(base)), set([base]))
+
+    def testAddUnindexable(self):
+        'Containers without filter slices are refused.'
+        index = DigestIndex()
+        self.assertFalse(index.add('a', object()))
+        self.assertFalse('a' in index)
+
+
+def suite():
+    digestindex_suite = unittest.makeSuite(DigestIndexTest)
+    suite = unittest.TestSuite((digestindex_suite))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.main()
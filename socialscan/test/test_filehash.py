@@ -4,7 +4,10 @@ Run tests by executing on the command line: python test_sethash.py
 """
 
 import hashlib
+import os
+import Queue
 import sys
+import tempfile
 import unittest
 
 from os import path
@@ -25,18 +28,9 @@ for d in [projectdir,
     if d not in sys.path:
         sys.path.append(d)
 
-# Import will fail if argv is not just one file.
-tmp_argv = []
-tmp_argv.extend(sys.argv)
-sys.argv = [sys.argv[0], thisfile]
-
 from f3ds.framework import filehash
 from f3ds.framework import sethash
 
-# Restore argv
-sys.argv = []
-sys.argv.extend(tmp_argv)
-
 
 class FilehashTest(unittest.TestCase):
 
@@ -45,17 +39,83 @@ class FilehashTest(unittest.TestCase):
         'Test calling filehash on this file.'
         filehash_path = path.join(projectdir, 'f3ds', 'framework', 'filehash.py')
         expected = """\
-077def2303208e3825d52102ccba667e\
-6367602e3f45149ac982f68427fdb30f\
-02ac80c99c8a64cf8eee3551a0915b96\
-b1df49c13f5ca0961392c908ddca9076"""
+249d80fae2ccec59d07dad577049a516\
+7ca4e7f2955a82d2faff76ce65e38029\
+d09342e3eeaed2ecdcaa56e4d828419c\
+1b96e13e05767b315ff7a617909ddf43"""
         actual = filehash.filehash(filehash_path)
         msg = "'%s' != '%s'\nfilehash.py may have changed since this test was written"
         self.assertEqual(expected, actual, msg % (expected, actual))
 
+    def testFileIterBlocks(self):
+        'FileIter reads no more than blocksize bytes at a time.'
+        with open(thisfile, 'rb') as f:
+            blocks = list(filehash.FileIter(f, 100))
+        with open(thisfile, 'rb') as f:
+            self.assertEqual(''.join(blocks), f.read())
+        self.assertTrue(len(blocks) > 1)
+        self.assertTrue(max([len(block) for block in blocks]) <= 100)
+
+    def testFilehashMatchesHasher(self):
+        'Hashing in blocks gives the digest of the whole file.'
+        with open(thisfile, 'rb') as f:
+            expected = sethash.hasher(f.read()).hexdigest()
+        self.assertEqual(filehash.filehash(thisfile, blocksize=7), expected)
+
+
+class FakeReactor(object):
+    'Just enough of a reactor to hand results from the hashing threads to the test.'
+
+    def __init__(self):
+        self.calls = Queue.Queue()
+
+    def callFromThread(self, f, *args, **kwargs):
+        self.calls.put((f, args, kwargs))
+
+    def addSystemEventTrigger(self, phase, event, f):
+        return (phase, event, f)
+
+    def removeSystemEventTrigger(self, trigger):
+        pass
+
+    def runOne(self):
+        f, args, kwargs = self.calls.get(timeout=10)
+        f(*args, **kwargs)
+
+
+class FileHasherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.hasher = filehash.FileHasher(maxthreads=2, reactor=self.reactor)
+
+    def tearDown(self):
+        self.hasher.stop()
+
+    def testHash(self):
+        'The Deferred fires with the digest of the file.'
+        results = []
+        d = self.hasher.hash(thisfile)
+        d.addCallback(results.append)
+        self.reactor.runOne()
+        self.assertEqual(results, [filehash.filehash(thisfile)])
+
+    def testHashMissingFile(self):
+        'A file which cannot be read fails the Deferred.'
+        handle, missing = tempfile.mkstemp()
+        os.close(handle)
+        os.remove(missing)
+        failures = []
+        d = self.hasher.hash(missing)
+        d.addErrback(failures.append)
+        self.reactor.runOne()
+        self.assertEqual(len(failures), 1)
+        self.assertTrue(failures[0].check(IOError))
+
 def suite():
     filehash_suite = unittest.makeSuite(FilehashTest)
-    suite = unittest.TestSuite((filehash_suite))
+    filehasher_suite = unittest.makeSuite(FileHasherTest)
+    suite = unittest.TestSuite((filehash_suite, filehasher_suite))
     return suite
 
 
@@ -0,0 +1,213 @@
+"""
+Unit test module for f3ds.framework.model.logstore module
+Run tests by executing on the command line: python test_logstore.py
+"""
+
+import anydbm
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from datetime import datetime
+from os import path
+
+# Modify the path to include the source under test
+# Then we can run the unit tests from the test directory
+# __file__ is <root>/test/test_logstore.py
+pdn = path.dirname
+projectdir = pdn(pdn(path.abspath(__file__)))
+for d in [projectdir, path.join(projectdir, 'socialscan'), path.join(projectdir, 'util'),
+          path.join(projectdir, 'test')]:
+    if d not in sys.path:
+        sys.path.append(d)
+
+from f3ds.framework.model.logstore import DbmLogStore, SegmentLogStore, openstore
+from f3ds.framework.sethash import hasher
+from f3ds.framework.util import UrlObject
+from socialscan.model import scanlog
+from socialscan.util import SigInfo, Safety
+from unittestutils import trim_microseconds
+
+
+class SegmentLogStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.storepath = path.join(self.tempdir, 'logfile')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def key(self, i):
+        return hasher('key %d' % i).digest()
+
+    def testPutLookupBeforeAndAfterSync(self):
+        'Records are found in the write buffer and, after sync, in a segment.'
+        store = SegmentLogStore(self.storepath)
+        store.put(self.key(1), '1')
+        store.put(self.key(2), '0')
+        self.assertEqual(store.lookup(self.key(1)), '1')
+        store.sync()
+        self.assertEqual(store.buffer, {})
+        self.assertEqual(len(store.segments), 1)
+        self.assertEqual(store.lookup(self.key(1)), '1')
+        self.assertEqual(store.lookup(self.key(2)), '0')
+        self.assertEqual(store.lookup(self.key(3)), None)
+        store.close()
+
+    def testReopen(self):
+        'Records and metadata survive closing and reopening, across many segments.'
+        store = SegmentLogStore(self.storepath)
+        for i in range(300):
+            store.put(self.key(i), '1' if i % 3 else '0')
+            if i % 100 == 99:
+                store.sync()
+        store.setmeta('urlcount', 300)
+        store.close()
+        self.assertTrue(SegmentLogStore.ismine(self.storepath))
+        store = openstore(self.storepath)
+        self.assertTrue(isinstance(store, SegmentLogStore))
+        self.assertEqual(len(store.segments), 3)
+        self.assertEqual(store.getmeta('urlcount'), '300')
+        for i in range(300):
+            self.assertEqual(store.lookup(self.key(i)), '1' if i % 3 else '0')
+        self.assertEqual(store.lookup(self.key(300)), None)
+        store.close()
+
+    def testNewerSegmentWins(self):
+        'A record put again is answered by the newest segment, also after compaction.'
+        store = SegmentLogStore(self.storepath)
+        store.put(self.key(1), '0')
+        store.sync()
+        store.put(self.key(1), '1')
+        store.sync()
+        self.assertEqual(store.lookup(self.key(1)), '1')
+        store.compact()
+        self.assertEqual(len(store.segments), 1)
+        self.assertEqual(store.lookup(self.key(1)), '1')
+        store.close()
+
+    def testCompaction(self):
+        'Going over max_segments merges the segments into one.'
+        store = SegmentLogStore(self.storepath)
+        for i in range(store.max_segments + 1):
+            store.put(self.key(i), '1')
+            store.setmeta('urlcount', i + 1)
+            store.sync()
+        self.assertEqual(len(store.segments), 1)
+        store.close()
+        store = SegmentLogStore(self.storepath)
+        self.assertEqual(len(store.segments), 1)
+        self.assertEqual(store.getmeta('urlcount'), '%d' % (store.max_segments + 1))
+        for i in range(store.max_segments + 1):
+            self.assertEqual(store.lookup(self.key(i)), '1')
+        store.close()
+
+    def testTruncatedBlockIsDropped(self):
+        'A block cut short is ignored, and overwritten by the next sync.'
+        store = SegmentLogStore(self.storepath)
+        store.put(self.key(1), '1')
+        store.sync()
+        store.put(self.key(2), '1')
+        store.close()
+        size = path.getsize(self.storepath)
+        with open(self.storepath, 'r+b') as f:
+            f.truncate(size - 5)
+        store = SegmentLogStore(self.storepath)
+        self.assertEqual(store.lookup(self.key(1)), '1')
+        self.assertEqual(store.lookup(self.key(2)), None)
+        store.put(self.key(3), '0')
+        store.close()
+        store = SegmentLogStore(self.storepath)
+        self.assertEqual(store.lookup(self.key(1)), '1')
+        self.assertEqual(store.lookup(self.key(3)), '0')
+        store.close()
+
+    def testOtherWidthKeys(self):
+        'Keys that are not of the key width are still stored and found.'
+        store = SegmentLogStore(self.storepath)
+        store.put('\xe6\x0f\x0c\x7b', '1')
+        store.put('not a digest at all', '0')
+        store.sync()
+        self.assertEqual(store.lookup('\xe6\x0f\x0c\x7b'), '1')
+        self.assertEqual(store.lookup('not a digest at all'), '0')
+        store.close()
+
+    def testOpenDbm(self):
+        'Logs in an anydbm database are opened with the dbm backend, keyed by hex.'
+        db = anydbm.open(self.storepath, 'c')
+        db['urlcount'] = '1'
+        db[self.key(1).encode('hex')] = '1'
+        db.close()
+        store = openstore(self.storepath)
+        self.assertTrue(isinstance(store, DbmLogStore))
+        self.assertEqual(store.getmeta('urlcount'), '1')
+        self.assertEqual(store.lookup(self.key(1)), '1')
+        store.close()
+
+
+class SegmentScanLogTest(unittest.TestCase):
+    name = 'Testbox'
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.slpath = path.join(self.tempdir, 'log', 'dbfile')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def testAddSaveLoadGet(self):
+        'A ScanLog in the segment store keeps its scans and metadata.'
+        data = [('http://www.google.com', 1546, 'e60f0c7b96e7ca2f0948ab1c31d', Safety.benign),
+                ('http://westealyourpasswd.com', 9823, 'b849b8e3a659f8d4cac675a',
+                 Safety.malicious),
+                ('http://youhavebeenpowned.cz', 0, '', Safety.malicious),
+                ('http://reallysafe.com', 136, '', Safety.benign)]
+        now = trim_microseconds(datetime.utcnow())
+        si = SigInfo('Unit Test Sig Info', '0.12345', now)
+        sl = scanlog.ScanLog(45, si, self.slpath, storetype='segment')
+        self.assertTrue(isinstance(sl.db, SegmentLogStore))
+        for url, size, hash, safety in data:
+            uo = UrlObject(url, size, nonce=self.name, hash=hash)
+            self.assertTrue(sl.add(uo, safety))
+        sl.hits = 7
+        sl.save()
+        sl.close()
+        sl = scanlog.ScanLog.load(self.slpath)
+        self.assertEqual(sl.maxcapacity, 45)
+        self.assertEqual(sl.siginfo, si)
+        self.assertEqual(len(sl), len(data))
+        self.assertEqual(int(sl.hits), 7)
+        for url, size, hash, safety in data:
+            uo = UrlObject(url, size, nonce=self.name, hash=hash)
+            self.assertEqual(sl.get(uo).ismalicious, safety.ismalicious)
+        missing = UrlObject('http://missing.com', 1, nonce=self.name, hash='missing')
+        self.assertEqual(sl.get(missing), None)
+        sl.close()
+
+    def testDefaultStore(self):
+        'New scan logs are kept in anydbm by default, so that older peers can read them.'
+        si = SigInfo('Unit Test Sig Info', '0.12345', trim_microseconds(datetime.utcnow()))
+        sl = scanlog.ScanLog(45, si, self.slpath)
+        self.assertTrue(isinstance(sl.db, DbmLogStore))
+        uo = UrlObject('http://www.google.com', 1546, nonce=self.name, hash='e60f0c7b96e7')
+        sl.add(uo, Safety.benign)
+        sl.save()
+        sl.close()
+        db = anydbm.open(self.slpath, 'r')
+        self.assertEqual(db['urlcount'], '1')
+        db.close()
+        self.assertFalse(scanlog.ScanLog.load(self.slpath).get(uo).ismalicious)
+
+
+def suite():
+    segment_suite = unittest.makeSuite(SegmentLogStoreTest)
+    scanlog_suite = unittest.makeSuite(SegmentScanLogTest)
+    suite = unittest.TestSuite((segment_suite, scanlog_suite))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,263 @@
+"""
+Unit test module for peerrpc module
+Run tests by executing on the command line: python test_peerrpc.py
+"""
+
+import sys
+import threading
+import time
+import unittest
+import xmlrpclib
+
+from os import path
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+from SocketServer import ThreadingMixIn
+
+# Modify the path to include the source under test
+# Then we can run the unit tests from the test directory
+# __file__ is <root>/test/test_peerrpc.py
+pdn = path.dirname
+thisfile = path.abspath(__file__)
+projectdir = pdn(pdn(thisfile))
+f3dsdir = pdn(projectdir)
+for d in [projectdir,
+          f3dsdir,
+          path.join(projectdir, 'socialscan'),
+          path.join(projectdir, 'util'),
+          path.join(projectdir, 'test')]:
+    if d not in sys.path:
+        sys.path.append(d)
+
+from twisted.internet import defer, task
+
+from f3ds.framework import peerrpc
+
+
+class KeepAliveHandler(SimpleXMLRPCRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+
+class ThreadingServer(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+class ProxyPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.threads = threading.active_count()
+        self.server = ThreadingServer(("127.0.0.1", 0), KeepAliveHandler, logRequests=False)
+        self.server.register_function(lambda a, b: a + b, 'add')
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = "http://127.0.0.1:%d/RPC2" % self.server.server_address[1]
+        self.pool = peerrpc.ProxyPool()
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        # let the handlers see their connections closed
+        deadline = time.time() + 5
+        while threading.active_count() > self.threads and time.time() < deadline:
+            time.sleep(0.01)
+
+    def testReused(self):
+        'A proxy and its connection are kept for the next call to the same peer.'
+        self.assertEqual(self.pool.call(self.url, 5, 'add', 1, 2), 3)
+        idle = list(self.pool.idle[self.url, 5])
+        self.assertEqual(len(idle), 1)
+        self.assertEqual(self.pool.call(self.url, 5, 'add', 3, 4), 7)
+        self.assertEqual(self.pool.idle[self.url, 5], idle)
+
+    def testFailedDropped(self):
+        'A proxy whose call failed is not reused.'
+        self.assertRaises(Exception, self.pool.call, self.url, 5, 'missing')
+        self.assertEqual(self.pool.idle[self.url, 5], [])
+
+
+class FakePeer(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.transport = self
+
+    def ping(self, *args):
+        return (self.name,) + args
+
+
+class FakeWorkers(object):
+    'Leaves every call unanswered until the test answers it.'
+
+    def __init__(self):
+        self.calls = []
+
+    def run(self, f, *args):
+        d = defer.Deferred()
+        self.calls.append((f, args, d))
+        return d
+
+    def answer(self, i):
+        f, args, d = self.calls[i]
+        try:
+            result = f(*args)
+        except:
+            d.errback()
+        else:
+            d.callback(result)
+
+
+class FanoutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.workers = FakeWorkers()
+        self.peers = [FakePeer('a'), FakePeer('b')]
+
+    def fanout(self, calls, deadline=None):
+        outcome = []
+        d = peerrpc.fanoutCalls(calls, 'ping', deadline=deadline, reactor=self.clock,
+                                workers=self.workers)
+        d.addCallback(outcome.append)
+        return outcome
+
+    def testAllAnswer(self):
+        'Every peer is called at once, with its own arguments.'
+        outcome = self.fanout([(peer, (i,)) for i, peer in enumerate(self.peers)])
+        self.assertEqual(len(self.workers.calls), 2)
+        self.workers.answer(1)
+        self.assertEqual(outcome, [])
+        self.workers.answer(0)
+        results, failures = outcome[0]
+        self.assertEqual(results, {self.peers[0]: ('a', 0), self.peers[1]: ('b', 1)})
+        self.assertEqual(failures, {})
+
+    def testDeadline(self):
+        'Peers which have not answered by the deadline are counted as failures.'
+        outcome = self.fanout([(peer, ()) for peer in self.peers], deadline=5)
+        self.workers.answer(0)
+        self.clock.advance(5)
+        results, failures = outcome[0]
+        self.assertEqual(results, {self.peers[0]: ('a',)})
+        self.assertTrue(failures[self.peers[1]].check(defer.TimeoutError))
+        self.workers.answer(1)  # too late, and ignored
+        self.assertEqual(len(outcome), 1)
+
+    def testFailure(self):
+        'A peer which fails is reported with its failure.'
+        outcome = self.fanout([(self.peers[0], ())])
+        self.assertEqual(outcome, [])
+        self.workers.calls[0] = (lambda: 1 / 0, (), self.workers.calls[0][2])
+        self.workers.answer(0)
+        results, failures = outcome[0]
+        self.assertTrue(failures[self.peers[0]].check(ZeroDivisionError))
+
+    def testBatched(self):
+        'Calls may be made through a function, such as a batcher.'
+        calls = []
+        def send(peer, *args):
+            calls.append((peer, args))
+            return defer.succeed(peer.name)
+        outcome = []
+        peerrpc.fanoutCalls([(peer, (1,)) for peer in self.peers], send).addCallback(
+            outcome.append)
+        self.assertEqual(calls, [(self.peers[0], (1,)), (self.peers[1], (1,))])
+        self.assertEqual(outcome, [({self.peers[0]: 'a', self.peers[1]: 'b'}, {})])
+
+    def testNoPeers(self):
+        'With no peers there is nothing to wait for.'
+        self.assertEqual(self.fanout([]), [({}, {})])
+
+
+class BatchingPeer(object):
+    'A peer which may or may not have the batch method.'
+
+    def __init__(self, url, batching=True):
+        self.url = url
+        self.timeout = 5
+        self.transport = self
+        self.batching = batching
+        self.calls = []
+
+    def echoMany(self, owner, items):
+        if not self.batching:
+            raise xmlrpclib.Fault(peerrpc.CallBatcher.NOT_FOUND, 'no such method')
+        self.calls.append(('echoMany', owner, items))
+        return [owner + item[0] for item in items]
+
+    def echo(self, owner, item):
+        self.calls.append(('echo', owner, item))
+        return owner + item
+
+
+class CallBatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.workers = FakeWorkers()
+        self.batcher = peerrpc.CallBatcher('echoMany', 'echo', ('me:',), window=1,
+                                           maxsize=3, reactor=self.clock,
+                                           workers=self.workers)
+
+    def answerAll(self):
+        for i in range(len(self.workers.calls)):
+            self.workers.answer(i)
+
+    def testWindow(self):
+        'Calls to the same peer within the window go together, and get their own results.'
+        a, b = BatchingPeer('http://a/'), BatchingPeer('http://b/')
+        results = []
+        for peer, item in [(a, '1'), (b, '2'), (a, '3')]:
+            self.batcher.add(peer, item).addCallback(results.append)
+        self.assertEqual(self.workers.calls, [])
+        self.clock.advance(1)
+        self.assertEqual(len(self.workers.calls), 2)
+        self.answerAll()
+        self.assertEqual(a.calls, [('echoMany', 'me:', [['1'], ['3']])])
+        self.assertEqual(b.calls, [('echoMany', 'me:', [['2']])])
+        self.assertEqual(sorted(results), ['me:1', 'me:2', 'me:3'])
+
+    def testFullBatchSent(self):
+        'A full batch is sent without waiting for the window.'
+        a = BatchingPeer('http://a/')
+        for item in '123':
+            self.batcher.add(a, item)
+        self.assertEqual(len(self.workers.calls), 1)
+        self.batcher.add(a, '4')
+        self.assertEqual(len(self.workers.calls), 1)
+        self.clock.advance(1)
+        self.assertEqual(len(self.workers.calls), 2)
+
+    def testFallback(self):
+        'A peer without the batch method is sent the calls one by one.'
+        a = BatchingPeer('http://a/', batching=False)
+        results = []
+        for item in '12':
+            self.batcher.add(a, item).addCallback(results.append)
+        self.clock.advance(1)
+        self.answerAll()
+        self.assertEqual(a.calls, [('echo', 'me:', '1'), ('echo', 'me:', '2')])
+        self.assertEqual(results, ['me:1', 'me:2'])
+
+    def testWholeBatchAnswer(self):
+        'An answer for the whole batch is given to every call in it.'
+        a = BatchingPeer('http://a/')
+        a.echoMany = lambda owner, items: "peer not known"
+        results = []
+        for item in '12':
+            self.batcher.add(a, item).addCallback(results.append)
+        self.clock.advance(1)
+        self.answerAll()
+        self.assertEqual(results, ["peer not known"] * 2)
+
+
+def suite():
+    pool_suite = unittest.makeSuite(ProxyPoolTest)
+    fanout_suite = unittest.makeSuite(FanoutTest)
+    batcher_suite = unittest.makeSuite(CallBatcherTest)
+    suite = unittest.TestSuite((pool_suite, fanout_suite, batcher_suite))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+"""
+Unit test module for redirector module
+Run tests by executing on the command line: python test_redirector.py
+"""
+
+import sys
+import unittest
+
+from os import path
+
+# Modify the path to include the source under test
+# Then we can run the unit tests from the test directory
+# __file__ is <root>/test/test_redirector.py
+pdn = path.dirname
+thisfile = path.abspath(__file__)
+projectdir = pdn(pdn(thisfile))
+f3dsdir = pdn(projectdir)
+for d in [projectdir,
+          f3dsdir,
+          path.join(projectdir, 'socialscan'),
+          path.join(projectdir, 'util'),
+          path.join(projectdir, 'test')]:
+    if d not in sys.path:
+        sys.path.append(d)
+
+from twisted.internet import defer
+from twisted.internet.error import ConnectionRefusedError
+from twisted.test.proto_helpers import StringTransport
+
+import redirector
+
+
+class FakeCore(object):
+    'Leaves every url undecided until the test decides it.'
+
+    def __init__(self):
+        self.urls = {}
+
+    def request(self, url):
+        d = self.urls[url] = defer.Deferred()
+        return d
+
+
+class RedirectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.core = FakeCore()
+        self.redirector = redirector.Redirector(None, core=self.core)
+        self.transport = StringTransport()
+        self.redirector.makeConnection(self.transport)
+
+    def testParseLine(self):
+        'The channel ID is optional.'
+        line = "http://a/ 192.168.100.1/- user2 GET myip=192.168.100.1 myport=3128"
+        self.assertEqual(self.redirector.parseLine(line), (None, "http://a/"))
+        self.assertEqual(self.redirector.parseLine("7 " + line), (7, "http://a/"))
+
+    def testConcurrent(self):
+        'Numbered lines are all in flight at once, and answered with their channel IDs.'
+        self.redirector.dataReceived("0 http://a/ - - GET\r\n1 http://b/ - - GET\n")
+        self.assertEqual(sorted(self.core.urls), ["http://a/", "http://b/"])
+        self.core.urls["http://b/"].callback("http://deny/")
+        self.core.urls["http://a/"].callback("")
+        self.assertEqual(self.transport.value(), "1 http://deny/\n0 \n")
+
+    def testUnnumberedInOrder(self):
+        'Lines without channel IDs are answered in the order they came in.'
+        self.redirector.dataReceived("http://a/\nhttp://b/\n")
+        self.core.urls["http://b/"].callback("http://deny/")
+        self.assertEqual(self.transport.value(), "")
+        self.core.urls["http://a/"].callback("")
+        self.assertEqual(self.transport.value(), "\nhttp://deny/\n")
+
+    def testCoreUnreachable(self):
+        'A url the core can not be asked about is still answered.'
+        self.redirector.dataReceived("3 http://a/\n")
+        self.core.urls["http://a/"].errback(ConnectionRefusedError())
+        self.assertEqual(self.transport.value(), "3 \n")
+
+
+def suite():
+    redirector_suite = unittest.makeSuite(RedirectorTest)
+    suite = unittest.TestSuite((redirector_suite))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.main()
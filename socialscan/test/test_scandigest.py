@@ -25,7 +25,11 @@ for d in [projectdir, path.join(projectdir, 'socialscan'), path.join(projectdir,
     if d not in sys.path:
         sys.path.append(d)
 
+from pybloom import ScalableBloomFilter
+
 from f3ds.framework.exceptions import ContainerFullError, ZeroSizedDigestError, DigestModifiedTimeError
+from f3ds.framework.model.index import DigestIndex
+from f3ds.framework.model.mappedfilter import CuckooFilter, MappedBloomFilter, StoredFilter
 from f3ds.framework.util import UrlObject
 from socialscan.model import scandigest
 from socialscan.util import SigInfo
@@ -228,6 +232,325 @@ class ScanDigestTest(unittest.TestCase):
         sd = scandigest.ScanDigest.load(self.sdpath)
         self.assertEqual(len(sd), len(data))
 
+    def testAddManyAllFit(self):
+        'add_many takes every item when they fit, and they can all be found afterwards.'
+        now = trim_microseconds(datetime.utcnow())
+        si = SigInfo('Test Scanner Version 0.14', 'signature version 9.12.10', now)
+        sd = scandigest.ScanDigest(300, si, self.sdpath, nonce=12345)
+        urlobjects = [UrlObject('http://www.froogly.com/%d' % i, 3425, nonce=self.name,
+                                hash='content %d' % i) for i in range(250)]
+        self.assertEqual(sd.add_many(urlobjects), len(urlobjects))
+        self.assertEqual(len(sd), len(urlobjects))
+        self.assertFalse(sd.saved)
+        for uo in urlobjects:
+            self.assertTrue(sd.get(uo))
+        sd.save()
+        sd = scandigest.ScanDigest.load(self.sdpath)
+        for uo in urlobjects:
+            self.assertTrue(sd.get(uo))
+        sd.close()
+
+    def testAddManyOverflow(self):
+        'add_many stops at capacity and returns the position of the first item left over.'
+        now = trim_microseconds(datetime.utcnow())
+        si = SigInfo('Test Scanner Version 0.14', 'signature version 9.12.10', now)
+        sd = scandigest.ScanDigest(10, si, self.sdpath, nonce=12345)
+        urlobjects = [UrlObject('http://www.froogly.com/%d' % i, 3425, nonce=self.name,
+                                hash='content %d' % i) for i in range(15)]
+        self.assertEqual(sd.add_many(urlobjects[:4]), 4)
+        self.assertEqual(sd.add_many(urlobjects[4:]), 6)
+        self.assertEqual(len(sd), 10)
+        for uo in urlobjects[:10]:
+            self.assertTrue(sd.get(uo))
+        self.assertEqual(sd.add_many(urlobjects[10:]), 0)
+        self.assertRaises(ContainerFullError, sd.add, urlobjects[10])
+
+    def testLoadIsMapped(self):
+        'A digest saved in the mapped format is probed from a mapping after loading.'
+        now = trim_microseconds(datetime.utcnow())
+        si = SigInfo('Test Scanner Version 0.14', 'signature version 9.12.10', now)
+        sd = scandigest.ScanDigest(300, si, self.sdpath, nonce=12345,
+                                   fileformat='mapped')
+        urlobjects = [UrlObject('http://www.froogly.com/%d' % i, 3425, nonce=self.name,
+                                hash='content %d' % i) for i in range(250)]
+        for uo in urlobjects:
+            sd.add(uo)
+        sd.save()
+        sd = scandigest.ScanDigest.load(self.sdpath)
+        self.assertTrue(isinstance(sd.filterS, MappedBloomFilter))
+        self.assertTrue(len(sd.filterS.filters) > 1)
+        self.assertEqual(len(sd), len(urlobjects))
+        for uo in urlobjects:
+            self.assertTrue(sd.get(uo))
+        missing = UrlObject('http://www.froogly.com/missing', 3425, nonce=self.name,
+                            hash='missing content')
+        self.assertFalse(sd.get(missing))
+        sd.close()
+
+    def testDemotePromote(self):
+        'A demoted digest is probed from the file, and mapped again when promoted.'
+        now = trim_microseconds(datetime.utcnow())
+        si = SigInfo('Test Scanner Version 0.14', 'signature version 9.12.10', now)
+        sd = scandigest.ScanDigest(300, si, self.sdpath, nonce=12345,
+                                   fileformat='mapped')
+        urlobjects = [UrlObject('http://www.froogly.com/%d' % i, 3425, nonce=self.name,
+                                hash='content %d' % i) for i in range(250)]
+        for uo in urlobjects:
+            sd.add(uo)
+        self.assertFalse(sd.demote())
+        sd.save()
+        sd = scandigest.ScanDigest.load(self.sdpath)
+        self.assertTrue(sd.demote())
+        self.assertTrue(sd.filterS.ondisk)
+        missing = UrlObject('http://www.froogly.com/missing', 3425, nonce=self.name,
+                            hash='missing content')
+        for uo in urlobjects:
+            self.assertTrue(sd.get(uo))
+        self.assertFalse(sd.get(missing))
+        sd.promote()
+        self.assertFalse(sd.filterS.ondisk)
+        for uo in urlobjects:
+            self.assertTrue(sd.get(uo))
+        sd.close()
+
+    def testBackends(self):
+        'Digests of every backend are saved with their backend, and load and search as such.'
+        now = trim_microseconds(datetime.utcnow())
+        si = SigInfo('Test Scanner Version 0.14', 'signature version 9.12.10', now)
+        urlobjects = [UrlObject('http://www.froogly.com/%d' % i, 3425, nonce=self.name,
+                                hash='content %d' % i) for i in range(300)]
+        missing = [UrlObject('http://www.froogly.com/missing/%d' % i, 3425, nonce=self.name,
+                             hash='missing %d' % i) for i in range(1000)]
+        for backend in ['blocked', 'cuckoo']:
+            sd = scandigest.ScanDigest(300, si, self.sdpath, nonce=12345, backend=backend)
+            self.assertEqual(sd.add_many(urlobjects[:250]), 250)
+            sd.save()
+            sd = scandigest.ScanDigest.load(self.sdpath)
+            self.assertEqual(sd.filterS.name, backend)
+            self.assertTrue(sd.filterS.mapping is not None)
+            self.assertFalse(DigestIndex().add('digest', sd))
+            for uo in urlobjects[:250]:
+                self.assertTrue(sd.get(uo))
+            self.assertTrue(sum([sd.get(uo) for uo in missing]) < 10)
+            for uo in urlobjects[250:]:
+                sd.add(uo)
+            sd.save()
+            sd = scandigest.ScanDigest.load(self.sdpath)
+            self.assertEqual(len(sd), 300)
+            self.assertTrue(sd.demote())
+            for uo in urlobjects:
+                self.assertTrue(sd.get(uo))
+            self.assertRaises(ContainerFullError, sd.add, missing[0])
+            sd.close()
+
+    def testScalableReadableByOlderPeers(self):
+        'The scalable backend is mapped without the backend field, as format version 2.'
+        now = trim_microseconds(datetime.utcnow())
+        si = SigInfo('Test Scanner Version 0.14', 'signature version 9.12.10', now)
+        sd = scandigest.ScanDigest(23, si, self.sdpath, nonce=12345,
+                                   fileformat='mapped')
+        sd.add(UrlObject('http://www.froogly.com/first', 3425, nonce=self.name, hash='first'))
+        sd.save()
+        with open(self.sdpath, 'rb') as f:
+            f.seek(scandigest.ScanDigest.transformer.size)
+            magic, version, nfilters = StoredFilter.marker.unpack(
+                f.read(StoredFilter.marker.size))
+        self.assertEqual(version, 2)
+
+    def testUnknownBackend(self):
+        'A digest from a backend not known here can not be loaded.'
+        now = trim_microseconds(datetime.utcnow())
+        si = SigInfo('Test Scanner Version 0.14', 'signature version 9.12.10', now)
+        sd = scandigest.ScanDigest(23, si, self.sdpath, nonce=12345, backend='blocked')
+        sd.add(UrlObject('http://www.froogly.com/first', 3425, nonce=self.name, hash='first'))
+        sd.save()
+        with open(self.sdpath, 'r+b') as f:
+            f.seek(scandigest.ScanDigest.transformer.size + StoredFilter.marker.size +
+                   StoredFilter.generation_field.size)
+            f.write(StoredFilter.backend_field.pack(99))
+        self.assertRaises(ValueError, scandigest.ScanDigest.load, self.sdpath)
+        self.assertRaises(ValueError, scandigest.ScanDigest, 23, si, self.sdpath,
+                          backend='unknown')
+        self.assertRaises(ValueError, scandigest.ScanDigest, 23, si, self.sdpath,
+                          fileformat='unknown')
+
+    def testCuckooFull(self):
+        'A cuckoo filter with no room left refuses a key and keeps every key it took.'
+        cuckoo = CuckooFilter.create(8, 0.001)
+        keys = []
+        try:
+            for i in xrange(1000):
+                key = 'key %d' % i
+                cuckoo.add(key)
+                keys.append(key)
+        except ContainerFullError:
+            pass
+        self.assertTrue(len(keys) >= 8)
+        self.assertTrue(len(keys) <= cuckoo.nbuckets * cuckoo.slots)
+        for key in keys:
+            self.assertTrue(key in cuckoo)
+
+    def testAddAfterMappedLoad(self):
+        'Adding to a mapped digest copies it into memory; it can then be saved and reloaded.'
+        now = trim_microseconds(datetime.utcnow())
+        si = SigInfo('Test Scanner Version 0.14', 'signature version 9.12.10', now)
+        sd = scandigest.ScanDigest(23, si, self.sdpath, nonce=12345,
+                                   fileformat='mapped')
+        first = UrlObject('http://www.froogly.com/first', 3425, nonce=self.name, hash='first')
+        second = UrlObject('http://www.froogly.com/second', 3425, nonce=self.name, hash='second')
+        sd.add(first)
+        sd.save()
+        sd = scandigest.ScanDigest.load(self.sdpath)
+        self.assertTrue(sd.add(second))
+        self.assertFalse(isinstance(sd.filterS, MappedBloomFilter))
+        sd.save()
+        sd = scandigest.ScanDigest.load(self.sdpath)
+        self.assertTrue(sd.get(first))
+        self.assertTrue(sd.get(second))
+        self.assertEqual(len(sd), 2)
+        sd.close()
+
+    def testLoadScalableFormat(self):
+        'Digests are saved in the ScalableBloomFilter format by default, which older peers read.'
+        now = trim_microseconds(datetime.utcnow())
+        si = SigInfo('Test Scanner Version 0.14', 'signature version 9.12.10', now)
+        sd = scandigest.ScanDigest(23, si, self.sdpath, nonce=12345)
+        uo = UrlObject('http://www.froogly.com/first', 3425, nonce=self.name, hash='first')
+        sd.add(uo)
+        sd.save()
+        with open(self.sdpath, 'rb') as f:
+            f.seek(scandigest.ScanDigest.transformer.size)
+            self.assertTrue(isinstance(ScalableBloomFilter.fromfile(f), ScalableBloomFilter))
+        sd = scandigest.ScanDigest.load(self.sdpath)
+        self.assertFalse(isinstance(sd.filterS, MappedBloomFilter))
+        self.assertEqual(sd.siginfo, si)
+        self.assertTrue(sd.get(uo))
+
+    def testLoadTruncatedMapped(self):
+        'A mapped digest cut short should result in a ValueError.'
+        now = trim_microseconds(datetime.utcnow())
+        si = SigInfo('Test Scanner Version 0.14', 'signature version 9.12.10', now)
+        sd = scandigest.ScanDigest(23, si, self.sdpath, nonce=12345,
+                                   fileformat='mapped')
+        sd.add(UrlObject('http://www.froogly.com/first', 3425, nonce=self.name, hash='first'))
+        sd.save()
+        size = os.path.getsize(self.sdpath)
+        with open(self.sdpath, 'r+b') as f:
+            f.truncate(size - 16)
+        self.assertRaises(ValueError, scandigest.ScanDigest.load, (self.sdpath))
+
+    def testGenerationSaved(self):
+        'Each save is a new generation, which is kept in the file.'
+        now = trim_microseconds(datetime.utcnow())
+        si = SigInfo('Test Scanner Version 0.14', 'signature version 9.12.10', now)
+        sd = scandigest.ScanDigest(23, si, self.sdpath, nonce=12345,
+                                   fileformat='mapped')
+        self.assertEqual(sd.generation, 0)
+        sd.add(UrlObject('http://www.froogly.com/first', 3425, nonce=self.name, hash='first'))
+        sd.save()
+        sd.save()  # nothing new to save
+        self.assertEqual(sd.generation, 1)
+        sd = scandigest.ScanDigest.load(self.sdpath)
+        self.assertEqual(sd.generation, 1)
+        sd.add(UrlObject('http://www.froogly.com/second', 3425, nonce=self.name, hash='second'))
+        sd.save()
+        self.assertEqual(scandigest.ScanDigest.load(self.sdpath).generation, 2)
+
+    def copyDigest(self, sd):
+        'Copy the file of a saved digest, as a peer would download it, and load the copy.'
+        fd, copy = tempfile.mkstemp(dir=path.dirname(self.sdpath))
+        os.close(fd)
+        shutil.copyfile(sd.filename, copy)
+        return scandigest.ScanDigest.load(copy)
+
+    def testDeltaPatch(self):
+        'A copy patched with the blocks changed since its generation matches the original.'
+        now = trim_microseconds(datetime.utcnow())
+        si = SigInfo('Test Scanner Version 0.14', 'signature version 9.12.10', now)
+        sd = scandigest.ScanDigest(2000, si, self.sdpath, nonce=12345,
+                                   fileformat='mapped')
+        urlobjects = [UrlObject('http://www.froogly.com/%d' % i, 3425, nonce=self.name,
+                                hash='content %d' % i) for i in range(1005)]
+        for uo in urlobjects[:1000]:
+            sd.add(uo)
+        sd.save()
+        copy = self.copyDigest(sd)
+        for uo in urlobjects[1000:]:
+            sd.add(uo)
+        sd.save()
+        delta = sd.delta(copy.generation)
+        self.assertEqual(delta['generation'], 2)
+        blocks = -(-os.path.getsize(self.sdpath) // delta['blocksize'])
+        self.assertTrue(0 < len(delta['indexes']) < blocks)
+        copy.patch(delta)
+        self.assertTrue(isinstance(copy.filterS, MappedBloomFilter))
+        self.assertEqual(copy.generation, 2)
+        self.assertEqual(len(copy), len(urlobjects))
+        for uo in urlobjects:
+            self.assertTrue(copy.get(uo))
+        self.assertEqual(open(copy.filename, 'rb').read(), open(self.sdpath, 'rb').read())
+        self.assertEqual(sd.delta(2)['indexes'], [])
+        copy.close()
+        self.removeTempFile(copy.filename)
+
+    def testDeltaUnknown(self):
+        'Changes from before the digest was loaded, or from the future, are not known.'
+        now = trim_microseconds(datetime.utcnow())
+        si = SigInfo('Test Scanner Version 0.14', 'signature version 9.12.10', now)
+        sd = scandigest.ScanDigest(23, si, self.sdpath, nonce=12345,
+                                   fileformat='mapped')
+        sd.add(UrlObject('http://www.froogly.com/first', 3425, nonce=self.name, hash='first'))
+        sd.save()
+        sd = scandigest.ScanDigest.load(self.sdpath)
+        self.assertEqual(sd.delta(1), None)
+        sd.add(UrlObject('http://www.froogly.com/second', 3425, nonce=self.name, hash='second'))
+        sd.save()
+        self.assertEqual(sd.delta(1), None)
+        self.assertEqual(sd.delta(3), None)
+        self.assertEqual(sd.delta(2)['indexes'], [])
+
+    def testPatchMismatch(self):
+        'A patch that does not reproduce the original is refused.'
+        now = trim_microseconds(datetime.utcnow())
+        si = SigInfo('Test Scanner Version 0.14', 'signature version 9.12.10', now)
+        sd = scandigest.ScanDigest(23, si, self.sdpath, nonce=12345,
+                                   fileformat='mapped')
+        sd.add(UrlObject('http://www.froogly.com/first', 3425, nonce=self.name, hash='first'))
+        sd.save()
+        copy = self.copyDigest(sd)
+        sd.add(UrlObject('http://www.froogly.com/second', 3425, nonce=self.name, hash='second'))
+        sd.save()
+        delta = sd.delta(1)
+        delta['checksum'] = 'not the checksum'
+        self.assertRaises(ValueError, copy.patch, delta)
+        self.removeTempFile(copy.filename)
+
+    def testPatchOutOfRange(self):
+        'A delta with a block outside its length, or growing the file too far, is refused.'
+        now = trim_microseconds(datetime.utcnow())
+        si = SigInfo('Test Scanner Version 0.14', 'signature version 9.12.10', now)
+        sd = scandigest.ScanDigest(23, si, self.sdpath, nonce=12345,
+                                   fileformat='mapped')
+        sd.add(UrlObject('http://www.froogly.com/first', 3425, nonce=self.name, hash='first'))
+        sd.save()
+        copy = self.copyDigest(sd)
+        sd.add(UrlObject('http://www.froogly.com/second', 3425, nonce=self.name, hash='second'))
+        sd.save()
+        original = open(copy.filename, 'rb').read()
+        delta = sd.delta(1)
+        size = delta['blocksize']
+        outside = dict(delta, indexes=delta['indexes'] + [delta['length'] // size + 1])
+        self.assertRaises(ValueError, copy.patch, outside)
+        toolong = dict(delta, length=len(original) + (len(delta['indexes']) + 1) * size)
+        self.assertRaises(ValueError, copy.patch, toolong)
+        self.assertRaises(ValueError, copy.patch, dict(delta, length=-1))
+        self.assertEqual(open(copy.filename, 'rb').read(), original)
+        self.assertTrue(copy.get(UrlObject('http://www.froogly.com/first', 3425,
+                                           nonce=self.name, hash='first')))
+        copy.patch(delta)
+        self.assertEqual(open(copy.filename, 'rb').read(), open(self.sdpath, 'rb').read())
+        self.removeTempFile(copy.filename)
+
     # Because load requires a file object, testing load from a non-existent file makes no
     # sense.  However, testing with an empty file, or a file that does not match
     # expectations (not big enough, only has metadata, wrong packing format) does make
@@ -290,6 +613,22 @@ class ScanDigestTest(unittest.TestCase):
         self.assertRaises(DigestModifiedTimeError, sd.verify_save, (time.time() + 1000))
         self.removeTempFile(tmp)
 
+    def testVerifySaveCoarseMtime(self):
+        'A modification time trailing the save by less than mtime_resolution is accepted.'
+        fd, tmp = tempfile.mkstemp(dir=path.dirname(self.sdpath))
+        os.write(fd, 'The brown lazy fox held on for dear life while the cow jumped over the moon.')
+        os.close(fd)
+        now = trim_microseconds(datetime.utcnow())
+        si = SigInfo('Test Scanner Version 0.14', 'signature version 9.12.10', now)
+        sd = scandigest.ScanDigest(23, si, self.sdpath, nonce=12345)
+        sd.filename = tmp
+        age = time.time()
+        os.utime(tmp, (age, age - sd.mtime_resolution / 2))
+        sd.verify_save(age)
+        os.utime(tmp, (age, age - sd.mtime_resolution * 2))
+        self.assertRaises(DigestModifiedTimeError, sd.verify_save, age)
+        self.removeTempFile(tmp)
+
     def testVerifySaveRecentFile(self):
         before_write = time.time()
         fd, tmp = tempfile.mkstemp(dir=path.dirname(self.sdpath))
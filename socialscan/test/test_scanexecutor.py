@@ -0,0 +1,240 @@
+"""
+Unit test module for the scan executor
+Run tests by executing on the command line: python test_scanexecutor.py
+"""
+
+import sys
+import unittest
+
+from os import path
+
+# Modify the path to include the source under test
+# Then we can run the unit tests from the test directory
+# __file__ is <root>/test/test_scanexecutor.py
+pdn = path.dirname
+thisfile = path.abspath(__file__)
+projectdir = pdn(pdn(thisfile))
+f3dsdir = pdn(projectdir)
+for d in [projectdir,
+          f3dsdir,
+          path.join(projectdir, 'socialscan'),
+          path.join(projectdir, 'util'),
+          path.join(projectdir, 'test')]:
+    if d not in sys.path:
+        sys.path.append(d)
+
+from twisted.internet import task
+
+from socialscan.exceptions import IncompleteScanError, ScanQueueFullError
+from socialscan.scanexecutor import LOCAL, ScanBatcher, ScanExecutor, peerPriority
+from test_peerrpc import FakeWorkers
+
+
+class ScanExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.pool = FakeWorkers()
+        self.executor = ScanExecutor(workers=2, maxqueue=3, reportinterval=1000.0,
+                                     pool=self.pool, clock=lambda: self.now)
+        self.results = []
+
+    def submit(self, priority, value):
+        d = self.executor.run(priority, 'dummy', lambda: value)
+        d.addCallbacks(self.results.append, lambda f: self.results.append(f.type))
+        return d
+
+    def testRunsUpToWorkers(self):
+        'Scans beyond the number of workers should wait for one to finish.'
+        for i in range(3):
+            self.submit(LOCAL, i)
+        self.assertEqual(2, len(self.pool.calls))
+        self.assertEqual((2, 1), (self.executor.running, len(self.executor.queue)))
+        self.pool.answer(0)
+        self.assertEqual([0], self.results)
+        self.assertEqual(3, len(self.pool.calls))
+        self.pool.answer(2)
+        self.pool.answer(1)
+        self.assertEqual([0, 2, 1], self.results)
+        self.assertEqual(0, self.executor.running)
+
+    def testPriority(self):
+        'Local scans should go first, then peers nearest first, in order of arrival.'
+        self.submit(LOCAL, 'busy1')
+        self.submit(LOCAL, 'busy2')
+        self.submit(peerPriority(2.0), 'far')
+        self.submit(peerPriority(1.0), 'near')
+        self.submit(LOCAL, 'local')
+        self.pool.answer(0)
+        self.pool.answer(1)
+        self.pool.answer(2)
+        self.pool.answer(3)
+        self.pool.answer(4)
+        self.assertEqual(['busy1', 'busy2', 'local', 'near', 'far'], self.results)
+
+    def testFullQueue(self):
+        'A full queue should push out its least urgent scan, or turn the new one away.'
+        self.submit(LOCAL, 'busy1')
+        self.submit(LOCAL, 'busy2')
+        for distance in (1.0, 2.0, 3.0):
+            self.submit(peerPriority(distance), distance)
+        self.assertFalse(self.executor.accepts(peerPriority(3.0)))
+        self.assertTrue(self.executor.accepts(peerPriority(2.5)))
+        self.submit(peerPriority(4.0), 4.0)
+        self.assertEqual([ScanQueueFullError], self.results)
+        self.submit(LOCAL, 'local')
+        self.assertEqual([ScanQueueFullError, ScanQueueFullError], self.results)
+        self.assertEqual(2, self.executor.rejected)
+        self.assertEqual(3, len(self.executor.queue))
+        for i in range(5):
+            self.pool.answer(i)
+        self.assertEqual(['busy1', 'busy2', 'local', 1.0, 2.0], self.results[2:])
+        self.assertTrue(issubclass(ScanQueueFullError, IncompleteScanError))
+
+    def testBackpressure(self):
+        'idle and pressure should follow the running and waiting scans.'
+        self.assertEqual((2, 0.0), (self.executor.idle, self.executor.pressure))
+        self.submit(LOCAL, 1)
+        self.assertEqual(1, self.executor.idle)
+        for i in range(4):
+            self.submit(LOCAL, i)
+        self.assertEqual((0, 1.0), (self.executor.idle, self.executor.pressure))
+
+    def testFailure(self):
+        'A scan which raises should fail its Deferred and free its worker.'
+        def fail():
+            raise IOError('gone')
+        failures = []
+        self.executor.run(LOCAL, 'dummy', fail).addErrback(failures.append)
+        self.pool.answer(0)
+        self.assertEqual(IOError, failures[0].type)
+        self.assertEqual(0, self.executor.running)
+
+    def testLatency(self):
+        'Waiting and scanning times should be kept per handler.'
+        self.submit(LOCAL, 1)
+        self.submit(LOCAL, 2)
+        self.executor.run(LOCAL, 'other', lambda: 3)
+        self.now = 2.0
+        self.pool.answer(0)
+        self.now = 5.0
+        self.pool.answer(2)
+        self.pool.answer(1)
+        dummy = self.executor.latency['dummy']
+        self.assertEqual((2, 0.0, 7.0, 5.0), (dummy.count, dummy.wait, dummy.scan, dummy.slowest))
+        other = self.executor.latency['other']
+        self.assertEqual((1, 2.0, 3.0), (other.count, other.wait, other.scan))
+        stats = self.executor.stats()
+        self.assertEqual((0, 0, 0), (stats['queued'], stats['running'], stats['rejected']))
+        self.assertEqual(set(['dummy', 'other']), set(stats['latency']))
+
+
+class FakeHandler(object):
+    'Finds files named evil*, and cannot read files named missing*.'
+
+    def __init__(self):
+        self.batches = []
+
+    def scan(self, filename):
+        if filename.startswith('missing'):
+            raise IOError(filename)
+        return filename.startswith('evil'), 'siginfo'
+
+
+class FakeBatchHandler(FakeHandler):
+
+    def scan_many(self, filenames):
+        self.batches.append(list(filenames))
+        results = []
+        for filename in filenames:
+            try:
+                results.append(self.scan(filename))
+            except IOError, e:
+                results.append(e)
+        return results
+
+
+class ScanBatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.pool = FakeWorkers()
+        self.executor = ScanExecutor(workers=2, maxqueue=4, pool=self.pool)
+        self.handler = FakeBatchHandler()
+        self.batcher = ScanBatcher(self.executor, 'fake', self.handler, window=0.5, maxsize=3,
+                                   reactor=self.clock)
+        self.results = []
+
+    def add(self, priority, filename):
+        d = self.batcher.add(priority, filename)
+        d.addCallbacks(lambda r: self.results.append((filename, r[0])),
+                       lambda f: self.results.append((filename, f.type)))
+
+    def testWindow(self):
+        'Files given within the window should be scanned in one call of scan_many.'
+        self.add(peerPriority(1.0), 'good1')
+        self.clock.advance(0.3)
+        self.add(peerPriority(1.0), 'evil1')
+        self.assertEqual([], self.pool.calls)
+        self.clock.advance(0.3)
+        self.assertEqual(1, len(self.pool.calls))
+        self.pool.answer(0)
+        self.assertEqual([['good1', 'evil1']], self.handler.batches)
+        self.assertEqual([('good1', False), ('evil1', True)], self.results)
+        self.assertEqual(1, self.executor.latency['fake'].count)
+
+    def testFullBatch(self):
+        'A full batch should be scanned without waiting out the window.'
+        for name in ('good1', 'good2', 'evil1', 'good3'):
+            self.add(peerPriority(1.0), name)
+        self.assertEqual(1, len(self.pool.calls))
+        self.pool.answer(0)
+        self.clock.advance(0.5)
+        self.pool.answer(1)
+        self.assertEqual([['good1', 'good2', 'evil1'], ['good3']], self.handler.batches)
+        self.assertEqual(4, len(self.results))
+
+    def testPriority(self):
+        'A batch should run at the priority of its most urgent file.'
+        self.add(peerPriority(3.0), 'good1')
+        self.add(peerPriority(1.0), 'good2')
+        self.assertEqual(peerPriority(1.0), self.batcher.pending.priority)
+
+    def testFileFailure(self):
+        'A file which could not be scanned should fail alone.'
+        for name in ('good1', 'missing1', 'evil1'):
+            self.add(peerPriority(1.0), name)
+        self.pool.answer(0)
+        self.assertEqual([('good1', False), ('missing1', IOError), ('evil1', True)],
+                         self.results)
+
+    def testFallback(self):
+        'Handlers without scan_many should have each file scanned with scan.'
+        self.batcher.handler = FakeHandler()
+        for name in ('evil1', 'missing1'):
+            self.add(peerPriority(1.0), name)
+        self.clock.advance(0.5)
+        self.pool.answer(0)
+        self.assertEqual([('evil1', True), ('missing1', IOError)], self.results)
+
+    def testBatchFailure(self):
+        'A batch which fails as a whole should fail every file in it.'
+        def fail(files):
+            raise IOError('scanner gone')
+        self.batcher._scan = fail
+        for name in ('good1', 'evil1'):
+            self.add(peerPriority(1.0), name)
+        self.clock.advance(0.5)
+        self.pool.answer(0)
+        self.assertEqual([('good1', IOError), ('evil1', IOError)], self.results)
+
+
+def suite():
+    executor_suite = unittest.makeSuite(ScanExecutorTest)
+    batcher_suite = unittest.makeSuite(ScanBatcherTest)
+    suite = unittest.TestSuite((executor_suite, batcher_suite))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -7,6 +7,8 @@ import unittest
 import sys
 import os
 import datetime
+import shutil
+import tempfile
 import time
 
 from os import path
@@ -21,7 +23,9 @@ for d in [projectdir, path.join(projectdir, 'socialscan'), path.join(projectdir,
     if d not in sys.path:
         sys.path.append(d)
 
+from socialscan import scanhandlers
 from socialscan.scanhandlers import dummy
+from socialscan.scanhandlers.daemon import ScannerDaemon, ScannerDaemonError
 from unittestutils import trim_microseconds
 
 class DummyTest(unittest.TestCase):
@@ -71,10 +75,194 @@ class DummyTest(unittest.TestCase):
         actual = (si.scannervv, si.sigversion, trim_microseconds(si.sigdate))
         self.assertEquals(expected, actual)
 
+    def testScanMany(self):
+        "scan_many should give each file's result, or the error for a file it cannot read."
+        files = [self.benignfile, 'data/nosuchfile', self.maliciousfile]
+        results = scanhandlers.scanMany(dummy, files)
+        self.assertEqual(3, len(results))
+        self.assertEqual(dummy.scan(self.benignfile), results[0])
+        self.assertTrue(isinstance(results[1], IOError))
+        self.assertEqual(dummy.scan(self.maliciousfile), results[2])
+
+
+class DummyDaemonTest(DummyTest):
+
+    def setUp(self):
+        DummyTest.setUp(self)
+        self.daemon = dummy.startDaemon()
+
+    def tearDown(self):
+        self.daemon.stop()
+        DummyTest.tearDown(self)
+
+    def siginfo(self, si):
+        return (si.scannervv, si.sigversion, trim_microseconds(si.sigdate))
+
+    def testDaemonGetSigInfo(self):
+        "The daemon's banner gives the signature info."
+        si = self.daemon.getSigInfo()
+        expected = (self.scannerfile, self.version, trim_microseconds(self.curtime))
+        self.assertEqual(expected, self.siginfo(si))
+
+    def testDaemonScan(self):
+        "One process should scan file after file, with the same results as scan."
+        for i in range(3):
+            self.assertEqual(dummy.scan(self.benignfile), self.daemon.scan(self.benignfile))
+            self.assertEqual(dummy.scan(self.maliciousfile),
+                             self.daemon.scan(self.maliciousfile))
+        self.assertEqual(0, self.daemon.restarts)
+
+    def testDaemonMissingFile(self):
+        "A file the daemon cannot read should raise, without restarting it."
+        self.daemon.scan(self.benignfile)
+        self.assertRaises(IOError, self.daemon.scan, 'data/nosuchfile')
+        self.assertEqual(0, self.daemon.restarts)
+        self.assertTrue(self.daemon.scan(self.maliciousfile)[0])
+
+    def testDaemonRestart(self):
+        "A process that has died should be restarted and the scan carried out."
+        self.daemon.scan(self.benignfile)
+        self.daemon.process.kill()
+        self.daemon.process.wait()
+        self.assertTrue(self.daemon.scan(self.maliciousfile)[0])
+        self.assertEqual(1, self.daemon.restarts)
+
+    def testDaemonCheck(self):
+        "The health check should pass a running process and restart a dead one."
+        self.daemon.scan(self.benignfile)
+        self.assertTrue(self.daemon.check())
+        self.daemon.process.kill()
+        self.daemon.process.wait()
+        self.assertFalse(self.daemon.check())
+        self.assertTrue(self.daemon.alive())
+        self.assertTrue(self.daemon.check())
+        self.assertEqual(1, self.daemon.restarts)
+
+    def testDaemonScanMany(self):
+        "The daemon should take a batch of files in one go, failing only unreadable ones."
+        files = [self.benignfile, 'data/nosuchfile', self.maliciousfile] * 3
+        results = scanhandlers.scanMany(self.daemon, files)
+        self.assertEqual(len(files), len(results))
+        for filename, result in zip(files, results):
+            if filename == 'data/nosuchfile':
+                self.assertTrue(isinstance(result, IOError))
+            else:
+                self.assertEqual(dummy.scan(filename), result)
+        self.assertEqual(0, self.daemon.restarts)
+        self.assertTrue(self.daemon.scan(self.maliciousfile)[0])
+
+    def testDaemonIdle(self):
+        "An idle process should be pinged before it scans."
+        self.daemon.idle = 0
+        self.assertFalse(self.daemon.scan(self.benignfile)[0])
+        self.assertTrue(self.daemon.scan(self.maliciousfile)[0])
+        self.assertEqual(0, self.daemon.restarts)
+
+    def testDaemonTimeout(self):
+        "A process that never answers should be given up on after the timeout."
+        self.daemon = ScannerDaemon([sys.executable, '-c', 'import time; time.sleep(60)'],
+                                    lambda filename, line: (False, None), timeout=0.2)
+        self.daemon.retries = 1
+        self.assertRaises(ScannerDaemonError, self.daemon.scan, self.benignfile)
+        self.assertEqual(1, self.daemon.restarts)
+        self.assertFalse(self.daemon.alive())
+
+    def testSession(self):
+        "A handler's session is its shared daemon, or the handler if it has none."
+        self.assertTrue(scanhandlers.session('dummy') is scanhandlers.session('dummy'))
+        self.assertTrue(isinstance(scanhandlers.session('dummy'), dummy.DummyDaemon))
+        self.assertTrue(scanhandlers.session('mcafee') is scanhandlers.get('mcafee'))
+        scanhandlers.session('dummy').stop()
+
+
+class SigInfoCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sigdir = tempfile.mkdtemp()
+        self.loads = 0
+        self.version = 1
+        self.changes = []
+        self.cache = scanhandlers.SigInfoCache(self.load, [self.sigdir])
+        self.cache.subscribe(self.changes.append)
+
+    def tearDown(self):
+        shutil.rmtree(self.sigdir)
+
+    def load(self):
+        self.loads += 1
+        return 'signatures %d' % self.version
+
+    def touch(self, mtime):
+        os.utime(self.sigdir, (mtime, mtime))
+
+    def testCached(self):
+        'The SigInfo should only be loaded again once the watched directory changes.'
+        self.touch(1000)
+        for i in range(3):
+            self.assertEqual('signatures 1', self.cache.getSigInfo())
+        self.assertEqual(1, self.loads)
+        self.version = 2
+        self.assertEqual('signatures 1', self.cache.getSigInfo())
+        self.touch(2000)
+        self.assertEqual('signatures 2', self.cache.getSigInfo())
+        self.assertEqual('signatures 2', self.cache.getSigInfo())
+        self.assertEqual(2, self.loads)
+
+    def testInvalidate(self):
+        'invalidate should have the SigInfo loaded again.'
+        self.cache.getSigInfo()
+        self.version = 2
+        self.cache.invalidate()
+        self.assertEqual('signatures 2', self.cache.getSigInfo())
+        self.assertEqual(2, self.loads)
+
+    def testListeners(self):
+        'Listeners should be told of new signatures, but not of the first or the same ones.'
+        self.touch(1000)
+        self.cache.getSigInfo()
+        self.touch(2000)
+        self.cache.getSigInfo()
+        self.assertEqual([], self.changes)
+        self.version = 2
+        self.cache.invalidate()
+        self.cache.getSigInfo()
+        self.assertEqual(['signatures 2'], self.changes)
+        self.cache.unsubscribe(self.changes.append)
+        self.version = 3
+        self.cache.invalidate()
+        self.cache.getSigInfo()
+        self.assertEqual(['signatures 2'], self.changes)
+
+    def testUnwatched(self):
+        'Without paths to watch, the SigInfo is asked for every time.'
+        cache = scanhandlers.SigInfoCache(self.load)
+        cache.getSigInfo()
+        cache.getSigInfo()
+        self.assertEqual(2, self.loads)
+
+    def testDummy(self):
+        "The dummy handler's SigInfo should follow its signature file."
+        cache = scanhandlers.sigInfoCache('dummy')
+        self.assertTrue(cache is scanhandlers.sigInfoCache('dummy'))
+        try:
+            os.makedirs('data')
+        except OSError:
+            pass
+        for version in ('1.0', '2.0'):
+            f = open('data/dummy', 'w')
+            f.write('data/dummy\n%s\n%s\n' % (version, time.time()))
+            f.close()
+            os.utime('data/dummy', (time.time(), time.time() + float(version)))
+            self.assertEqual(version, dummy.getSigInfo().sigversion)
+            self.assertEqual(version, cache.getSigInfo().sigversion)
+        os.remove('data/dummy')
+
 
 def suite():
     dummy_suite = unittest.makeSuite(DummyTest)
-    suite = unittest.TestSuite((dummy_suite))
+    daemon_suite = unittest.makeSuite(DummyDaemonTest)
+    cache_suite = unittest.makeSuite(SigInfoCacheTest)
+    suite = unittest.TestSuite((dummy_suite, daemon_suite, cache_suite))
     return suite
 
 
@@ -194,6 +194,30 @@ aa671bbf7cc781825435501ecafdb417\
         self.assertFalse(uo.contenthash)
         self.assertFalse(uo)
 
+    def testRawForms(self):
+        'Test that the raw hashes are digests and url and contenthash their hex forms'
+        plain_url = 'https://amason.com/buywarez'
+        filesize = 5433
+        hash = '9fa3ce1ba6ce2de7af3de8ad4be1e4f0'
+        uo = util.UrlObject(plain_url, filesize, nonce=self.name, hash=hash)
+        self.assertEqual(uo.rawurl, sethash.hasher(plain_url).digest())
+        self.assertEqual(uo.rawcontenthash, sethash.hasher(hash).digest())
+        self.assertEqual(uo.url, uo.rawurl.encode('hex'))
+        self.assertEqual(uo.contenthash, uo.rawcontenthash.encode('hex'))
+        with self.assertRaises(AttributeError):
+            uo.unexpected = True
+
+    def testHashedRoundTrip(self):
+        'Test that a UrlObject made from the hex forms of another is equal to it'
+        plain_url = 'https://amason.com/buywarez'
+        filesize = 5433
+        hash = '9fa3ce1ba6ce2de7af3de8ad4be1e4f0'
+        uo1 = util.UrlObject(plain_url, filesize, nonce=self.name, hash=hash)
+        uo2 = util.UrlObject(uo1.url, filesize, nonce=self.name, hash=uo1.contenthash,
+                             is_hashed=True)
+        self.assertEqual(uo1, uo2)
+        self.assertEqual(uo2.rawurl, uo1.rawurl)
+
     def testEqual(self):
         'Test that two equivalent UrlObjects are equal.'
         plain_url = 'https://amason.com/buywarez'
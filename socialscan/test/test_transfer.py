@@ -0,0 +1,112 @@
+"""
+Unit test module for transfer module
+Run tests by executing on the command line: python test_transfer.py
+"""
+
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+from os import path
+
+# Modify the path to include the source under test
+# Then we can run the unit tests from the test directory
+# __file__ is <root>/test/test_transfer.py
+pdn = path.dirname
+thisfile = path.abspath(__file__)
+projectdir = pdn(pdn(thisfile))
+f3dsdir = pdn(projectdir)
+for d in [projectdir,
+          f3dsdir,
+          path.join(projectdir, 'socialscan'),
+          path.join(projectdir, 'util'),
+          path.join(projectdir, 'test')]:
+    if d not in sys.path:
+        sys.path.append(d)
+
+from f3ds.framework import transfer
+from f3ds.framework.exceptions import CorruptTransferError
+
+
+class TransferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.source = path.join(self.tempdir, 'container')
+        self.encoded = self.source + transfer.SUFFIX
+        # mostly zeros, like a sparse bloom filter
+        self.data = ('\0' * 5000 + 'bits') * 50
+        with open(self.source, 'wb') as f:
+            f.write(self.data)
+        transfer.encode(self.source, self.encoded)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def decode(self, encoded, chunk=100):
+        'Feed the encoded bytes to a DecodingWriter in chunks, as a download would.'
+        out = StringIO.StringIO()
+        writer = transfer.DecodingWriter(out)
+        for i in range(0, len(encoded), chunk):
+            writer.write(encoded[i:i + chunk])
+        writer.finish()
+        return out.getvalue()
+
+    def testRoundTrip(self):
+        'The encoded copy is smaller, and decodes to the container however it arrives.'
+        encoded = open(self.encoded, 'rb').read()
+        self.assertTrue(len(encoded) < len(self.data) / 10)
+        self.assertEqual(self.decode(encoded), self.data)
+        self.assertEqual(self.decode(encoded, chunk=3), self.data)
+        self.assertEqual(sorted(os.listdir(self.tempdir)), ['container', 'container.z'])
+
+    def testCorrupt(self):
+        'A changed byte is caught.'
+        encoded = open(self.encoded, 'rb').read()
+        header = transfer.HEADER.size
+        body = list(encoded[header:])
+        body[len(body) / 2] = chr(ord(body[len(body) / 2]) ^ 0xff)
+        self.assertRaises(CorruptTransferError, self.decode, encoded[:header] + ''.join(body))
+
+    def testCutShort(self):
+        'A download which stops early is caught.'
+        encoded = open(self.encoded, 'rb').read()
+        self.assertRaises(CorruptTransferError, self.decode, encoded[:-10])
+        self.assertRaises(CorruptTransferError, self.decode, encoded[:5])
+
+    def testTooLong(self):
+        'A body inflating to more than the header says is stopped as soon as it does.'
+        encoded = open(self.encoded, 'rb').read()
+        magic, version, length, checksum = transfer.HEADER.unpack(
+            encoded[:transfer.HEADER.size])
+        header = transfer.HEADER.pack(magic, version, 100, checksum)
+        out = StringIO.StringIO()
+        writer = transfer.DecodingWriter(out)
+        self.assertRaises(CorruptTransferError, writer.write,
+                          header + encoded[transfer.HEADER.size:])
+        self.assertTrue(len(out.getvalue()) <= 100)
+
+    def testNotEncoded(self):
+        'A plain container is not taken for an encoded one.'
+        self.assertRaises(CorruptTransferError, self.decode, self.data)
+
+    def testUrls(self):
+        'The encoded copy is offered at the container url with the suffix added.'
+        url = 'http://peer/shared/digests/1234'
+        self.assertTrue(transfer.isEncoded(transfer.encodedUrl(url)))
+        self.assertFalse(transfer.isEncoded(url))
+        self.assertEqual(transfer.containerUrl(transfer.encodedUrl(url)), url)
+        self.assertEqual(transfer.containerUrl(url), url)
+
+
+def suite():
+    transfer_suite = unittest.makeSuite(TransferTest)
+    suite = unittest.TestSuite((transfer_suite))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,194 @@
+"""
+Unit test module for urlretrieve module
+Run tests by executing on the command line: python test_urlretrieve.py
+"""
+
+import BaseHTTPServer
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import threading
+import urllib
+
+from os import path
+
+# Modify the path to include the source under test
+# Then we can run the unit tests from the test directory
+# __file__ is <root>/test/test_urlretrieve.py
+pdn = path.dirname
+thisfile = path.abspath(__file__)
+projectdir = pdn(pdn(thisfile))
+f3dsdir = pdn(projectdir)
+for d in [projectdir,
+          f3dsdir,
+          path.join(projectdir, 'socialscan'),
+          path.join(projectdir, 'util'),
+          path.join(projectdir, 'test')]:
+    if d not in sys.path:
+        sys.path.append(d)
+
+from twisted.internet import defer, task
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone, ResponseFailed
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+
+from f3ds.framework import filehash
+from f3ds.framework import urlretrieve
+
+
+class UrlRetrieveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filepath = path.join(self.tempdir, 'download')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def testRetrieveHashesWhileWriting(self):
+        'The download is written out, and its hash and size come back with it.'
+        url = 'file:' + urllib.pathname2url(thisfile)
+        retrieval = urlretrieve.retrieve(url, self.filepath, blocksize=100)
+        self.assertEqual(retrieval.filepath, self.filepath)
+        self.assertEqual(retrieval.contenthash, filehash.filehash(thisfile))
+        self.assertEqual(retrieval.filesize, path.getsize(thisfile))
+        self.assertEqual(filehash.filehash(self.filepath), retrieval.contenthash)
+        self.assertEqual(int(retrieval.headers['content-length']), retrieval.filesize)
+
+    def testRetrieveMissing(self):
+        'A url which can not be opened raises IOError.'
+        url = 'file:' + urllib.pathname2url(path.join(self.tempdir, 'missing'))
+        self.assertRaises(IOError, urlretrieve.retrieve, url, self.filepath)
+
+    def testBodyWriter(self):
+        'Chunks delivered to the body protocol are written and hashed as they arrive.'
+        writer = urlretrieve.HashingWriter(self.filepath)
+        finished = defer.Deferred()
+        protocol = urlretrieve._BodyWriter(writer, finished)
+        results = []
+        finished.addCallback(lambda ignored: results.append(writer.retrieval({})))
+        protocol.dataReceived('evil ')
+        protocol.dataReceived('bits')
+        protocol.connectionLost(Failure(ResponseDone()))
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0].filesize, 9)
+        with open(self.filepath, 'rb') as f:
+            self.assertEqual(f.read(), 'evil bits')
+        self.assertEqual(results[0].contenthash, filehash.filehash(self.filepath))
+
+    def testBodyWriterFailure(self):
+        'A body cut short fails the Deferred.'
+        writer = urlretrieve.HashingWriter(self.filepath)
+        finished = defer.Deferred()
+        protocol = urlretrieve._BodyWriter(writer, finished)
+        failures = []
+        finished.addErrback(failures.append)
+        protocol.dataReceived('evil')
+        protocol.connectionLost(Failure(ResponseFailed([])))
+        self.assertEqual(len(failures), 1)
+        self.assertTrue(writer.f.closed)
+
+    def testBodyWriterShort(self):
+        'A body ended by the connection closing short of its Content-Length fails.'
+        for size, outcome in [(9, 'done'), (12, 'failed')]:
+            writer = urlretrieve.HashingWriter(self.filepath)
+            finished = defer.Deferred()
+            protocol = urlretrieve._BodyWriter(writer, finished, length=size)
+            results = []
+            finished.addCallbacks(lambda ignored: results.append('done'),
+                                  lambda failure: results.append('failed'))
+            protocol.dataReceived('evil bits')
+            protocol.connectionLost(Failure(PotentialDataLoss()))
+            self.assertEqual(results, [outcome])
+
+    def testFetchErrorStatus(self):
+        'A response with other than a 2xx status fails with IOError, and nothing is written.'
+        agent = FakeAgent()
+        failures = []
+        urlretrieve.fetch('http://evil/', self.filepath, agent=agent,
+                          reactor=task.Clock()).addErrback(failures.append)
+        agent.pending.callback(FakeResponse(404, 'Not Found'))
+        self.assertEqual(len(failures), 1)
+        self.assertTrue(failures[0].check(IOError))
+        self.assertFalse(path.exists(self.filepath))
+
+    def testFetchTimeout(self):
+        'A download not done within the timeout is cancelled, and its body no longer read.'
+        agent = FakeAgent()
+        clock = task.Clock()
+        failures = []
+        d = urlretrieve.fetch('http://slow/', self.filepath, agent=agent, timeout=10,
+                              reactor=clock)
+        d.addErrback(failures.append)
+        response = FakeResponse(200, 'OK')
+        agent.pending.callback(response)
+        response.protocol.dataReceived('evil')
+        clock.advance(10)
+        self.assertEqual(len(failures), 1)
+        self.assertTrue(failures[0].check(defer.CancelledError))
+        self.assertTrue(response.transport.stopped)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def testRetrieveErrorStatus(self):
+        'retrieve raises IOError for a response with other than a 2xx status.'
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), NotFoundHandler)
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:%d/missing' % server.server_port
+            self.assertRaises(IOError, urlretrieve.retrieve, url, self.filepath, timeout=5)
+        finally:
+            thread.join()
+            server.server_close()
+
+
+class NotFoundHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.send_error(404)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeAgent(object):
+    'Answers a request with the Deferred kept in pending.'
+
+    def request(self, method, url):
+        self.pending = defer.Deferred()
+        return self.pending
+
+
+class FakeTransport(object):
+    stopped = False
+
+    def stopProducing(self):
+        self.stopped = True
+
+
+class FakeResponse(object):
+    'A response which hands its body protocol a transport, and nothing else.'
+
+    def __init__(self, code, phrase):
+        self.code = code
+        self.phrase = phrase
+        self.headers = Headers({'content-length': ['9']})
+        self.transport = FakeTransport()
+        self.protocol = None
+
+    def deliverBody(self, protocol):
+        self.protocol = protocol
+        protocol.makeConnection(self.transport)
+
+
+def suite():
+    urlretrieve_suite = unittest.makeSuite(UrlRetrieveTest)
+    suite = unittest.TestSuite((urlretrieve_suite))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.main()
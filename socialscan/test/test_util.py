@@ -102,9 +102,48 @@ class UtilTest(unittest.TestCase):
         self.assertEqual(ic.name, util.class_name(ic))
 
 
+class ExpiringLRUCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.cache = util.ExpiringLRUCache(2, 10, clock=lambda: self.now)
+
+    def testHitsAndMisses(self):
+        'Lookups are counted as hits or misses.'
+        self.cache.put('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def testLeastRecentlyUsedEvicted(self):
+        'A full cache forgets the entry used longest ago.'
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+        self.cache.get('a')
+        self.cache.put('c', 3)
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('c'), 3)
+
+    def testExpiry(self):
+        'Entries are forgotten after ttl seconds.'
+        self.cache.put('a', 1)
+        self.now = 9.5
+        self.assertEqual(self.cache.get('a'), 1)
+        self.now = 10.0
+        self.assertEqual(self.cache.get('a'), None)
+
+    def testDisabled(self):
+        'A cache of size 0 keeps nothing.'
+        cache = util.ExpiringLRUCache(0, 10)
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), None)
+
+
 def suite():
     util_suite = unittest.makeSuite(UtilTest)
-    suite = unittest.TestSuite((util_suite))
+    cache_suite = unittest.makeSuite(ExpiringLRUCacheTest)
+    suite = unittest.TestSuite((util_suite, cache_suite))
     return suite
 
 
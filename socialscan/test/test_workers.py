@@ -0,0 +1,106 @@
+"""
+Unit test module for workers module and the handler resolver
+Run tests by executing on the command line: python test_workers.py
+"""
+
+import sys
+import unittest
+
+from os import path
+
+# Modify the path to include the source under test
+# Then we can run the unit tests from the test directory
+# __file__ is <root>/test/test_workers.py
+pdn = path.dirname
+thisfile = path.abspath(__file__)
+projectdir = pdn(pdn(thisfile))
+f3dsdir = pdn(projectdir)
+for d in [projectdir,
+          f3dsdir,
+          path.join(projectdir, 'socialscan'),
+          path.join(projectdir, 'util'),
+          path.join(projectdir, 'test')]:
+    if d not in sys.path:
+        sys.path.append(d)
+
+from twisted.internet import defer
+
+from f3ds.framework import workers
+from f3ds.framework.core import resolve
+from test_filehash import FakeReactor
+
+
+class WorkerPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.workers = workers.WorkerPool('test', maxthreads=2, reactor=self.reactor)
+
+    def tearDown(self):
+        self.workers.stop()
+
+    def testRun(self):
+        'The Deferred fires with what the call returned.'
+        results = []
+        self.workers.run(lambda a, b=0: a + b, 1, b=2).addCallback(results.append)
+        self.reactor.runOne()
+        self.assertEqual(results, [3])
+
+    def testRunRaises(self):
+        'What the call raised fails the Deferred.'
+        failures = []
+        self.workers.run(int, 'not a number').addErrback(failures.append)
+        self.reactor.runOne()
+        self.assertEqual(len(failures), 1)
+        self.assertTrue(failures[0].check(ValueError))
+
+    def testGetPoolShared(self):
+        'Pools are shared by name.'
+        self.assertTrue(workers.getPool('shared') is workers.getPool('shared'))
+
+
+class ResolveTest(unittest.TestCase):
+
+    def resolved(self, result):
+        results = []
+        resolve(result).addBoth(results.append)
+        self.assertEqual(len(results), 1)
+        return results[0]
+
+    def testPlain(self):
+        'A plain result from a legacy handler is wrapped in a Deferred.'
+        self.assertEqual(self.resolved('safe'), 'safe')
+
+    def testDeferred(self):
+        'A Deferred is passed through.'
+        self.assertEqual(self.resolved(defer.succeed('safe')), 'safe')
+
+    def testGenerator(self):
+        'A resolver is run until it returns a value.'
+        def resolver():
+            value = yield defer.succeed('sa')
+            defer.returnValue(value + 'fe')
+        self.assertEqual(self.resolved(resolver()), 'safe')
+
+    def testWaits(self):
+        'A resolver waiting on a Deferred resolves once that fires.'
+        pending = defer.Deferred()
+        def resolver():
+            value = yield pending
+            defer.returnValue(value)
+        results = []
+        resolve(resolver()).addCallback(results.append)
+        self.assertEqual(results, [])
+        pending.callback('safe')
+        self.assertEqual(results, ['safe'])
+
+
+def suite():
+    workers_suite = unittest.makeSuite(WorkerPoolTest)
+    resolve_suite = unittest.makeSuite(ResolveTest)
+    suite = unittest.TestSuite((workers_suite, resolve_suite))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.main()
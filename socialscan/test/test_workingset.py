@@ -0,0 +1,111 @@
+"""
+Unit test module for workingset module
+Run tests by executing on the command line: python test_workingset.py
+"""
+
+import sys
+import unittest
+
+from os import path
+
+# Modify the path to include the source under test
+# Then we can run the unit tests from the test directory
+# __file__ is <root>/test/test_workingset.py
+pdn = path.dirname
+thisfile = path.abspath(__file__)
+projectdir = pdn(pdn(thisfile))
+f3dsdir = pdn(projectdir)
+for d in [projectdir,
+          f3dsdir,
+          path.join(projectdir, 'socialscan'),
+          path.join(projectdir, 'util'),
+          path.join(projectdir, 'test')]:
+    if d not in sys.path:
+        sys.path.append(d)
+
+from f3ds.framework.model.workingset import WorkingSet
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000000.0
+
+    def __call__(self):
+        return self.now
+
+
+class WorkingSetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.workingset = WorkingSet(limit=3, halflife=100, clock=self.clock)
+
+    def testDecay(self):
+        'A hit counts half as much after every half-life.'
+        ws = self.workingset
+        ws.add('a', 0)
+        ws.hit('a')
+        ws.hit('a')
+        self.assertAlmostEqual(ws.scoreOf(ws.keys['a']), 2.0)
+        self.clock.now += 200
+        self.assertAlmostEqual(ws.scoreOf(ws.keys['a']), 0.5)
+        ws.hit('a')
+        self.assertAlmostEqual(ws.scoreOf(ws.keys['a']), 1.5)
+
+    def testWeakest(self):
+        'Containers hit long ago are weaker than those hit just once lately.'
+        ws = self.workingset
+        for name in 'abc':
+            ws.add(name, 0)
+        self.assertEqual(ws.weakest(), ('a', WorkingSet.NEVER))
+        for i in range(3):
+            ws.hit('a')
+        self.clock.now += 300
+        ws.hit('b')
+        ws.hit('c')
+        self.assertEqual(ws.weakest()[0], 'a')
+        ws.remove('a')
+        ws.hit('c')
+        self.assertEqual(ws.weakest()[0], 'b')
+
+    def testLimit(self):
+        'Without a budget, containers are counted against the limit.'
+        ws = self.workingset
+        for name in 'ab':
+            ws.add(name, 10 ** 9)
+        self.assertFalse(ws.full(10 ** 9))
+        ws.add('c', 0)
+        self.assertTrue(ws.full())
+        self.assertTrue(WorkingSet(limit=0).full())
+
+    def testBudget(self):
+        'With a budget, containers are admitted while their bytes fit in it.'
+        ws = WorkingSet(budget=100, limit=1, clock=self.clock)
+        ws.add('a', 40)
+        ws.add('b', 40)
+        self.assertFalse(ws.full(20))
+        self.assertTrue(ws.full(21))
+        ws.remove('a')
+        self.assertEqual(ws.used, 40)
+        self.assertTrue(ws.fits(100))
+        self.assertFalse(ws.fits(101))
+
+    def testStaleDropped(self):
+        'Entries left behind by hits do not pile up.'
+        ws = self.workingset
+        ws.add('a', 0)
+        for i in range(1000):
+            ws.hit('a')
+        self.assertTrue(len(ws.heap) <= 2 * len(ws) + 17)
+        self.assertEqual(ws.weakest()[0], 'a')
+
+
+def suite():
+    workingset_suite = unittest.makeSuite(WorkingSetTest)
+    suite = unittest.TestSuite((workingset_suite))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.main()